@@ -14,10 +14,19 @@
 
 #include "output-llm.h"
 
+#include <cerrno>
 #include <cmath>
+#include <cstdint>
 #include <cstdlib>
+#include <cstring>
 #include <sstream>
 #include <fstream>
+#include <map>
+#include <string>
+#include <vector>
+#include <fcntl.h>
+#include <poll.h>
+#include <unistd.h>
 
 #include "ability.h"
 #include "art-enum.h"
@@ -34,6 +43,7 @@
 #include "item-name.h"
 #include "item-prop.h"
 #include "jobs.h"
+#include "level-id.h"
 #include "lang-fake.h"
 #include "libutil.h"
 #include "macro.h" // command_to_string
@@ -63,50 +73,84 @@
 #include "view.h"
 #include "xom.h"
 
-void output_data_for_llm()
-{
-    // Open and truncate 'llm_data.log'
-    std::ofstream outfile;
-    outfile.open("tmp/llm_data.log", std::ofstream::out | std::ofstream::trunc);
+// Cell flags in the grid dump format
+static const uint8_t LLM_CELL_PATH = 1 << 0;
+static const uint8_t LLM_CELL_KNOWN = 1 << 1;
 
-    outfile << "Dumping game state" << std::endl;
-    outfile << "GAME_SEED: " << you.game_seed << std::endl;
+// Sequence number of the current input request. Bumped once per output_data_for_llm() call.
+static uint64_t llm_input_seq = 0;
 
-    outfile << std::endl << "===SECTION===" << std::endl; // For easier parsing
-    outfile << "PLAYER_LOCATION: " << you.pos().x << "," << you.pos().y << std::endl;
-    outfile << "PLAYER_HEALTH: " << you.hp << "/" << you.hp_max << std::endl;
-    outfile << "PLAYER_LEVEL: " << you.experience_level << std::endl;
-    outfile << "PLAYER_GOLD: " << you.gold << std::endl;
-    outfile << "TURN_NUMBER: " << you.num_turns << std::endl;
+// Whether the harness was last told the game is running rather than waiting for a key
+static bool llm_running = false;
 
-    // Ignoring these game mechanics for now:
-    // - Magic
-    // - Regeneration
-    // - Gods
-    // - Runes
-    // - Active Items
-    
-    // Dump the player's inventory
-    outfile << std::endl << "===SECTION===" << std::endl; // For easier parsing
-    outfile << "PLAYER_INVENTORY" << std::endl;
-    for (int i = 0; i < ENDOFPACK; i++)
-    {
-        const item_def& item = you.inv[i];
-        if (!item.defined()) continue;
+// How long to wait for the harness to make room in the pipe before giving up on a write
+static const int LLM_WRITE_TIMEOUT_MS = 100;
 
-        outfile << "ITEM: " << item.name(DESC_PLAIN) << std::endl;
+// Most bytes to hold back for the harness. Past this, new messages are dropped.
+static const size_t LLM_MAX_PENDING_BYTES = 1 << 20;
+
+// Bytes for the side channel that the pipe had no room for yet. A message that was only
+// partly written is finished before anything else is sent, so the stream is never torn.
+static std::string llm_pending;
+
+/**
+ * The side channel to the LLM harness, from the LLM_SIGNAL_FD environment
+ * variable, or -1 if the game wasn't started by the harness. The pipe is made
+ * non-blocking, so a harness that stops reading can never stall the game.
+ */
+static int _llm_signal_fd()
+{
+    static int signal_fd = -2;
+    if (signal_fd == -2)
+    {
+        const char* fd_env = getenv("LLM_SIGNAL_FD");
+        signal_fd = fd_env ? atoi(fd_env) : -1;
+        if (signal_fd >= 0)
+            fcntl(signal_fd, F_SETFL, fcntl(signal_fd, F_GETFL) | O_NONBLOCK);
     }
+    return signal_fd;
+}
 
-    outfile << std::endl << "===SECTION===" << std::endl; // For easier parsing
-    outfile << "PLAYER_EQUIP" << std::endl;
-    for (const player_equip_entry& entry : you.equipment.items)
+/**
+ * Write as much of llm_pending as the pipe will take, waiting at most
+ * LLM_WRITE_TIMEOUT_MS each time it's full. True if all of it was written.
+ */
+static bool _flush_pending(int fd)
+{
+    while (!llm_pending.empty())
     {
-        const item_def& item = entry.get_item();
-        outfile << "ITEM: " << item.name(DESC_PLAIN) << std::endl;
+        const ssize_t written = write(fd, llm_pending.data(), llm_pending.size());
+        if (written < 0)
+        {
+            if (errno == EINTR) continue;
+            if (errno == EAGAIN || errno == EWOULDBLOCK)
+            {
+                pollfd pfd = { fd, POLLOUT, 0 };
+                if (poll(&pfd, 1, LLM_WRITE_TIMEOUT_MS) > 0) continue;
+                return false;
+            }
+            // The harness is gone, so nothing more can be delivered
+            llm_pending.clear();
+            return false;
+        }
+        llm_pending.erase(0, written);
     }
+    return true;
+}
 
-    // Dump the current floor map - both actual and remembered
-    outfile << std::endl << "===SECTION===" << std::endl; // For easier parsing
+// Queue a whole message for the harness and send what the pipe takes. False if it was dropped.
+static bool _send_to_harness(int fd, const std::string& message)
+{
+    if (llm_pending.size() + message.size() > LLM_MAX_PENDING_BYTES)
+        return false;
+    llm_pending += message;
+    _flush_pending(fd);
+    return true;
+}
+
+// One `CELL:` line per seen cell, followed by any monster or item on it
+static void _output_floor_text(std::ostringstream& outfile)
+{
     outfile << "CURRENT_FLOOR_MAP" << std::endl;
     for (int y = 0; y < GYM; y++)
     {
@@ -148,7 +192,344 @@ void output_data_for_llm()
                 outfile << "ITEM: " << x << "," << y << ": " << item.name(DESC_INVENTORY) << std::endl;
             }
         }
-    }    
+    }
+}
+
+// The floor as of one snapshot, in the form used by the grid format
+struct llm_floor_snapshot
+{
+    std::vector<uint8_t> features = std::vector<uint8_t>(GXM * GYM, 0);
+    std::vector<uint8_t> flags = std::vector<uint8_t>(GXM * GYM, 0);
+    std::map<int, std::string> monsters; // Cell index -> monster name
+    std::map<int, std::string> items;    // Cell index -> item name
+};
+
+// What the harness last received, so the next snapshot can be sent as a delta
+static struct
+{
+    uint64_t seq = 0; // 0 = nothing sent yet
+    level_id level;
+    int snapshots_since_keyframe = 0;
+    std::map<dungeon_feature_type, uint8_t> feature_ids;
+    std::vector<std::string> feature_names;
+    llm_floor_snapshot floor;
+} llm_sent;
+
+// Send a full keyframe at least this often, even if nothing forces one
+static const int LLM_KEYFRAME_INTERVAL = 50;
+
+static llm_floor_snapshot _snapshot_floor()
+{
+    llm_floor_snapshot snapshot;
+    for (int y = 0; y < GYM; y++)
+    {
+        for (int x = 0; x < GXM; x++)
+        {
+            const coord_def pos(x, y);
+            const dungeon_feature_type pos_actual = env.grid(pos);
+
+            // Skip empty cells
+            if (pos_actual == DNGN_UNSEEN) continue;
+
+            const int i = y * GXM + x;
+            const map_cell pos_memory = env.map_knowledge(pos);
+            const monster* mon = monster_at(pos);
+
+            // A level has far fewer than 255 distinct features, so ids fit in a byte
+            auto feature_id = llm_sent.feature_ids.find(pos_actual);
+            if (feature_id == llm_sent.feature_ids.end())
+            {
+                llm_sent.feature_names.push_back(dungeon_feature_name(pos_actual));
+                feature_id = llm_sent.feature_ids.emplace(pos_actual, llm_sent.feature_names.size()).first;
+            }
+            snapshot.features[i] = feature_id->second;
+
+            if (feat_is_traversable(pos_actual))
+                snapshot.flags[i] |= LLM_CELL_PATH;
+            if (pos_memory.feat() != DNGN_UNSEEN)
+                snapshot.flags[i] |= LLM_CELL_KNOWN;
+
+            if (mon)
+                snapshot.monsters[i] = mon->name(DESC_PLAIN);
+
+            if (pos_memory.item())
+                snapshot.items[i] = pos_memory.item()->name(DESC_INVENTORY);
+        }
+    }
+    return snapshot;
+}
+
+// `<prefix> x,y: name` for each entry, preceded by `<count_label>: <n>`
+static void _output_entity_lines(std::ostringstream& outfile, const char* count_label, const char* prefix,
+                                 const std::vector<std::pair<int, std::string>>& entries)
+{
+    outfile << count_label << ": " << entries.size() << "\n";
+    for (const auto& entry : entries)
+    {
+        outfile << prefix << " " << entry.first % GXM << "," << entry.first / GXM;
+        if (!entry.second.empty())
+            outfile << ": " << entry.second;
+        outfile << "\n";
+    }
+}
+
+// Entries in `current` that are new or different from `previous`
+static std::vector<std::pair<int, std::string>> _changed_entries(const std::map<int, std::string>& previous,
+                                                                 const std::map<int, std::string>& current)
+{
+    std::vector<std::pair<int, std::string>> changed;
+    for (const auto& entry : current)
+    {
+        const auto old = previous.find(entry.first);
+        if (old == previous.end() || old->second != entry.second)
+            changed.push_back(entry);
+    }
+    return changed;
+}
+
+/**
+ * Keyframe: the floor as fixed-size planes of GXM * GYM cells in row-major order,
+ * behind a small text header:
+ *
+ *   CURRENT_FLOOR_GRID: <width> <height>
+ *   FEATURES: <n>            followed by n feature names; feature id i is line i (1-based)
+ *   MONSTERS: <n>            followed by n `MONSTER: x,y: name` lines
+ *   ITEMS: <n>               followed by n `ITEM: x,y: name` lines
+ *   PLANES: <length>         followed by exactly `length` bytes:
+ *     uint8  feature id      (0 = unseen)
+ *     uint8  flags           (LLM_CELL_PATH | LLM_CELL_KNOWN)
+ *     uint16 monster index   (1-based into MONSTERS, 0 = none, native byte order)
+ *     uint16 item index      (1-based into ITEMS, 0 = none, native byte order)
+ */
+static void _output_floor_keyframe(std::ostringstream& outfile, const llm_floor_snapshot& floor)
+{
+    const int n_cells = GXM * GYM;
+    std::vector<uint16_t> monsters(n_cells, 0);
+    std::vector<uint16_t> items(n_cells, 0);
+    std::vector<std::pair<int, std::string>> monster_entries(floor.monsters.begin(), floor.monsters.end());
+    std::vector<std::pair<int, std::string>> item_entries(floor.items.begin(), floor.items.end());
+    for (size_t i = 0; i < monster_entries.size(); i++)
+        monsters[monster_entries[i].first] = i + 1;
+    for (size_t i = 0; i < item_entries.size(); i++)
+        items[item_entries[i].first] = i + 1;
+
+    outfile << "CURRENT_FLOOR_GRID: " << GXM << " " << GYM << "\n";
+    outfile << "FEATURES: " << llm_sent.feature_names.size() << "\n";
+    for (const std::string& name : llm_sent.feature_names)
+        outfile << name << "\n";
+    _output_entity_lines(outfile, "MONSTERS", "MONSTER:", monster_entries);
+    _output_entity_lines(outfile, "ITEMS", "ITEM:", item_entries);
+
+    outfile << "PLANES: " << n_cells * (2 * sizeof(uint8_t) + 2 * sizeof(uint16_t)) << "\n";
+    outfile.write(reinterpret_cast<const char*>(floor.features.data()), n_cells * sizeof(uint8_t));
+    outfile.write(reinterpret_cast<const char*>(floor.flags.data()), n_cells * sizeof(uint8_t));
+    outfile.write(reinterpret_cast<const char*>(monsters.data()), n_cells * sizeof(uint16_t));
+    outfile.write(reinterpret_cast<const char*>(items.data()), n_cells * sizeof(uint16_t));
+}
+
+/**
+ * Delta: only what changed since the snapshot with sequence number `base_seq`.
+ * Feature ids are the same as in that snapshot, with any new ones appended.
+ *
+ *   CURRENT_FLOOR_DELTA: <width> <height> <base_seq>
+ *   FEATURES: <n>            followed by the full feature name table
+ *   MONSTERS: <n>            followed by n new or changed `MONSTER: x,y: name` lines
+ *   MONSTERS_REMOVED: <n>    followed by n `MONSTER: x,y` lines
+ *   ITEMS: <n>               followed by n new or changed `ITEM: x,y: name` lines
+ *   ITEMS_REMOVED: <n>       followed by n `ITEM: x,y` lines
+ *   CELLS: <n>               followed by exactly 4 * n bytes of changed cells:
+ *     uint16 cell index      (y * width + x, native byte order)
+ *     uint8  feature id
+ *     uint8  flags
+ */
+static void _output_floor_delta(std::ostringstream& outfile, const llm_floor_snapshot& floor)
+{
+    const llm_floor_snapshot& previous = llm_sent.floor;
+
+    std::vector<std::pair<int, std::string>> monsters_removed;
+    for (const auto& entry : previous.monsters)
+        if (!floor.monsters.count(entry.first))
+            monsters_removed.emplace_back(entry.first, "");
+
+    std::vector<std::pair<int, std::string>> items_removed;
+    for (const auto& entry : previous.items)
+        if (!floor.items.count(entry.first))
+            items_removed.emplace_back(entry.first, "");
+
+    std::string cells;
+    for (int i = 0; i < GXM * GYM; i++)
+    {
+        if (floor.features[i] == previous.features[i] && floor.flags[i] == previous.flags[i])
+            continue;
+        const uint16_t index = i;
+        cells.append(reinterpret_cast<const char*>(&index), sizeof(index));
+        cells.push_back(floor.features[i]);
+        cells.push_back(floor.flags[i]);
+    }
+
+    outfile << "CURRENT_FLOOR_DELTA: " << GXM << " " << GYM << " " << llm_sent.seq << "\n";
+    outfile << "FEATURES: " << llm_sent.feature_names.size() << "\n";
+    for (const std::string& name : llm_sent.feature_names)
+        outfile << name << "\n";
+    _output_entity_lines(outfile, "MONSTERS", "MONSTER:", _changed_entries(previous.monsters, floor.monsters));
+    _output_entity_lines(outfile, "MONSTERS_REMOVED", "MONSTER:", monsters_removed);
+    _output_entity_lines(outfile, "ITEMS", "ITEM:", _changed_entries(previous.items, floor.items));
+    _output_entity_lines(outfile, "ITEMS_REMOVED", "ITEM:", items_removed);
+    outfile << "CELLS: " << cells.size() / 4 << "\n";
+    outfile << cells;
+}
+
+/**
+ * Dump the floor in the grid format. When `allow_delta` is set and the receiver
+ * has everything we sent before, only the changes since the last snapshot are
+ * sent. A keyframe is sent on level change and every LLM_KEYFRAME_INTERVAL
+ * snapshots.
+ */
+static void _output_floor_grid(std::ostringstream& outfile, bool allow_delta)
+{
+    const bool keyframe = !allow_delta
+                          || llm_sent.seq == 0
+                          || llm_sent.level != level_id::current()
+                          || llm_sent.snapshots_since_keyframe >= LLM_KEYFRAME_INTERVAL;
+    if (keyframe)
+    {
+        // Start a fresh feature table so ids don't accumulate across levels
+        llm_sent.feature_ids.clear();
+        llm_sent.feature_names.clear();
+    }
+
+    llm_floor_snapshot floor = _snapshot_floor();
+    if (keyframe)
+    {
+        _output_floor_keyframe(outfile, floor);
+        llm_sent.snapshots_since_keyframe = 0;
+    }
+    else
+    {
+        _output_floor_delta(outfile, floor);
+        llm_sent.snapshots_since_keyframe++;
+    }
+
+    llm_sent.seq = allow_delta ? llm_input_seq : 0;
+    llm_sent.level = level_id::current();
+    llm_sent.floor = std::move(floor);
+}
+
+// Whether LLM_DATA_FORMAT=grid selects the binary plane format for the floor map
+static bool _llm_grid_format()
+{
+    static int grid_format = -1;
+    if (grid_format < 0)
+    {
+        const char* format = getenv("LLM_DATA_FORMAT");
+        grid_format = format && strcmp(format, "grid") == 0;
+    }
+    return grid_format;
+}
+
+void output_data_for_llm()
+{
+    llm_input_seq++;
+
+    // If the harness still hasn't taken the last snapshot, drop this one rather than stall
+    // the game. It won't have this snapshot to apply a delta to, so the next is a keyframe.
+    const int signal_fd = _llm_signal_fd();
+    if (signal_fd >= 0 && !_flush_pending(signal_fd))
+    {
+        llm_sent.seq = 0;
+        return;
+    }
+
+    // Build the whole dump in memory so it can be delivered in one piece
+    std::ostringstream outfile;
+
+    outfile << "Dumping game state" << std::endl;
+    outfile << "GAME_SEED: " << you.game_seed << std::endl;
+    outfile << "SEQUENCE: " << llm_input_seq << std::endl;
+
+    outfile << std::endl << "===SECTION===" << std::endl; // For easier parsing
+    outfile << "PLAYER_LOCATION: " << you.pos().x << "," << you.pos().y << std::endl;
+    outfile << "PLAYER_HEALTH: " << you.hp << "/" << you.hp_max << std::endl;
+    outfile << "PLAYER_LEVEL: " << you.experience_level << std::endl;
+    outfile << "PLAYER_GOLD: " << you.gold << std::endl;
+    outfile << "TURN_NUMBER: " << you.num_turns << std::endl;
+
+    // Ignoring these game mechanics for now:
+    // - Magic
+    // - Regeneration
+    // - Gods
+    // - Runes
+    // - Active Items
+    
+    // Dump the player's inventory
+    outfile << std::endl << "===SECTION===" << std::endl; // For easier parsing
+    outfile << "PLAYER_INVENTORY" << std::endl;
+    for (int i = 0; i < ENDOFPACK; i++)
+    {
+        const item_def& item = you.inv[i];
+        if (!item.defined()) continue;
+
+        outfile << "ITEM: " << item.name(DESC_PLAIN) << std::endl;
+    }
+
+    outfile << std::endl << "===SECTION===" << std::endl; // For easier parsing
+    outfile << "PLAYER_EQUIP" << std::endl;
+    for (const player_equip_entry& entry : you.equipment.items)
+    {
+        const item_def& item = entry.get_item();
+        outfile << "ITEM: " << item.name(DESC_PLAIN) << std::endl;
+    }
+
+    // Dump the current floor map - both actual and remembered
+    outfile << std::endl << "===SECTION===" << std::endl; // For easier parsing
+    // Deltas are only safe over the side channel, where the harness sees every snapshot
+    if (_llm_grid_format())
+        _output_floor_grid(outfile, signal_fd >= 0);
+    else
+        _output_floor_text(outfile);
+
+    const std::string data = outfile.str();
+    if (signal_fd >= 0)
+    {
+        // Framed as `GAME_STATE: <seq> <length>` followed by exactly `length` bytes
+        if (!_send_to_harness(signal_fd, "GAME_STATE: " + std::to_string(llm_input_seq)
+                                         + " " + std::to_string(data.size()) + "\n" + data))
+        {
+            llm_sent.seq = 0;
+        }
+    }
+    else
+    {
+        // Not started by the harness - fall back to 'llm_data.log'
+        std::ofstream logfile("tmp/llm_data.log",
+                              std::ofstream::out | std::ofstream::trunc | std::ofstream::binary);
+        logfile << data;
+    }
+}
+
+/**
+ * Write `AWAITING_INPUT: <seq>` to the harness side channel, if any. The sequence
+ * number is that of the latest output_data_for_llm() snapshot, and increases by
+ * one every time the game is about to wait for a key.
+ */
+void signal_awaiting_input_for_llm()
+{
+    const int signal_fd = _llm_signal_fd();
+    if (signal_fd < 0) return;
+
+    llm_running = false;
+    _send_to_harness(signal_fd, "AWAITING_INPUT: " + std::to_string(llm_input_seq) + "\n");
+}
+
+/**
+ * Write `RUNNING: <seq>` to the harness side channel, if any, when the game starts
+ * autoexplore, travel, resting or another delayed action. Those take many steps
+ * without reading a key, and can pause between them. The next AWAITING_INPUT ends it.
+ */
+void signal_running_for_llm()
+{
+    const int signal_fd = _llm_signal_fd();
+    if (signal_fd < 0 || llm_running) return;
 
-    outfile.close();
+    llm_running = _send_to_harness(signal_fd, "RUNNING: " + std::to_string(llm_input_seq) + "\n");
 }
@@ -13,3 +13,5 @@
 #pragma once
 
 void output_data_for_llm();
+void signal_awaiting_input_for_llm();
+void signal_running_for_llm();
@@ -0,0 +1,140 @@
+from array import array
+import bisect
+from collections import OrderedDict
+import os
+import pickle
+from typing import Generic, List, Optional, TypeVar
+import zlib
+
+T = TypeVar("T")
+
+# How many of the latest entries are kept in memory by default. Enough for every turn the main game
+# shows in its history, so the prompt never has to wait for the disk.
+DEFAULT_MEMORY_SIZE = 64
+
+
+class HistoryStore(Generic[T]):
+    """
+    Something recorded every turn, by iteration, that doesn't grow in memory however long the game.
+
+    The latest `memory_size` entries are kept in memory. Older ones are pickled, compressed, and
+    appended to the file at `path`, and read back from it when asked for. Without a `path`, older
+    entries are forgotten.
+
+    The file must not exist yet, as only this store knows where its entries are: give each store its
+    own path. `close` the store, or use it as a context manager, to delete the file when done.
+
+    Iterations must be added in increasing order, though the latest ones in memory may be replaced.
+    """
+    def __init__(self, path: Optional[str], memory_size: int = DEFAULT_MEMORY_SIZE):
+        if memory_size < 1:
+            raise ValueError("memory_size must be at least 1")
+        self.memory_size = memory_size
+        self._recent: "OrderedDict[int, T]" = OrderedDict()
+
+        # Where each spilled iteration's record starts in the file, in order. Arrays rather than a
+        # dict, so the index costs 16 bytes per entry
+        self._iterations = array("q")
+        self._offsets = array("q")
+        self._end = 0
+        # Entries that fell out of memory with no file to spill to, still counted by `len`
+        self._forgotten = 0
+        self._last_forgotten: Optional[int] = None
+
+        self.path = path
+        self._file = None
+        if path is not None:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self._file = open(path, "x+b")
+
+    def append(self, iteration: int, value: T) -> None:
+        if iteration not in self._recent:
+            latest = next(reversed(self._recent), None)
+            if latest is None:
+                latest = self._iterations[-1] if self._iterations else self._last_forgotten
+            if latest is not None and iteration <= latest:
+                raise ValueError(f"Iteration {iteration} was added after iteration {latest}")
+        self._recent[iteration] = value
+
+        while len(self._recent) > self.memory_size:
+            self._spill(*self._recent.popitem(last=False))
+
+    def __setitem__(self, iteration: int, value: T) -> None:
+        self.append(iteration, value)
+
+    def __getitem__(self, iteration: int) -> T:
+        if iteration in self._recent:
+            return self._recent[iteration]
+
+        index = self._spilled_index(iteration)
+        if index is None:
+            raise KeyError(iteration)
+        return self._read(index)
+
+    def get(self, iteration: int, default: Optional[T] = None) -> Optional[T]:
+        try:
+            return self[iteration]
+        except KeyError:
+            return default
+
+    def __contains__(self, iteration: int) -> bool:
+        return iteration in self._recent or self._spilled_index(iteration) is not None
+
+    def __len__(self) -> int:
+        """How many entries were added, including any that were forgotten."""
+        return len(self._iterations) + len(self._recent) + self._forgotten
+
+    def last(self) -> Optional[T]:
+        """The latest entry, or None if there are none."""
+        if self._recent:
+            return next(reversed(self._recent.values()))
+        return self._read(len(self._iterations) - 1) if self._iterations and self._file is not None else None
+
+    def latest(self, count: int) -> List[T]:
+        """The latest `count` entries, oldest first. Fewer if there aren't that many, or they were forgotten."""
+        if count <= 0:
+            return []
+        recent = list(self._recent.values())[-count:]
+        missing = count - len(recent)
+        if missing <= 0 or self._file is None:
+            return recent
+        start = max(0, len(self._iterations) - missing)
+        return [self._read(index) for index in range(start, len(self._iterations))] + recent
+
+    def close(self) -> None:
+        """Close and delete the file. Entries that were spilled to it can't be read any more."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            os.remove(self.path)
+
+    def __enter__(self) -> "HistoryStore[T]":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _spilled_index(self, iteration: int) -> Optional[int]:
+        """Where `iteration` is in the file's index, or None if it was never spilled or was forgotten."""
+        index = bisect.bisect_left(self._iterations, iteration)
+        if self._file is None or index == len(self._iterations) or self._iterations[index] != iteration:
+            return None
+        return index
+
+    def _spill(self, iteration: int, value: T) -> None:
+        if self._file is None:
+            self._forgotten += 1
+            self._last_forgotten = iteration
+            return
+        record = zlib.compress(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+        self._file.seek(self._end)
+        self._file.write(record)
+        self._iterations.append(iteration)
+        self._offsets.append(self._end)
+        self._end += len(record)
+
+    def _read(self, index: int) -> T:
+        start = self._offsets[index]
+        end = self._offsets[index + 1] if index + 1 < len(self._offsets) else self._end
+        self._file.seek(start)
+        return pickle.loads(zlib.decompress(self._file.read(end - start)))
@@ -0,0 +1,40 @@
+from typing import Any, Dict, List, Optional
+
+from langchain_core.messages import BaseMessage, SystemMessage
+
+from dcssllm.agent.util import notnull, prep_message, trim_indent
+
+
+class StablePrefix:
+    """
+    The static instructions at the start of a prompt, assembled once so every prompt starts with
+    the same bytes. Providers and llama.cpp only reuse their cached prefill up to the first byte
+    that differs, so nothing that changes between calls may be merged into it.
+
+    With `cache_marker`, the prefix is marked with an Anthropic-style `cache_control` breakpoint,
+    for providers that only cache what they're told to. Leave it off for providers that reject it.
+    """
+    def __init__(self, *blocks: str, cache_marker: bool = False):
+        text = "\n\n".join(trim_indent(block) for block in blocks)
+        if cache_marker:
+            self.message = SystemMessage([{"type": "text", "text": text, "cache_control": {"type": "ephemeral"}}])
+        else:
+            self.message = SystemMessage(text)
+
+    def build(self, turn: List[Optional[BaseMessage]]) -> List[BaseMessage]:
+        """
+        The prompt: the prefix, then the per-turn messages in the order given. Callers should order
+        them from least to most likely to change, so the cache covers as much as possible.
+        """
+        return [self.message, *prep_message(notnull(turn))]
+
+
+def llama_cpp_cache_kwargs(slot: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Model kwargs that make a llama.cpp server reuse the KV cache of its previous prompt. Pin each
+    game to its own `slot` when several share a server, or they'll evict each other's cache.
+    """
+    extra_body: Dict[str, Any] = {"cache_prompt": True}
+    if slot is not None:
+        extra_body["id_slot"] = slot
+    return {"extra_body": extra_body}
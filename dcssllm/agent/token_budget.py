@@ -0,0 +1,164 @@
+import functools
+import json
+import logging
+import os
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+from langchain_core.messages import BaseMessage
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+# Context window of the smallest model we route to (the local one)
+DEFAULT_CONTEXT_TOKENS = 32768
+
+# Room left in the window for tool definitions, the turn's own tool calls and results, and the response
+DEFAULT_RESERVED_TOKENS = 8192
+
+# Most tokens each section may use, before the overall cap is considered
+DEFAULT_SECTION_LIMITS = {
+    "memory": 2000,
+    "history": 8000,
+    "map": 3000,
+}
+
+# Sections shrunk, in this order, when the prompt is over the overall cap
+DEFAULT_SHRINK_ORDER = ("screen_ansi", "history", "map")
+
+# Rough characters per token, when tiktoken isn't installed
+CHARS_PER_TOKEN = 4
+
+# Weight of each response's reported prompt size when calibrating counts to the model's tokenizer
+CALIBRATION_SMOOTHING = 0.2
+
+
+class TokenCounter:
+    """
+    Counts tokens in prompt text, with tiktoken if it's installed and four characters per token
+    if not. Neither matches every model's tokenizer, so counts are scaled by a correction
+    calibrated from the prompt sizes providers report back.
+    """
+    def __init__(self, encoding: str = "cl100k_base"):
+        self._encoding = tiktoken.get_encoding(encoding) if tiktoken is not None else None
+        self.correction = 1.0
+        # The same text comes back on every chatbot call, so remember what it counted to
+        self._count_text = functools.lru_cache(maxsize=1024)(self._count_raw)
+
+    def _count_raw(self, text: str) -> int:
+        if self._encoding is not None:
+            return len(self._encoding.encode(text, disallowed_special=()))
+        return len(text) // CHARS_PER_TOKEN
+
+    def count(self, messages: Sequence[BaseMessage]) -> int:
+        return round(sum(self._count_text(_text_of(message)) for message in messages) * self.correction)
+
+    def calibrate(self, messages: Sequence[BaseMessage], actual_tokens: int) -> None:
+        """Nudge the correction towards what the model reported for a prompt of these messages."""
+        counted = sum(self._count_text(_text_of(message)) for message in messages)
+        if counted <= 0 or actual_tokens <= 0:
+            return
+        self.correction += CALIBRATION_SMOOTHING * (actual_tokens / counted - self.correction)
+
+
+class PromptSection:
+    """
+    A named part of a prompt. `shrink`, if given, returns a smaller version of the section that
+    fits in a number of tokens, as best it can.
+    """
+    def __init__(self, name: str, messages: Sequence[Optional[BaseMessage]],
+                 shrink: Optional[Callable[[int], List[BaseMessage]]] = None):
+        self.name = name
+        self.messages = [message for message in messages if message is not None]
+        self.shrink = shrink
+
+
+class TokenBudget:
+    """
+    Keeps a prompt within the model's context window. Each section is held to its own limit first,
+    then sections are shrunk in `shrink_order` until the whole prompt is under `max_prompt_tokens`.
+
+    The tokens each section used are appended to `log_path` as a JSON line per prompt, to show
+    where prefill time goes.
+    """
+    def __init__(self, context_tokens: int = DEFAULT_CONTEXT_TOKENS,
+                 reserved_tokens: int = DEFAULT_RESERVED_TOKENS,
+                 section_limits: Optional[Dict[str, int]] = None,
+                 shrink_order: Sequence[str] = DEFAULT_SHRINK_ORDER,
+                 counter: Optional[TokenCounter] = None,
+                 log_path: Optional[str] = "tmp/prompt_budget.jsonl"):
+        self.max_prompt_tokens = context_tokens - reserved_tokens
+        self.section_limits = dict(DEFAULT_SECTION_LIMITS if section_limits is None else section_limits)
+        self.shrink_order = tuple(shrink_order)
+        self.counter = counter or TokenCounter()
+        self.log_path = log_path
+
+    def fit(self, sections: List[PromptSection], prefix: Sequence[BaseMessage] = (),
+            **log_fields: Any) -> List[BaseMessage]:
+        """
+        The messages of every section, in order, after shrinking them to fit the budget. `prefix` is
+        sent before them and counts against the budget, but is never shrunk or returned.
+        """
+        counts = {"prefix": self.counter.count(prefix)}
+        counts.update((section.name, self.counter.count(section.messages)) for section in sections)
+        original = dict(counts)
+
+        for section in sections:
+            limit = self.section_limits.get(section.name)
+            if limit is not None and counts[section.name] > limit:
+                self._shrink(section, limit, counts)
+
+        by_name = {section.name: section for section in sections}
+        for name in self.shrink_order:
+            excess = sum(counts.values()) - self.max_prompt_tokens
+            if excess <= 0:
+                break
+            # An empty section has nothing to give up, and its shrinker may not expect to be called
+            if name in by_name and counts[name] > 0:
+                self._shrink(by_name[name], max(0, counts[name] - excess), counts)
+
+        total = sum(counts.values())
+        if total > self.max_prompt_tokens:
+            logger.warning(f"Prompt is {total} tokens after shrinking, over the budget of {self.max_prompt_tokens}")
+        self._log({**log_fields, "total": total, "sections": counts,
+                   "shrunk": {name: count for name, count in original.items() if counts[name] != count}})
+        return [message for section in sections for message in section.messages]
+
+    def _shrink(self, section: PromptSection, target: int, counts: Dict[str, int]) -> None:
+        if section.shrink is None:
+            return
+        section.messages = section.shrink(target)
+        counts[section.name] = self.counter.count(section.messages)
+
+    def _log(self, entry: Dict[str, Any]) -> None:
+        if self.log_path is None:
+            return
+        os.makedirs(os.path.dirname(self.log_path) or ".", exist_ok=True)
+        with open(self.log_path, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+
+
+def largest_that_fits(build: Callable[[int], List[BaseMessage]], low: int, high: int,
+                      counter: TokenCounter, target: int) -> List[BaseMessage]:
+    """
+    `build(size)` for the largest size in [low, high] whose messages fit in `target` tokens, assuming
+    bigger sizes give bigger messages. `build(low)` if none fit.
+    """
+    smallest, best = low, None
+    while low <= high:
+        middle = (low + high) // 2
+        messages = build(middle)
+        if counter.count(messages) <= target:
+            best, low = messages, middle + 1
+        else:
+            high = middle - 1
+    return best if best is not None else build(smallest)
+
+
+def _text_of(message: BaseMessage) -> str:
+    if isinstance(message.content, str):
+        return message.content
+    return "".join(block.get("text", "") if isinstance(block, dict) else str(block) for block in message.content)
@@ -1,3 +1,4 @@
+import functools
 import textwrap
 from typing import List, Any, Optional
 from langchain_core.messages.base import BaseMessage
@@ -57,22 +58,54 @@ def prep_message(value: List[BaseMessage]) -> List[BaseMessage]:
     """
     Conversation roles must alternate user/assistant/user/assistant...
 
-    This function consolidates adjacent messages of the same role into a single message and applies trim_indent to the content.
+    This function consolidates adjacent messages of the same role into a single message and applies trim_indent
+    to the content of system and user messages. The messages given are never modified: merged or trimmed messages
+    are new copies, and the rest are returned as they are, so static messages can be built once and reused.
     """
-    value = notnull(value)
-    if not value:
-        return value
-
-    value[0].content = trim_indent(value[0].content)
-    consolidated = [value[0]]
-    for message in value[1:]:
-        if message.type == consolidated[-1].type and message.type != "tool":
-            consolidated[-1].content += "\n\n" + trim_indent(message.content)
-        else:
-            consolidated.append(message)
-
+    consolidated = []
+    run = []
+    for message in notnull(value):
+        if run and not _can_merge(run[-1], message):
+            consolidated.append(_merge(run))
+            run = []
+        run.append(message)
+    if run:
+        consolidated.append(_merge(run))
     return consolidated
 
+
+def _can_merge(previous: BaseMessage, message: BaseMessage) -> bool:
+    # Content blocks (images, cache markers) can't be joined as text, so they stay separate
+    return (message.type == previous.type and message.type != "tool"
+            and isinstance(previous.content, str) and isinstance(message.content, str))
+
+
+def _merge(run: List[BaseMessage]) -> BaseMessage:
+    """One message with the content of all of `run`, which are of the same type."""
+    first = run[0]
+    if len(run) == 1:
+        content = _trimmed(first)
+        return first if content is first.content else first.model_copy(update={"content": content})
+    return first.model_copy(update={"content": "\n\n".join(_trimmed(message) for message in run)})
+
+
+def _trimmed(message: BaseMessage) -> Any:
+    """The message's content with trim_indent applied, for system and user messages."""
+    if message.type not in ("system", "human") or not isinstance(message.content, str):
+        return message.content
+    trimmed = _trim_indent_cached(message.content)
+    # Keep the original string if nothing changed, so callers can tell no copy is needed
+    return message.content if trimmed == message.content else trimmed
+
+
+@functools.lru_cache(maxsize=256)
+def _trim_indent_cached(text: str) -> str:
+    """
+    trim_indent, remembered. Static instructions and the screens in the turn history are passed in again on
+    every chatbot call, so most calls only hash a string whose hash Python has already cached.
+    """
+    return trim_indent(text)
+
 def log_llm_io(
     agent_name: str, iteration: int, chatbot_message_number: int, 
     type: str, messages: List[BaseMessage],
@@ -1,5 +1,7 @@
 
-from typing import List
+import os
+from typing import List, Optional
+import uuid
 from logging import getLogger
 
 from langchain_core.messages import HumanMessage
@@ -7,6 +9,8 @@ from langchain_core.language_models.chat_models import BaseChatModel
 
 from dcssllm.agent.util import *
 from dcssllm.agent.base_agent import BaseAgent
+from dcssllm.agent.history_store import DEFAULT_MEMORY_SIZE, HistoryStore
+from dcssllm.agent.token_budget import TokenBudget
 from dcssllm.agent.v1.general_instructions import *
 from dcssllm.agent.v1.subagent_main_game import SubagentMainGame
 from dcssllm.agent.v1.subagent_start_game import SubagentStartGame
@@ -14,6 +18,7 @@ from dcssllm.agent.v1.tool import StatefulTool
 from dcssllm.agent.v1.tool_game_state import ToolGameState
 from dcssllm.agent.v1.tool_longterm_memory import LongTermMemory, ToolWriteLongTermMemory
 from dcssllm.agent.v1.tool_send_key_press import ToolSendKeyPress
+from dcssllm.agent.v1.tool_travel import ToolTravel
 from dcssllm.curses_utils import CursesApplication
 
 
@@ -23,18 +28,36 @@ class V1Agent(BaseAgent):
     def __init__(self, game: CursesApplication,
                  llm_default: BaseChatModel,
                  llm_start_game: BaseChatModel = None, 
-                 llm_main_game: BaseChatModel = None,):
+                 llm_main_game: BaseChatModel = None,
+                 prompt_cache_markers: bool = False,
+                 prompt_budget: Optional[TokenBudget] = None,
+                 history_directory: Optional[str] = "tmp/history",
+                 history_memory_size: int = DEFAULT_MEMORY_SIZE):
         super().__init__()
         self.game = game # Connection to the game instance
 
+        # Whether to mark the static start of prompts for providers that need explicit cache breakpoints
+        self.prompt_cache_markers = prompt_cache_markers
+
+        # Keeps the main game's prompt within the smallest model's context window
+        self.prompt_budget = prompt_budget or TokenBudget()
+
         # Current game mode (main_menu, main_game, etc)
         self.game_state = ""
 
+        # Where per-turn history older than the last `history_memory_size` turns is kept, if anywhere.
+        # Files are named for this agent, so agents sharing the directory don't overwrite each other.
+        self.history_directory = history_directory
+        self.history_memory_size = history_memory_size
+        self._history_run_id = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._history_stores: List[HistoryStore] = []
+
         # Screen data and history
         self.latest_screen = ""
         self.latest_text_only_screen = ""
-        self.previous_screen = {}
-        self.previous_text_only_screen = {}
+        self.previous_screen: HistoryStore[str] = self.create_history_store("screens")
+        self.previous_text_only_screen: HistoryStore[str] = self.create_history_store("text_only_screens")
+        self.latest_fingerprint: Optional[int] = None
 
         # Utility to track if the last action didn't do anything
         self.nothing_happened = False
@@ -47,9 +70,11 @@ class V1Agent(BaseAgent):
         self.tool_write_long_term_memory = ToolWriteLongTermMemory(self, self.long_term_memory)
 
         self.tool_game_state = ToolGameState(self)
+        self.tool_travel = ToolTravel(self)
         self.tools: List[StatefulTool] = [
             self.tool_send_key_press,
             self.tool_game_state,
+            self.tool_travel,
             self.tool_write_long_term_memory,
         ]
 
@@ -68,13 +93,41 @@ class V1Agent(BaseAgent):
             tool.on_new_turn()
 
         if self.game_state == "main_menu":
+            self.tool_travel.stop()
             await self.subagent_start_game.ai_turn()
             return
 
         if self.game_state == "main_game":
+            # Keep walking the route of an earlier travel call, if it's going to plan
+            if self.tool_travel.continue_route():
+                return
             await self.subagent_main_game.ai_turn()
 
 
+    def create_history_store(self, name: str) -> HistoryStore:
+        """
+        A store for something recorded every turn, spilling to `history_directory` under `name`.
+        Closed with the agent.
+        """
+        path = None
+        if self.history_directory is not None:
+            path = os.path.join(self.history_directory, f"{name}-{self._history_run_id}.bin")
+        store = HistoryStore(path, self.history_memory_size)
+        self._history_stores.append(store)
+        return store
+
+    def close(self) -> None:
+        """Close the history stores, deleting their files."""
+        for store in self._history_stores:
+            store.close()
+
+    def __enter__(self) -> "V1Agent":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
     def get_message_no_action(self):
         if self.nothing_happened:
             return HumanMessage(trim_indent(f"""
@@ -88,12 +141,14 @@ class V1Agent(BaseAgent):
 
 
     def _on_new_screen(self, screen: str, text_only_screen: str):
+        previous_fingerprint = self.latest_fingerprint
+        self.latest_fingerprint = self.game.fingerprint()
         self.latest_screen = screen
         self.latest_text_only_screen = text_only_screen
         self.previous_screen[self.iterations] = self.latest_screen
         self.previous_text_only_screen[self.iterations] = self.latest_text_only_screen
 
-        if self.tool_send_key_press._sent_key and self.previous_screen == self.latest_screen:
+        if self.tool_send_key_press._sent_key and previous_fingerprint == self.latest_fingerprint:
             logger.info(f"[STATE CHANGE] Setting 'Nothing Happened' Flag")
             self.nothing_happened = True
             self.nothing_happened_keys.add(self.tool_send_key_press._previous_key)
@@ -29,13 +29,17 @@ class BaseAgentState(TypedDict):
 
 def create_chatbot_node[T: BaseAgentState](
     name: str, llm: BaseChatModel, 
-    bot_func: Callable[[T], Tuple[List[BaseMessage], T]]
+    bot_func: Callable[[T], Tuple[List[BaseMessage], T]],
+    on_response: Optional[Callable[[List[BaseMessage], BaseMessage], None]] = None,
 ):
-    def chatbot(state: T):
+    async def chatbot(state: T):
         request, new_state = bot_func(state)
         log_llm_io(name, state["iteration"], state["_chatbot_message_number"], "prompt", request)
-        response = llm.invoke(request)
+        # Async, so waiting for quota doesn't stall the game's PTY reader
+        response = await llm.ainvoke(request)
         log_llm_io(name, state["iteration"], state["_chatbot_message_number"], "response", [response])
+        if on_response is not None:
+            on_response(request, response)
 
         if isinstance(response, AIMessage) and response.usage_metadata:
             incr_input_tokens = response.usage_metadata["input_tokens"]
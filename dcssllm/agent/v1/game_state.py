@@ -1,15 +1,73 @@
 from logging import getLogger
 from dataclasses import dataclass
+from array import array
 import math
-from typing import List, Dict, Tuple, Optional, Any
+import re
+import struct
+import sys
+from typing import List, Dict, Set, Tuple, Optional, Any, Callable, TYPE_CHECKING
+import weakref
 
 from dcssllm.agent.util import trim_indent
+from dcssllm.agent.v1.spatial_index import DistanceMetric, SpatialIndex
+
+if TYPE_CHECKING:
+    from dcssllm.agent.v1.game_state_delta import GameStateDelta
 
 
 logger = getLogger(__name__)
 
 
-@dataclass
+# Binary map format, selected with LLM_DATA_FORMAT=grid. Either a full keyframe or a delta
+# against the previous snapshot.
+GRID_SECTION_MARKERS = (b"\nCURRENT_FLOOR_GRID:", b"\nCURRENT_FLOOR_DELTA:")
+GRID_FLAG_PATH = 1 << 0
+GRID_FLAG_KNOWN = 1 << 1
+
+# Set on every cell that has a feature. Only used in our flag plane, never sent by the game.
+CELL_FLAG_SEEN = 1 << 2
+
+# Feature names are interned process-wide, so a feature id means the same thing in every snapshot.
+# Id 0 is reserved for unseen cells.
+FEATURE_NAMES: List[str] = [""]
+_FEATURE_IDS: Dict[str, int] = {}
+
+
+def intern_feature(name: str) -> int:
+    """Get the process-wide feature id for a feature name, assigning a new one if needed."""
+    feature_id = _FEATURE_IDS.get(name)
+    if feature_id is None:
+        if len(FEATURE_NAMES) > 255:
+            raise ValueError(f"Too many distinct features to fit in a byte plane: {name}")
+        feature_id = len(FEATURE_NAMES)
+        FEATURE_NAMES.append(name)
+        _FEATURE_IDS[name] = feature_id
+    return feature_id
+
+
+def _make_render_table(require_knowledge: bool) -> bytes:
+    """Translation table from a flag byte to the map character for that cell."""
+    table = bytearray(b" " * 256)
+    for flags in range(256):
+        if flags & CELL_FLAG_SEEN and (flags & GRID_FLAG_KNOWN or not require_knowledge):
+            table[flags] = ord(".") if flags & GRID_FLAG_PATH else ord("#")
+    return bytes(table)
+
+
+_RENDER_TABLES = {True: _make_render_table(True), False: _make_render_table(False)}
+
+# Translation table from a feature id to CELL_FLAG_SEEN if the cell has a feature
+_SEEN_TABLE = bytes([0] + [CELL_FLAG_SEEN] * 255)
+
+
+def _or_planes(a: bytes, b: bytes) -> bytearray:
+    """Bytewise OR of two planes of the same length, as a single big integer operation."""
+    return bytearray((int.from_bytes(a) | int.from_bytes(b)).to_bytes(len(a)))
+
+
+# Snapshots are kept in history for many turns, so entities are slotted and immutable, and share
+# their names and positions instead of holding fresh copies per snapshot.
+@dataclass(frozen=True, slots=True)
 class Position:
     x: int
     y: int
@@ -26,97 +84,283 @@ class Position:
         return f"({self.x}, {self.y})"
 
 
-@dataclass
+# Shared Position instances for every cell of the largest map the game makes (GXM x GYM)
+_POSITION_GRID_SIZE = (70, 80)  # (height, width)
+_POSITION_GRID = [Position(x, y) for y in range(_POSITION_GRID_SIZE[0]) for x in range(_POSITION_GRID_SIZE[1])]
+
+
+def position_at(x: int, y: int) -> Position:
+    """Get the shared Position for (x, y). Only positions off the map are newly allocated."""
+    height, width = _POSITION_GRID_SIZE
+    if 0 <= x < width and 0 <= y < height:
+        return _POSITION_GRID[y * width + x]
+    return Position(x, y)
+
+
+def intern_name(name: str) -> str:
+    """Get the process-wide copy of a monster or item name, so repeated names share one string."""
+    return sys.intern(name)
+
+
+@dataclass(frozen=True, slots=True)
 class Cell:
     feature: str
     traversable: bool = False
     known: bool = False
 
 
-@dataclass
+# Shared Cell instances, keyed by (feature id, GRID_FLAG_PATH | GRID_FLAG_KNOWN bits)
+_CELLS: Dict[Tuple[int, int], Cell] = {}
+
+
+@dataclass(frozen=True, slots=True)
 class Monster:
     name: str
     position: Position
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class Item:
     name: str
     position: Optional[Position] = None  # None for inventory items
 
 
-class GameState:
-    def __init__(self, filename: str = "tmp/llm_data.log"):
-        # Player data
-        self.player_pos: Optional[Position] = None
-        self.player_health: Tuple[int, int] = (0, 0)  # current, max
-        self.player_level: int = 0
-        self.player_gold: int = 0
-        self.turn_number: int = 0
-        self.game_seed: int = 0
-
-        # Items
-        self.inventory: List[Item] = []
-        self.equipment: List[Item] = []
-        self.floor_items: List[Item] = []
-
-        # Keys are Position objects, values are Cell objects
-        self.map: Dict[Position, Cell] = {}
-        self.map_size: Tuple[int, int] = (70, 80)  # (height, width) = (y, x)
-        self.monsters: List[Monster] = []
-
-        """Parse the llm_data.log file and populate the game state."""
-        try:
-            with open(filename, 'r') as f:
-                lines = f.readlines()
-        except FileNotFoundError:
-            logger.warn(f"Could not find {filename}")
-            return
+# Which lazily parsed section of the dump each GameState attribute comes from
+_SECTION_ATTRIBUTES: Dict[str, str] = {
+    **dict.fromkeys(("player_pos", "player_health", "player_level", "player_gold", "turn_number"), "player"),
+    "inventory": "inventory",
+    "equipment": "equipment",
+    **dict.fromkeys(("map_size", "monsters", "floor_items", "feature_plane", "flag_plane",
+                     "monster_plane", "item_plane", "map_sequence"), "map"),
+}
 
-        current_section: Optional[str] = None
+# The first line of each text section, which says what the section is
+_SECTION_HEADERS = (
+    (b"PLAYER_LOCATION:", "player"),
+    (b"PLAYER_INVENTORY", "inventory"),
+    (b"PLAYER_EQUIP", "equipment"),
+    (b"CURRENT_FLOOR_MAP", "map"),
+)
+_SECTION_MARKER = b"===SECTION==="
+_NON_WHITESPACE = re.compile(rb"\S")
 
-        for line in lines:
-            line = line.strip()
 
-            # Skip empty lines
-            if not line:
-                continue
-
-            # Check for section markers
-            if line == "===SECTION===":
-                current_section = None
-                continue
+class GameState:
+    """
+    A snapshot of the game state dump. Reads `filename` unless `data` is given. If the dump's map is a delta,
+    it's applied on top of `previous`, which must be the snapshot just before it.
+
+    Only the section offsets are found up front. The player, inventory, equipment and map sections are each
+    parsed the first time one of their attributes is read, so snapshots whose map is never looked at are cheap.
+    """
+    # Player data
+    player_pos: Optional[Position]
+    player_health: Tuple[int, int]  # current, max
+    player_level: int
+    player_gold: int
+    turn_number: int
+
+    # Items
+    inventory: List[Item]
+    equipment: List[Item]
+    floor_items: List[Item]
+
+    map_size: Tuple[int, int]  # (height, width) = (y, x)
+    monsters: List[Monster]
+
+    # The map as dense planes of map_size cells in row-major order (index = y * width + x)
+    feature_plane: bytearray   # Interned feature ids (see FEATURE_NAMES), 0 = unseen
+    flag_plane: bytearray      # GRID_FLAG_* and CELL_FLAG_SEEN bits
+    monster_plane: array       # 1-based index into self.monsters, 0 = none
+    item_plane: array          # 1-based index into self.floor_items, 0 = none
+
+    # Sequence number of the snapshot the map is in sync with, or None if a delta couldn't be applied
+    map_sequence: Optional[int]
+
+    def __init__(self, filename: str = "tmp/llm_data.log", data: Optional[bytes] = None,
+                 previous: Optional["GameState"] = None):
+        self._loaded: Set[str] = set()
+        self.game_seed: int = 0
+        self.sequence: int = 0
+
+        # Byte ranges of each section in the dump
+        self._data: Optional[bytes] = None
+        self._sections: Dict[str, Tuple[int, int]] = {}
+        self._map_is_grid = False
+        self._map_is_delta = False
+
+        # Only kept until our map is parsed, and only if it's a delta on top of the previous one
+        self._previous: Optional["GameState"] = None
+
+        # Spatial indexes and query results, built on first use. A GameState is never modified
+        # after parsing, so these stay valid for the life of the snapshot.
+        self._monster_index: Optional[SpatialIndex[Monster]] = None
+        self._item_index: Optional[SpatialIndex[Item]] = None
+        self._query_cache: Dict[Tuple, List] = {}
+        # Only weakly refers to the previous snapshot, or every snapshot would keep the one before alive
+        self._delta_cache: Optional[Tuple["weakref.ReferenceType[GameState]", "GameStateDelta"]] = None
+
+        if data is None:
+            try:
+                with open(filename, 'rb') as f:
+                    data = f.read()
+            except FileNotFoundError:
+                logger.warn(f"Could not find {filename}")
+                return
+
+        self._data = data
+        self._index_sections(data)
+        if self._map_is_delta:
+            self._previous = previous
+
+    def __getattr__(self, name: str) -> Any:
+        # Only called for attributes that aren't set yet, so a section's parser runs once
+        section = _SECTION_ATTRIBUTES.get(name)
+        if section is None or section in self.__dict__.get("_loaded", (section,)):
+            raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+        getattr(self, f"_load_{section}")()
+        return object.__getattribute__(self, name)
+
+    def _index_sections(self, data: bytes) -> None:
+        """Find where each section of the dump starts and ends, in one pass."""
+        # With LLM_DATA_FORMAT=grid, the map is a binary section at the end of the dump
+        text_end = len(data)
+        for marker in GRID_SECTION_MARKERS:
+            grid_start = data.find(marker)
+            if grid_start >= 0:
+                self._sections["map"] = (grid_start + 1, len(data))
+                self._map_is_grid = True
+                self._map_is_delta = marker == GRID_SECTION_MARKERS[1]
+                text_end = grid_start + 1
+                break
+
+        start = 0
+        while start < text_end:
+            end = data.find(_SECTION_MARKER, start, text_end)
+            if end < 0:
+                end = text_end
+
+            first = _NON_WHITESPACE.search(data, start, end)
+            if first is not None:
+                for header, section in _SECTION_HEADERS:
+                    if data.startswith(header, first.start()):
+                        self._sections.setdefault(section, (first.start(), end))
+                        break
+                else:
+                    self._parse_header(data[start:end])
+            start = end + len(_SECTION_MARKER)
 
-            # Determine which section we're in
-            if line.startswith("PLAYER_LOCATION:"):
-                current_section = "player_data"
-            elif line.startswith("PLAYER_INVENTORY"):
-                current_section = "inventory"
-            elif line.startswith("PLAYER_EQUIP"):
-                current_section = "equipment"
-            elif line.startswith("CURRENT_FLOOR_MAP"):
-                current_section = "map"
-            elif line.startswith("GAME_SEED:"):
+    def _parse_header(self, text: bytes) -> None:
+        for line in text.decode(errors="replace").splitlines():
+            line = line.strip()
+            if line.startswith("GAME_SEED:"):
                 self.game_seed = int(line.split(": ")[1])
+            elif line.startswith("SEQUENCE:"):
+                self.sequence = int(line.split(": ")[1])
 
-            # Process line based on current section
-            if current_section == "player_data":
-                self._parse_player_data(line)
-            elif current_section == "inventory" and line.startswith("ITEM:"):
-                item_name = line[6:].strip()
-                self.inventory.append(Item(name=item_name))
-            elif current_section == "equipment" and line.startswith("ITEM:"):
-                item_name = line[6:].strip()
-                self.equipment.append(Item(name=item_name))
-            elif current_section == "map":
-                self._parse_map_data(line)
+    def _section_lines(self, section: str) -> List[str]:
+        bounds = self._sections.get(section)
+        if bounds is None:
+            return []
+        lines = self._data[bounds[0]:bounds[1]].decode(errors="replace").splitlines()
+        return [line.strip() for line in lines if line.strip()]
+
+    def _load_player(self) -> None:
+        self._loaded.add("player")
+        self.player_pos = None
+        self.player_health = (0, 0)
+        self.player_level = 0
+        self.player_gold = 0
+        self.turn_number = 0
+        for line in self._section_lines("player"):
+            self._parse_player_data(line)
+        self._release_data()
+
+    def _load_inventory(self) -> None:
+        self._loaded.add("inventory")
+        self.inventory = [Item(name=intern_name(line[6:].strip())) for line in self._section_lines("inventory")
+                          if line.startswith("ITEM:")]
+        self._release_data()
+
+    def _load_equipment(self) -> None:
+        self._loaded.add("equipment")
+        self.equipment = [Item(name=intern_name(line[6:].strip())) for line in self._section_lines("equipment")
+                          if line.startswith("ITEM:")]
+        self._release_data()
+
+    def _load_map(self) -> None:
+        # A delta needs the previous snapshot's map, which may not be parsed yet either. Walk back to the
+        # last parsed map or keyframe without recursing, since many unread snapshots can pile up in a turn.
+        chain = [self]
+        while (chain[-1]._map_is_delta and chain[-1]._previous is not None
+               and "map" not in chain[-1]._previous._loaded):
+            chain.append(chain[-1]._previous)
+
+        for state in reversed(chain):
+            state._parse_map()
+
+    def resolve_map(self) -> None:
+        """
+        Parse the map now if it hasn't been. A delta holds on to every unparsed snapshot before it, and
+        their raw dumps, until then. Once parsed, a grid map's bytes are dropped from the dump.
+        """
+        if "map" not in self._loaded:
+            self._load_map()
+
+    def _parse_map(self) -> None:
+        self._loaded.add("map")
+        self.map_size = (70, 80)
+        self.monsters = []
+        self.floor_items = []
+        self.map_sequence = None
+        self._allocate_planes()
+
+        if self._data is not None:
+            if self._map_is_grid:
+                self._parse_map_grid(self._data, self._sections["map"][0], self._previous)
+            else:
+                for line in self._section_lines("map"):
+                    self._parse_map_data(line)
+                self.map_sequence = self.sequence
+        self._previous = None
+        self._index_entities()
+        self._release_data()
+
+    def _release_data(self) -> None:
+        """Drop as much of the raw dump as has been parsed, so a kept snapshot only costs its parsed form."""
+        if self._data is None:
+            return
+        if self._loaded.issuperset(self._sections):
+            self._data = None
+            self._sections = {}
+        elif self._map_is_grid and "map" in self._loaded and "map" in self._sections:
+            # The binary map is the bulk of the dump, and always comes last
+            self._data = self._data[:self._sections.pop("map")[0]]
+
+    def _allocate_planes(self) -> None:
+        n_cells = self.map_size[0] * self.map_size[1]
+        self.feature_plane = bytearray(n_cells)
+        self.flag_plane = bytearray(n_cells)
+        self.monster_plane = array("H", bytes(2 * n_cells))
+        self.item_plane = array("H", bytes(2 * n_cells))
+
+    def _index_entities(self) -> None:
+        """Fill the monster and item planes from the monster and floor item lists."""
+        height, width = self.map_size
+        self.monster_plane = array("H", bytes(2 * height * width))
+        self.item_plane = array("H", bytes(2 * height * width))
+        for plane, entities in ((self.monster_plane, self.monsters), (self.item_plane, self.floor_items)):
+            for i, entity in enumerate(entities):
+                x, y = entity.position.x, entity.position.y
+                if 0 <= x < width and 0 <= y < height:
+                    plane[y * width + x] = i + 1
 
     def _parse_player_data(self, line: str) -> None:
         """Parse player-related data lines."""
         if line.startswith("PLAYER_LOCATION:"):
             coords = line.split(": ")[1].split(",")
             x, y = int(coords[0]), int(coords[1])
-            self.player_pos = Position(x, y)
+            self.player_pos = position_at(x, y)
 
         elif line.startswith("PLAYER_HEALTH:"):
             health_data = line.split(": ")[1].split("/")
@@ -132,6 +376,93 @@ class GameState:
         elif line.startswith("TURN_NUMBER:"):
             self.turn_number = int(line.split(": ")[1])
 
+    def _parse_map_grid(self, data: bytes, offset: int, previous: Optional["GameState"]) -> None:
+        """
+        Parse the binary CURRENT_FLOOR_GRID or CURRENT_FLOOR_DELTA section starting at `offset`. See
+        `_output_floor_keyframe` and `_output_floor_delta` in output-llm.cc for the layout.
+        """
+        def read_line() -> str:
+            nonlocal offset
+            end = data.index(b"\n", offset)
+            line = data[offset:end].decode(errors="replace")
+            offset = end + 1
+            return line
+
+        def read_count() -> int:
+            return int(read_line().split(": ")[1])
+
+        section, header = read_line().split(": ")
+        header_values = [int(v) for v in header.split()]
+        width, height = header_values[0], header_values[1]
+        self.map_size = (height, width)
+        n_cells = width * height
+
+        # Translation table from the dump's feature ids to our interned ones
+        feature_table = bytearray(256)
+        for i in range(read_count()):
+            feature_table[i + 1] = intern_feature(read_line())
+
+        if section == "CURRENT_FLOOR_GRID":
+            for _ in range(read_count()):
+                self._parse_map_data(read_line())
+            for _ in range(read_count()):
+                self._parse_map_data(read_line())
+
+            # The monster and item index planes follow, but they're rebuilt from the lists above
+            read_count()
+            planes = memoryview(data)[offset:offset + 2 * n_cells]
+            self.feature_plane = bytearray(planes[:n_cells]).translate(feature_table)
+            self.flag_plane = _or_planes(planes[n_cells:], self.feature_plane.translate(_SEEN_TABLE))
+            self.map_sequence = self.sequence
+            return
+
+        # A delta only makes sense on top of the exact snapshot it was computed against
+        base_sequence = header_values[2]
+        if previous is None or previous.map_sequence != base_sequence:
+            logger.warning(f"Got a map delta against snapshot {base_sequence} we don't have. "
+                           f"Keeping the last known map until the next keyframe.")
+            if previous is not None:
+                self.feature_plane = previous.feature_plane
+                self.flag_plane = previous.flag_plane
+                self.monsters = previous.monsters
+                self.floor_items = previous.floor_items
+            return
+
+        def read_removed_positions() -> List[Position]:
+            positions = []
+            for _ in range(read_count()):
+                coords = read_line().split(": ")[1].split(",")
+                positions.append(position_at(int(coords[0]), int(coords[1])))
+            return positions
+
+        # Changed monsters and items are parsed into our lists, then merged over the previous ones
+        for _ in range(read_count()):
+            self._parse_map_data(read_line())
+        monsters_removed = read_removed_positions()
+        for _ in range(read_count()):
+            self._parse_map_data(read_line())
+        items_removed = read_removed_positions()
+
+        monsters = {m.position: m for m in previous.monsters}
+        for position in monsters_removed:
+            monsters.pop(position, None)
+        monsters.update((m.position, m) for m in self.monsters)
+        self.monsters = sorted(monsters.values(), key=lambda m: (m.position.y, m.position.x))
+
+        floor_items = {i.position: i for i in previous.floor_items}
+        for position in items_removed:
+            floor_items.pop(position, None)
+        floor_items.update((i.position, i) for i in self.floor_items)
+        self.floor_items = sorted(floor_items.values(), key=lambda i: (i.position.y, i.position.x))
+
+        n_changed = read_count()
+        self.feature_plane = bytearray(previous.feature_plane)
+        self.flag_plane = bytearray(previous.flag_plane)
+        for index, feature_id, flags in struct.iter_unpack("=HBB", data[offset:offset + 4 * n_changed]):
+            self.feature_plane[index] = feature_table[feature_id]
+            self.flag_plane[index] = flags | _SEEN_TABLE[feature_id]
+        self.map_sequence = self.sequence
+
     def _parse_map_data(self, line: str) -> None:
         """Parse map-related data lines."""
         if line.startswith("CELL:"):
@@ -152,7 +483,13 @@ class GameState:
             feature = feature_info.replace("[PATH]", "").replace("[KNOWN]", "").strip()
 
             # Store in map
-            self.map[Position(x, y)] = Cell(feature=feature, traversable=traversable, known=known)
+            height, width = self.map_size
+            if 0 <= x < width and 0 <= y < height:
+                index = y * width + x
+                self.feature_plane[index] = intern_feature(feature)
+                self.flag_plane[index] = (CELL_FLAG_SEEN
+                                          | (GRID_FLAG_PATH if traversable else 0)
+                                          | (GRID_FLAG_KNOWN if known else 0))
 
         elif line.startswith("MONSTER:"):
             # Format: MONSTER: x,y: monster_name
@@ -165,7 +502,7 @@ class GameState:
             x, y = int(coords[0]), int(coords[1])
 
             # Add monster
-            self.monsters.append(Monster(name=monster_name, position=Position(x, y)))
+            self.monsters.append(Monster(name=intern_name(monster_name), position=position_at(x, y)))
 
         elif line.startswith("ITEM:") and "," in line:  # Items on the floor have coordinates
             # Format: ITEM: x,y: item_name
@@ -178,11 +515,30 @@ class GameState:
             x, y = int(coords[0]), int(coords[1])
 
             # Add item
-            self.floor_items.append(Item(name=item_name, position=Position(x, y)))
+            self.floor_items.append(Item(name=intern_name(item_name), position=position_at(x, y)))
 
     def get_cell(self, position: Position) -> Optional[Cell]:
         """Get the cell at the specified coordinates."""
-        return self.map.get(position)
+        height, width = self.map_size
+        if not (0 <= position.x < width and 0 <= position.y < height):
+            return None
+        index = position.y * width + position.x
+        return self._make_cell(self.feature_plane[index], self.flag_plane[index])
+
+    @staticmethod
+    def _make_cell(feature_id: int, flags: int) -> Optional[Cell]:
+        if feature_id == 0:
+            return None
+        # Cells are immutable, so there's one shared instance per feature and flag combination
+        key = (feature_id, flags & (GRID_FLAG_PATH | GRID_FLAG_KNOWN))
+        cell = _CELLS.get(key)
+        if cell is None:
+            cell = _CELLS[key] = Cell(
+                feature=FEATURE_NAMES[feature_id],
+                traversable=bool(flags & GRID_FLAG_PATH),
+                known=bool(flags & GRID_FLAG_KNOWN),
+            )
+        return cell
 
     def get_visible_area(self, view_radius: int = 8, require_knowledge: bool = True) -> List[List[Optional[Cell]]]:
         """Return a subset of the map that's visible to the player within the given radius."""
@@ -199,49 +555,78 @@ class GameState:
 
         # Create a 2D list for the visible area
         height = max_y - min_y + 1
-        width = max_x - min_x + 1
-        visible_area: List[List[Optional[Cell]]] = [[None for _ in range(width)] for _ in range(height)]
+        visible_area: List[List[Optional[Cell]]] = [[] for _ in range(height)]
 
-        # Fill the visible area with cells from the map
+        # Fill the visible area with cells from the map, a row slice at a time
+        map_width = self.map_size[1]
+        required_flags = CELL_FLAG_SEEN | (GRID_FLAG_KNOWN if require_knowledge else 0)
         for y in range(min_y, max_y + 1):
-            for x in range(min_x, max_x + 1):
-                cell = self.get_cell(Position(x, y))
-                if cell and ((not require_knowledge) or cell.known):
-                    visible_area[y - min_y][x - min_x] = cell
+            start = y * map_width
+            features = self.feature_plane[start + min_x:start + max_x + 1]
+            flags = self.flag_plane[start + min_x:start + max_x + 1]
+            visible_area[y - min_y] = [
+                self._make_cell(f, fl) if fl & required_flags == required_flags else None
+                for f, fl in zip(features, flags)
+            ]
 
         return visible_area
 
-    def get_nearby_monsters(self, radius: int = 10) -> List[Tuple[Monster, float]]:
-        """Return monsters near the player within the given radius."""
+    @property
+    def monster_index(self) -> SpatialIndex[Monster]:
+        if self._monster_index is None:
+            self._monster_index = SpatialIndex(self.monsters)
+        return self._monster_index
+
+    @property
+    def item_index(self) -> SpatialIndex[Item]:
+        if self._item_index is None:
+            self._item_index = SpatialIndex(self.floor_items)
+        return self._item_index
+
+    def _cached_query(self, key: Tuple, query: Callable[[], List]) -> List:
+        if key not in self._query_cache:
+            self._query_cache[key] = query()
+        return self._query_cache[key]
+
+    def get_nearby_monsters(self, radius: int = 10,
+                            metric: DistanceMetric = "euclidean") -> List[Tuple[Monster, float]]:
+        """Return monsters near the player within the given radius, nearest first."""
         if not self.player_pos:
             return []
-
-        px, py = self.player_pos.x, self.player_pos.y
-        nearby: List[Tuple[Monster, float]] = []
-
-        for monster in self.monsters:
-            mx, my = monster.position.x, monster.position.y
-            distance = ((px - mx) ** 2 + (py - my) ** 2) ** 0.5
-            if distance <= radius:
-                nearby.append((monster, distance))
-
-        return sorted(nearby, key=lambda x: x[1])  # Sort by distance
-
-    def get_nearby_items(self, radius: int = 10) -> List[Tuple[Item, float]]:
-        """Return items near the player within the given radius."""
+        return self._cached_query(
+            ("nearby_monsters", radius, metric),
+            lambda: self.monster_index.within(self.player_pos.x, self.player_pos.y, radius, metric),
+        )
+
+    def get_nearby_items(self, radius: int = 10,
+                         metric: DistanceMetric = "euclidean") -> List[Tuple[Item, float]]:
+        """Return items near the player within the given radius, nearest first."""
         if not self.player_pos:
             return []
-
-        px, py = self.player_pos.x, self.player_pos.y
-        nearby: List[Tuple[Item, float]] = []
-
-        for item in self.floor_items:
-            ix, iy = item.position.x, item.position.y
-            distance = ((px - ix) ** 2 + (py - iy) ** 2) ** 0.5
-            if distance <= radius:
-                nearby.append((item, distance))
-
-        return sorted(nearby, key=lambda x: x[1])  # Sort by distance
+        return self._cached_query(
+            ("nearby_items", radius, metric),
+            lambda: self.item_index.within(self.player_pos.x, self.player_pos.y, radius, metric),
+        )
+
+    def get_nearest_monsters(self, k: int = 1,
+                             metric: DistanceMetric = "chebyshev") -> List[Tuple[Monster, float]]:
+        """Return the `k` monsters nearest to the player. Chebyshev distance is the number of moves away."""
+        if not self.player_pos:
+            return []
+        return self._cached_query(
+            ("nearest_monsters", k, metric),
+            lambda: self.monster_index.nearest(self.player_pos.x, self.player_pos.y, k, metric),
+        )
+
+    def get_nearest_items(self, k: int = 1,
+                          metric: DistanceMetric = "chebyshev") -> List[Tuple[Item, float]]:
+        """Return the `k` floor items nearest to the player. Chebyshev distance is the number of moves away."""
+        if not self.player_pos:
+            return []
+        return self._cached_query(
+            ("nearest_items", k, metric),
+            lambda: self.item_index.nearest(self.player_pos.x, self.player_pos.y, k, metric),
+        )
 
     def get_player_summary(self) -> Dict[str, Any]:
         """Return a summary of player information."""
@@ -260,39 +645,54 @@ class GameState:
 
     def get_map_bounds(self) -> Optional[Tuple[int, int, int, int]]:
         """Return the bounds of the explored map."""
-        if not self.map:
-            return None
-
-        x_coords = [pos.x for pos in self.map.keys()]
-        y_coords = [pos.y for pos in self.map.keys()]
+        height, width = self.map_size
+        min_x, min_y, max_x, max_y = width, height, -1, -1
 
-        min_x, max_x = min(x_coords), max(x_coords)
-        min_y, max_y = min(y_coords), max(y_coords)
+        for y in range(height):
+            row = self.feature_plane[y * width:(y + 1) * width]
+            if row.count(0) == width:
+                continue
+            min_y = min(min_y, y)
+            max_y = y
+            min_x = min(min_x, width - len(row.lstrip(b"\0")))
+            max_x = max(max_x, len(row.rstrip(b"\0")) - 1)
 
+        if max_y < 0:
+            return None
         return (min_x, min_y, max_x, max_y)
 
     def get_map_section(self, min_pos: Position, max_pos: Position,
                         require_knowledge: bool = True) -> str:
         """Get a section of the map as a string representation."""
-        ret = ""
+        height, width = self.map_size
+        section_width = max_pos.x - min_pos.x + 1
+
+        # Render every cell in one pass, then cut out the rows we want
+        rendered = self.flag_plane.translate(_RENDER_TABLES[require_knowledge])
+        lo_x = max(min_pos.x, 0)
+        hi_x = min(max_pos.x, width - 1)
+
+        rows = []
         for y in range(min_pos.y, max_pos.y + 1):
-            row = []
-            for x in range(min_pos.x, max_pos.x + 1):
-                cell = self.get_cell(Position(x, y))
-                if cell and ((not require_knowledge) or cell.known):
-                    char = "." if cell.traversable else "#"
-                    if self.player_pos and x == self.player_pos.x and y == self.player_pos.y:
-                        char = "@"
-                    row.append(char)
-                else:
-                    row.append(" ")  # Unknown space
-            ret += "".join(row) + "\n"
-        return ret
+            if not (0 <= y < height) or lo_x > hi_x:
+                rows.append(" " * section_width)  # Unknown space
+                continue
+
+            row = rendered[y * width + lo_x:y * width + hi_x + 1].decode()
+            row = " " * (lo_x - min_pos.x) + row + " " * (max_pos.x - hi_x)
+            if self.player_pos and y == self.player_pos.y and min_pos.x <= self.player_pos.x <= max_pos.x:
+                px = self.player_pos.x - min_pos.x
+                if row[px] != " ":
+                    row = row[:px] + "@" + row[px + 1:]
+            rows.append(row)
+        return "".join(row + "\n" for row in rows)
 
     def get_map(self, require_knowledge: bool = True) -> str:
         """Get the complete map as a string representation."""
         map_bounds = self.get_map_bounds()
-        return self.get_map_section(Position(map_bounds[0], map_bounds[1]), Position(map_bounds[2], map_bounds[3]),
+        if map_bounds is None:
+            return ""
+        return self.get_map_section(position_at(map_bounds[0], map_bounds[1]), position_at(map_bounds[2], map_bounds[3]),
                                     require_knowledge=require_knowledge)
 
     def get_summary_without_map(self) -> str:
@@ -318,66 +718,17 @@ class GameState:
         ret = "\n".join([f" - {m.name} at {m.position} ({math.ceil(dist)} tiles away)" for m, dist in nearby])
         return trim_indent(f"{len(nearby)} Enemies nearby:\n{ret}")
 
-    def get_delta_summary(self, previous: "GameState") -> str:
-        """Write a brief summary of the differences between two game states, ignoring the map."""
-        differences = []
+    def get_delta(self, previous: "GameState") -> "GameStateDelta":
+        """Get the structured differences from `previous`. Cached, since it's asked for repeatedly each turn."""
+        from dcssllm.agent.v1.game_state_delta import compute_delta
 
-        if self.turn_number != previous.turn_number:
-            differences.append(f"Turn: {previous.turn_number} -> {self.turn_number}")
-        if self.player_pos != previous.player_pos:
-            differences.append(f"Player Position: {previous.player_pos} -> {self.player_pos}")
+        if self._delta_cache is None or self._delta_cache[0]() is not previous:
+            self._delta_cache = (weakref.ref(previous), compute_delta(previous, self))
+        return self._delta_cache[1]
 
-        hp_current, hp_max = self.player_health
-        prev_hp_current, prev_hp_max = previous.player_health
-        if hp_current != prev_hp_current or hp_max != prev_hp_max:
-            differences.append(f"Player Health: {prev_hp_current}/{prev_hp_max} -> {hp_current}/{hp_max}")
-
-        if self.player_level != previous.player_level:
-            differences.append(f"Player Level: {previous.player_level} -> {self.player_level}")
-
-        if self.player_gold != previous.player_gold:
-            differences.append(f"Player Gold: {previous.player_gold} -> {self.player_gold}")
-
-        if len(self.inventory) != len(previous.inventory):
-            differences.append(f"Inventory: {len(previous.inventory)} items -> {len(self.inventory)} items")
-            for item in self.inventory:
-                if item not in previous.inventory:
-                    differences.append(f"    Added {item.name}")
-            for item in previous.inventory:
-                if item not in self.inventory:
-                    differences.append(f"    Removed {item.name}")
-
-        if len(self.equipment) != len(previous.equipment):
-            differences.append(f"Equipment: {len(previous.equipment)} items -> {len(self.equipment)} items")
-            for item in self.equipment:
-                if item not in previous.equipment:
-                    differences.append(f"    Added {item.name}")
-            for item in previous.equipment:
-                if item not in self.equipment:
-                    differences.append(f"    Removed {item.name}")
-
-        if len(self.monsters) != len(previous.monsters):
-            differences.append(f"Monsters: {len(previous.monsters)} -> {len(self.monsters)}")
-            for monster in self.monsters:
-                if monster not in previous.monsters:
-                    differences.append(f"    Added {monster.name} at {monster.position}")
-            for monster in previous.monsters:
-                if monster not in self.monsters:
-                    differences.append(f"    Removed {monster.name} at {monster.position}")
-
-        if len(self.floor_items) != len(previous.floor_items):
-            differences.append(f"Items on Floor: {len(previous.floor_items)} -> {len(self.floor_items)}")
-            for item in self.floor_items:
-                if item not in previous.floor_items:
-                    differences.append(f"    Added {item.name} at {item.position}")
-            for item in previous.floor_items:
-                if item not in self.floor_items:
-                    differences.append(f"    Removed {item.name} at {item.position}")
-
-        if len(differences) == 0:
-            return "No changes."
-
-        return "\n".join(differences)
+    def get_delta_summary(self, previous: "GameState") -> str:
+        """Write a brief summary of the differences between two game states."""
+        return str(self.get_delta(previous))
 
     def __str__(self) -> str:
         """Return a string representation of the game state."""
@@ -392,7 +743,7 @@ class GameState:
 
         summary.append(f"Inventory: {len(self.inventory)} items")
         summary.append(f"Equipment: {len(self.equipment)} items")
-        summary.append(f"Map cells discovered: {len(self.map)}")
+        summary.append(f"Map cells discovered: {len(self.feature_plane) - self.feature_plane.count(0)}")
         summary.append(f"Monsters visible: {len(self.get_nearby_monsters())}")
         summary.append(f"Items nearby: {len(self.get_nearby_items())}")
 
@@ -0,0 +1,222 @@
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field
+from logging import getLogger
+from typing import Any, Dict, List, Tuple, TYPE_CHECKING
+
+from dcssllm.agent.v1.game_state import FEATURE_NAMES, GRID_FLAG_KNOWN, Monster, Position, position_at
+
+if TYPE_CHECKING:
+    from dcssllm.agent.v1.game_state import GameState
+
+
+logger = getLogger(__name__)
+
+# Limit on how many individual map changes are listed; the rest are only counted
+MAX_LISTED_FEATURE_CHANGES = 10
+
+# Translation table from a flag byte to 1 if the cell is known, for counting with bytes.count
+_KNOWN_TABLE = bytes(1 if flags & GRID_FLAG_KNOWN else 0 for flags in range(256))
+
+
+@dataclass
+class ValueChange:
+    label: str
+    before: Any
+    after: Any
+
+
+@dataclass
+class MonsterMove:
+    monster: Monster
+    before: Position
+
+
+@dataclass
+class FeatureChange:
+    position: Position
+    before: str
+    after: str
+
+
+@dataclass
+class GameStateDelta:
+    """What changed between two game state snapshots. Render with `str()`."""
+    values: List[ValueChange] = field(default_factory=list)
+
+    inventory_count: Tuple[int, int] = (0, 0)
+    inventory_added: List[str] = field(default_factory=list)
+    inventory_removed: List[str] = field(default_factory=list)
+
+    equipment_count: Tuple[int, int] = (0, 0)
+    equipment_added: List[str] = field(default_factory=list)
+    equipment_removed: List[str] = field(default_factory=list)
+
+    monster_count: Tuple[int, int] = (0, 0)
+    monsters_added: List[Monster] = field(default_factory=list)
+    monsters_removed: List[Monster] = field(default_factory=list)
+    monsters_moved: List[MonsterMove] = field(default_factory=list)
+
+    floor_item_count: Tuple[int, int] = (0, 0)
+    floor_items_added: List[Tuple[str, Position]] = field(default_factory=list)
+    floor_items_removed: List[Tuple[str, Position]] = field(default_factory=list)
+
+    cells_newly_known: int = 0
+    feature_changes: List[FeatureChange] = field(default_factory=list)
+    n_feature_changes: int = 0
+
+    def is_empty(self) -> bool:
+        return not (
+            self.values
+            or self.inventory_added or self.inventory_removed
+            or self.equipment_added or self.equipment_removed
+            or self.monsters_added or self.monsters_removed or self.monsters_moved
+            or self.floor_items_added or self.floor_items_removed
+            or self.cells_newly_known or self.n_feature_changes
+        )
+
+    def __str__(self) -> str:
+        if self.is_empty():
+            return "No changes."
+
+        lines = [f"{v.label}: {v.before} -> {v.after}" for v in self.values]
+
+        if self.inventory_added or self.inventory_removed:
+            lines.append(f"Inventory: {self.inventory_count[0]} items -> {self.inventory_count[1]} items")
+            lines.extend(f"    Added {name}" for name in self.inventory_added)
+            lines.extend(f"    Removed {name}" for name in self.inventory_removed)
+
+        if self.equipment_added or self.equipment_removed:
+            lines.append(f"Equipment: {self.equipment_count[0]} items -> {self.equipment_count[1]} items")
+            lines.extend(f"    Added {name}" for name in self.equipment_added)
+            lines.extend(f"    Removed {name}" for name in self.equipment_removed)
+
+        if self.monsters_added or self.monsters_removed or self.monsters_moved:
+            lines.append(f"Monsters: {self.monster_count[0]} -> {self.monster_count[1]}")
+            lines.extend(f"    Added {m.name} at {m.position}" for m in self.monsters_added)
+            lines.extend(f"    Removed {m.name} at {m.position}" for m in self.monsters_removed)
+            lines.extend(f"    Moved {m.monster.name} from {m.before} to {m.monster.position}"
+                         for m in self.monsters_moved)
+
+        if self.floor_items_added or self.floor_items_removed:
+            lines.append(f"Items on Floor: {self.floor_item_count[0]} -> {self.floor_item_count[1]}")
+            lines.extend(f"    Added {name} at {position}" for name, position in self.floor_items_added)
+            lines.extend(f"    Removed {name} at {position}" for name, position in self.floor_items_removed)
+
+        if self.cells_newly_known or self.n_feature_changes:
+            lines.append(f"Map: {self.cells_newly_known} newly explored cells, "
+                         f"{self.n_feature_changes} changed cells")
+            lines.extend(f"    {c.position}: {c.before} -> {c.after}" for c in self.feature_changes)
+            if self.n_feature_changes > len(self.feature_changes):
+                lines.append(f"    ... and {self.n_feature_changes - len(self.feature_changes)} more")
+
+        return "\n".join(lines)
+
+
+def _multiset_diff(before: List[str], after: List[str]) -> Tuple[List[str], List[str]]:
+    """(added, removed) between two lists, counting duplicates."""
+    before_counts = Counter(before)
+    after_counts = Counter(after)
+    return list((after_counts - before_counts).elements()), list((before_counts - after_counts).elements())
+
+
+def _chebyshev(a: Position, b: Position) -> int:
+    return max(abs(a.x - b.x), abs(a.y - b.y))
+
+
+def _match_monsters(before: List[Monster], after: List[Monster], delta: GameStateDelta) -> None:
+    """
+    Match monsters of the same name across snapshots, pairing the closest ones first. Matched
+    monsters that changed position are reported as moves rather than a removal plus an addition.
+    """
+    before_by_name: Dict[str, List[Monster]] = defaultdict(list)
+    after_by_name: Dict[str, List[Monster]] = defaultdict(list)
+    for monster in before:
+        before_by_name[monster.name].append(monster)
+    for monster in after:
+        after_by_name[monster.name].append(monster)
+
+    matched_before = set()
+    matched_after = set()
+    for name, current in after_by_name.items():
+        previous = before_by_name.get(name)
+        if not previous:
+            continue
+
+        pairs = sorted(
+            (_chebyshev(p.position, c.position), i, j)
+            for i, p in enumerate(previous)
+            for j, c in enumerate(current)
+        )
+        used_previous = set()
+        used_current = set()
+        for _, i, j in pairs:
+            if i in used_previous or j in used_current:
+                continue
+            used_previous.add(i)
+            used_current.add(j)
+            matched_before.add(id(previous[i]))
+            matched_after.add(id(current[j]))
+            if previous[i].position != current[j].position:
+                delta.monsters_moved.append(MonsterMove(monster=current[j], before=previous[i].position))
+
+    delta.monsters_added = [m for m in after if id(m) not in matched_after]
+    delta.monsters_removed = [m for m in before if id(m) not in matched_before]
+
+
+def _diff_map(previous: "GameState", current: "GameState", delta: GameStateDelta) -> None:
+    if previous.map_size != current.map_size:
+        return
+
+    delta.cells_newly_known = max(0, current.flag_plane.translate(_KNOWN_TABLE).count(1)
+                                     - previous.flag_plane.translate(_KNOWN_TABLE).count(1))
+
+    # Features that changed on cells we'd already seen (doors opening, walls dug through, ...)
+    if current.feature_plane == previous.feature_plane:
+        return
+    width = current.map_size[1]
+    for i, (before, after) in enumerate(zip(previous.feature_plane, current.feature_plane)):
+        if before == after or before == 0:
+            continue
+        delta.n_feature_changes += 1
+        if len(delta.feature_changes) < MAX_LISTED_FEATURE_CHANGES:
+            delta.feature_changes.append(FeatureChange(
+                position=position_at(i % width, i // width),
+                before=FEATURE_NAMES[before],
+                after=FEATURE_NAMES[after] if after else "unknown",
+            ))
+
+
+def compute_delta(previous: "GameState", current: "GameState") -> GameStateDelta:
+    """Diff two game state snapshots in time linear in their size."""
+    delta = GameStateDelta()
+
+    for label, before, after in (
+        ("Turn", previous.turn_number, current.turn_number),
+        ("Player Position", previous.player_pos, current.player_pos),
+        ("Player Health", "{}/{}".format(*previous.player_health), "{}/{}".format(*current.player_health)),
+        ("Player Level", previous.player_level, current.player_level),
+        ("Player Gold", previous.player_gold, current.player_gold),
+    ):
+        if before != after:
+            delta.values.append(ValueChange(label, before, after))
+
+    delta.inventory_count = (len(previous.inventory), len(current.inventory))
+    delta.inventory_added, delta.inventory_removed = _multiset_diff(
+        [i.name for i in previous.inventory], [i.name for i in current.inventory])
+
+    delta.equipment_count = (len(previous.equipment), len(current.equipment))
+    delta.equipment_added, delta.equipment_removed = _multiset_diff(
+        [i.name for i in previous.equipment], [i.name for i in current.equipment])
+
+    delta.monster_count = (len(previous.monsters), len(current.monsters))
+    _match_monsters(previous.monsters, current.monsters, delta)
+
+    # Floor items don't move, so they're keyed by name and position
+    delta.floor_item_count = (len(previous.floor_items), len(current.floor_items))
+    before_items = Counter((i.name, i.position) for i in previous.floor_items)
+    after_items = Counter((i.name, i.position) for i in current.floor_items)
+    delta.floor_items_added = list((after_items - before_items).elements())
+    delta.floor_items_removed = list((before_items - after_items).elements())
+
+    _diff_map(previous, current, delta)
+    return delta
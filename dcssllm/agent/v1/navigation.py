@@ -0,0 +1,210 @@
+from array import array
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from dcssllm.agent.v1.game_state import (
+    CELL_FLAG_SEEN, FEATURE_NAMES, GRID_FLAG_KNOWN, GRID_FLAG_PATH, GameState, Position, position_at,
+)
+
+# DCSS movement is 8-directional, and every step costs one move, so plain BFS gives shortest paths.
+# Keys are named the same way as in ToolSendKeyPress.
+DIRECTION_KEYS = {
+    (-1, 0): "LEFT",
+    (1, 0): "RIGHT",
+    (0, -1): "UP",
+    (0, 1): "DOWN",
+    (-1, -1): "y",
+    (1, -1): "u",
+    (-1, 1): "b",
+    (1, 1): "n",
+}
+DIRECTIONS = list(DIRECTION_KEYS.keys())
+
+
+def _bit_table(required: int) -> bytes:
+    """Translation table from a flag byte to the digit "1" if all of the `required` flags are set, else "0"."""
+    return bytes(ord("1") if flags & required == required else ord("0") for flags in range(256))
+
+
+# Cells the player knows can be walked on, and cells the player knows anything about
+_WALKABLE_BITS = _bit_table(CELL_FLAG_SEEN | GRID_FLAG_KNOWN | GRID_FLAG_PATH)
+_KNOWN_BITS = _bit_table(CELL_FLAG_SEEN | GRID_FLAG_KNOWN)
+
+
+def _plane_bits(plane: bytes, table: bytes) -> int:
+    """A flag plane as a bitset, with bit `index` set for each cell whose flags match `table`."""
+    # Translated, the plane is a string of digits with cell 0 first, so read it backwards in base 2
+    return int(plane.translate(table)[::-1] or b"0", 2)
+
+
+def _cells(bits: int) -> Iterator[int]:
+    """The index of every cell set in `bits`, in order."""
+    digits = format(bits, "b")[::-1]
+    index = digits.find("1")
+    while index >= 0:
+        yield index
+        index = digits.find("1", index + 1)
+
+UNREACHABLE = -1
+
+
+def _is_downstairs(name: str) -> bool:
+    return ("stair" in name and "down" in name) or "hatch in the floor" in name
+
+
+def _is_upstairs(name: str) -> bool:
+    return ("stair" in name and "up" in name) or "hatch in the ceiling" in name
+
+
+class NavigationGrid:
+    """
+    Shortest paths over the cells the player knows are walkable, from the player's position.
+
+    Monsters block movement, but a monster's own cell is reachable: stepping into it is an attack.
+    Built once per GameState snapshot; all queries reuse the same distance map.
+
+    Sets of cells are bitsets, with bit `y * width + x` for each cell, so the search and the frontier
+    scan work on a whole map's worth of cells per operation rather than one cell at a time.
+    """
+    def __init__(self, state: GameState):
+        self.state = state
+        self.height, self.width = state.map_size
+        n_cells = self.width * self.height
+        self._all = (1 << n_cells) - 1
+        self.walkable = _plane_bits(state.flag_plane, _WALKABLE_BITS)
+        self.known = _plane_bits(state.flag_plane, _KNOWN_BITS)
+        self.monsters = 0
+        for monster in state.monsters:
+            if self._in_bounds(monster.position.x, monster.position.y):
+                self.monsters |= 1 << self._index(monster.position)
+
+        # Cells that have a neighbour to their left, and to their right, so moves don't wrap around rows
+        first_column = sum(1 << (y * self.width) for y in range(self.height))
+        self._has_left = self._all & ~first_column
+        self._has_right = self._all & ~(first_column << (self.width - 1))
+
+        self.start: Optional[int] = None
+        self.reached = 0
+        self.distances = array("i", [UNREACHABLE]) * n_cells
+        if state.player_pos and self._in_bounds(state.player_pos.x, state.player_pos.y):
+            self.start = self._index(state.player_pos)
+            self._compute_distances()
+
+    def _index(self, position: Position) -> int:
+        return position.y * self.width + position.x
+
+    def _position(self, index: int) -> Position:
+        return position_at(index % self.width, index // self.width)
+
+    def _in_bounds(self, x: int, y: int) -> bool:
+        return 0 <= x < self.width and 0 <= y < self.height
+
+    def _neighbours(self, index: int) -> Iterable[int]:
+        x, y = index % self.width, index // self.width
+        for dx, dy in DIRECTIONS:
+            if self._in_bounds(x + dx, y + dy):
+                yield index + dy * self.width + dx
+
+    def _grow(self, cells: int) -> int:
+        """`cells` and every cell one move away from them."""
+        row = cells | (cells & self._has_right) << 1 | (cells & self._has_left) >> 1
+        return (row | row << self.width | row >> self.width) & self._all
+
+    def _compute_distances(self) -> None:
+        """Breadth-first search from the player over walkable cells, growing the whole frontier each step."""
+        distances = self.distances
+        frontier = reached = 1 << self.start
+        distance = 0
+        while frontier:
+            for index in _cells(frontier):
+                distances[index] = distance
+            # Monsters can be reached (attacked) but not walked through
+            frontier = self._grow(frontier & ~self.monsters) & self.walkable & ~reached
+            reached |= frontier
+            distance += 1
+        self.reached = reached
+
+    def distance_to(self, position: Position) -> int:
+        """Number of moves to reach `position`, or UNREACHABLE."""
+        if not self._in_bounds(position.x, position.y):
+            return UNREACHABLE
+        return self.distances[self._index(position)]
+
+    def path_to(self, position: Position) -> Optional[List[Position]]:
+        """The cells to step through to reach `position`, excluding the start. None if unreachable."""
+        if self.distance_to(position) == UNREACHABLE:
+            return None
+
+        # Walk back down the distance map, never through a monster
+        index = self._index(position)
+        path = [index]
+        while self.distances[index] > 0:
+            index = next(
+                n for n in self._neighbours(index)
+                if self.distances[n] == self.distances[index] - 1
+                and (self.distances[n] == 0 or not self.state.monster_plane[n])
+            )
+            path.append(index)
+        path.pop()  # The start
+        return [self._position(i) for i in reversed(path)]
+
+    def nearest(self, positions: Iterable[Position]) -> Optional[Tuple[Position, int]]:
+        """The reachable position with the shortest path, and its distance."""
+        best = None
+        for position in positions:
+            distance = self.distance_to(position)
+            if distance != UNREACHABLE and distance > 0 and (best is None or distance < best[1]):
+                best = (position, distance)
+        return best
+
+    def frontiers(self) -> List[Position]:
+        """Reachable walkable cells next to cells the player hasn't explored."""
+        unexplored = self._all & ~self.known
+        return [self._position(index) for index in _cells(self.reached & ~self.monsters & self._grow(unexplored))]
+
+    def feature_positions(self, predicate) -> List[Position]:
+        """Positions of every cell whose feature name matches `predicate`."""
+        positions = []
+        for feature_id, name in enumerate(FEATURE_NAMES):
+            if feature_id == 0 or not predicate(name):
+                continue
+            marker = bytes([feature_id])
+            index = self.state.feature_plane.find(marker)
+            while index >= 0:
+                positions.append(self._position(index))
+                index = self.state.feature_plane.find(marker, index + 1)
+        return positions
+
+    def nearest_frontier(self) -> Optional[Tuple[Position, int]]:
+        return self.nearest(self.frontiers())
+
+    def nearest_downstairs(self) -> Optional[Tuple[Position, int]]:
+        return self.nearest(self.feature_positions(_is_downstairs))
+
+    def nearest_upstairs(self) -> Optional[Tuple[Position, int]]:
+        return self.nearest(self.feature_positions(_is_upstairs))
+
+    def nearest_item(self) -> Optional[Tuple[Position, int]]:
+        return self.nearest(item.position for item in self.state.floor_items)
+
+    def nearest_monster(self) -> Optional[Tuple[Position, int]]:
+        return self.nearest(monster.position for monster in self.state.monsters)
+
+    def directions(self, path: List[Position]) -> List[str]:
+        """The key to press for each step of `path`."""
+        keys = []
+        previous = self.state.player_pos
+        for position in path:
+            keys.append(DIRECTION_KEYS[(position.x - previous.x, position.y - previous.y)])
+            previous = position
+        return keys
+
+
+def summarize_keys(keys: List[str]) -> str:
+    """Run-length summary of a key sequence, i.e. `3 x UP, 2 x u`."""
+    runs: List[Tuple[str, int]] = []
+    for key in keys:
+        if runs and runs[-1][0] == key:
+            runs[-1] = (key, runs[-1][1] + 1)
+        else:
+            runs.append((key, 1))
+    return ", ".join(f"{count} x {key}" for key, count in runs)
@@ -0,0 +1,23 @@
+from itertools import zip_longest
+from typing import List
+
+
+def screen_rows(screen: str) -> List[str]:
+    """The screen's rows, without the padding curses leaves at the end of each."""
+    return [row.rstrip() for row in screen.splitlines()]
+
+
+def diff_screen(previous: str, current: str) -> str:
+    """
+    The rows of `current` that differ from `previous`, one per line as "<row>: <new contents>",
+    numbered from 1. The screen is a fixed grid, so rows are compared in place: a line that moved
+    is listed as changed in both rows, which the model reads far more reliably than a unified diff.
+
+    Empty if nothing changed.
+    """
+    changed = []
+    rows = zip_longest(screen_rows(previous), screen_rows(current), fillvalue="")
+    for number, (before, after) in enumerate(rows, start=1):
+        if before != after:
+            changed.append(f"{number}: {after}".rstrip())
+    return "\n".join(changed)
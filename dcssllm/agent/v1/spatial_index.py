@@ -0,0 +1,94 @@
+from collections import defaultdict
+import math
+from typing import Callable, Dict, Generic, Iterable, List, Literal, Optional, Tuple, TypeVar
+
+
+# Entities only need a `position` with integer `x` and `y`, like Monster and Item
+T = TypeVar("T")
+
+# DCSS movement is 8-directional, so Chebyshev distance is the number of moves between two tiles.
+DistanceMetric = Literal["euclidean", "chebyshev"]
+
+DISTANCE_FUNCTIONS: Dict[str, Callable[[int, int], float]] = {
+    "euclidean": lambda dx, dy: math.hypot(dx, dy),
+    "chebyshev": lambda dx, dy: max(abs(dx), abs(dy)),
+}
+
+
+class SpatialIndex(Generic[T]):
+    """
+    Grid-bucketed index of entities by position, for radius and nearest-neighbour queries.
+
+    Results are sorted by distance. Ties keep the order the entities were given in.
+    """
+    def __init__(self, entities: Iterable[T], bucket_size: int = 8):
+        self._bucket_size = bucket_size
+        self._buckets: Dict[Tuple[int, int], List[Tuple[int, T, int, int]]] = defaultdict(list)
+        self._count = 0
+
+        for order, entity in enumerate(entities):
+            x, y = entity.position.x, entity.position.y
+            self._buckets[(x // bucket_size, y // bucket_size)].append((order, entity, x, y))
+            self._count += 1
+
+        # Largest bucket distance from any bucket to any other, to bound ring searches
+        if self._buckets:
+            bxs = [bx for bx, _ in self._buckets]
+            bys = [by for _, by in self._buckets]
+            self._bucket_extent = (min(bxs), min(bys), max(bxs), max(bys))
+
+    def __len__(self) -> int:
+        return self._count
+
+    def within(self, x: int, y: int, radius: float,
+               metric: DistanceMetric = "euclidean") -> List[Tuple[T, float]]:
+        """All entities within `radius` of (x, y), nearest first."""
+        distance = DISTANCE_FUNCTIONS[metric]
+        size = self._bucket_size
+        r = math.floor(radius)
+
+        found = []
+        for bx in range((x - r) // size, (x + r) // size + 1):
+            for by in range((y - r) // size, (y + r) // size + 1):
+                for order, entity, ex, ey in self._buckets.get((bx, by), ()):
+                    d = distance(ex - x, ey - y)
+                    if d <= radius:
+                        found.append((d, order, entity))
+
+        found.sort(key=lambda f: (f[0], f[1]))
+        return [(entity, d) for d, _, entity in found]
+
+    def nearest(self, x: int, y: int, k: int = 1, metric: DistanceMetric = "euclidean",
+                max_radius: Optional[float] = None) -> List[Tuple[T, float]]:
+        """The `k` entities nearest to (x, y), optionally no further than `max_radius`, nearest first."""
+        if self._count == 0 or k <= 0:
+            return []
+
+        distance = DISTANCE_FUNCTIONS[metric]
+        size = self._bucket_size
+        cbx, cby = x // size, y // size
+        min_bx, min_by, max_bx, max_by = self._bucket_extent
+        max_ring = max(abs(cbx - min_bx), abs(cbx - max_bx), abs(cby - min_by), abs(cby - max_by))
+
+        found = []
+        seen = 0
+        for ring in range(max_ring + 1):
+            # Visit the buckets exactly `ring` buckets away from the centre bucket
+            for bx in range(cbx - ring, cbx + ring + 1):
+                for by in range(cby - ring, cby + ring + 1):
+                    if max(abs(bx - cbx), abs(by - cby)) != ring:
+                        continue
+                    for order, entity, ex, ey in self._buckets.get((bx, by), ()):
+                        seen += 1
+                        d = distance(ex - x, ey - y)
+                        if max_radius is None or d <= max_radius:
+                            found.append((d, order, entity))
+
+            # Anything in a further ring is at least `ring * size + 1` tiles away, under either metric
+            found.sort(key=lambda f: (f[0], f[1]))
+            if seen == self._count or (len(found) >= k and found[k - 1][0] < ring * size + 1):
+                break
+            if max_radius is not None and ring * size + 1 > max_radius:
+                break
+
+        return [(entity, d) for d, _, entity in found[:k]]
@@ -1,22 +1,77 @@
+from dataclasses import dataclass
 import logging
-from typing import List, TYPE_CHECKING
+from typing import List, Optional, TYPE_CHECKING
 
 from langchain_core.language_models.chat_models import BaseChatModel
-from langchain_core.messages import SystemMessage, HumanMessage, BaseMessage
-from langgraph.graph import StateGraph, START, END
+from langchain_core.messages import HumanMessage, BaseMessage
+from langgraph.graph import StateGraph, START
 
 from dcssllm.agent.util import *
+from dcssllm.agent.prompt_cache import StablePrefix
+from dcssllm.agent.token_budget import PromptSection, largest_that_fits
 from dcssllm.agent.v1.common_graph import BaseAgentState, attach_tool_nodes, create_chatbot_node
 from dcssllm.agent.v1.general_instructions import *
+from dcssllm.agent.v1.screen_diff import diff_screen
 
 if TYPE_CHECKING:
+    from dcssllm.agent.history_store import HistoryStore
     from dcssllm.agent.v1.agent_main import V1Agent
 
 logger = logging.getLogger(__name__)
 
+# How many previous turns are shown at most. The oldest are dropped HISTORY_STEP at a time rather
+# than one per turn, so the start of the history, and the prompt cache covering it, holds for a while.
+HISTORY_TURNS = 20
+HISTORY_STEP = 10
+
+# A previous turn is shown as the rows of its screen that changed, unless those take more than this
+# many tokens or half the full screen's (say, a menu opened), in which case the full screen is shown
+MAX_DIFF_TOKENS = 400
+
+# Static text, dedented once here rather than on every chatbot call
+TURN_INSTRUCTIONS = trim_indent("""
+    You're in-game now. Look at the information you've been given and form a strategy for
+    how to play the game. You don't know much about the game, so explore and learn from your
+    experiences.
+
+    Take your time. Strategize. Decisions now can have long-term consequences. Think about
+    what you want to do, short and medium term objectives, and long term goals.
+    Save what you have learned in your long-term memory.
+    Don't be in a rush to press a button.
+
+    As you learn more about the game (i.e. how to use tools or perform actions), update your
+    long-term memory to remind yourself of what you've learned. At the start of each turn, you
+    should think "What do I know now that I didn't know before?" and "Is this something worth
+    writing down in my long-term memory?"
+
+    If you have nothing better to do, using autoexplore ('o')is a good idea. Once you have explored
+    the area, proceed to the next floor.
+""")
+FORCE_ACTION = trim_indent("""
+    Alright, you've been thinking for too long.
+    YOU MUST SEND A KEY PRESS NOW.
+""")
+KEEP_THINKING = "Ok, keep thinking. What do you want to do next? You should call at least one tool."
+
+
+@dataclass
+class PreviousTurn:
+    iteration: int
+    screen: str
+    # The turn with its full screen, shown for the oldest turn in the history
+    keyframe: BaseMessage
+    # The turn with only the rows that changed since the turn before it, shown for the rest. None
+    # if that's barely smaller than the keyframe.
+    diff: Optional[BaseMessage]
+    response: Optional[BaseMessage]
+
 
 class AgentState(BaseAgentState):
-    previous_turn_summary: List[BaseMessage]
+    # The previous turns to show, oldest first
+    previous_turns: List[PreviousTurn]
+    turn_instructions: BaseMessage
+    screen_ansi: BaseMessage
+    screen: BaseMessage
 
 
 class SubagentMainGame:
@@ -28,33 +83,53 @@ class SubagentMainGame:
         self.tools = [
             self.master.tool_send_key_press,
             self.master.tool_game_state,
+            self.master.tool_travel,
             self.master.tool_write_long_term_memory,
         ]
-        self._previous_turn_actions = []
+        self._previous_turn_actions: "HistoryStore[PreviousTurn]" = master.create_history_store("main_game_turns")
+        self.prefix = StablePrefix(
+            GENERAL_AGENT_INTRO,
+            GAME_UI_INSTRUCTIONS,
+            CHARACTER_PLAYSTYLE_INSTRUCTIONS,
+            KEY_BINDING_INSTRUCTIONS,
+            cache_marker=master.prompt_cache_markers,
+        )
+        budget = master.prompt_budget
 
         def message_generator(state: AgentState):
             force_action = None
             if state['_chatbot_message_number'] > 10:
-                force_action = HumanMessage(f"""
-                    Alright, you've been thinking for too long.
-                    YOU MUST SEND A KEY PRESS NOW.
-                """),
-
-            messages = prep_message([
-                SystemMessage(GENERAL_AGENT_INTRO),
-                SystemMessage(GAME_UI_INSTRUCTIONS),
-                SystemMessage(CHARACTER_PLAYSTYLE_INSTRUCTIONS),
-                SystemMessage(KEY_BINDING_INSTRUCTIONS),
-                *state["previous_turn_summary"],
-                HumanMessage(f"The current turn is {state['iteration']}."),
-                self.master.long_term_memory.create_message(),
-                *self.master.tool_game_state.create_message(),
-                *state["messages"],
-                force_action,
-            ])
+                force_action = HumanMessage(FORCE_ACTION)
+
+            # Least to most likely to change, so the cached prefix runs as far as it can
+            turns = state["previous_turns"]
+            sections = [
+                PromptSection("memory", [self.master.long_term_memory.create_message()]),
+                PromptSection("history", self._history_messages(turns), shrink=self._shrink_history(turns)),
+                PromptSection("game_state", [
+                    HumanMessage(f"The current turn is {state['iteration']}."),
+                    *self.master.tool_game_state.create_message(),
+                ]),
+                PromptSection("map", self.master.tool_game_state.create_map_message(), shrink=self._shrink_map),
+                PromptSection("travel", self.master.tool_travel.create_message()),
+                PromptSection("instructions", [state["turn_instructions"]]),
+                # The plain screen has everything the formatted one does, so the formatted one goes first
+                PromptSection("screen_ansi", [state["screen_ansi"]], shrink=lambda _: []),
+                PromptSection("screen", [state["screen"]]),
+                PromptSection("messages", [*state["messages"], force_action]),
+            ]
+            messages = self.prefix.build(budget.fit(
+                sections, prefix=[self.prefix.message],
+                iteration=state["iteration"], call=state["_chatbot_message_number"],
+            ))
             return messages, {}
 
-        chatbot = create_chatbot_node(__name__, llm.bind_tools(self.tools), message_generator)
+        def on_response(request: List[BaseMessage], response: BaseMessage):
+            # Calibrate token counts to what the model actually saw
+            if isinstance(response, AIMessage) and response.usage_metadata:
+                budget.counter.calibrate(request, response.usage_metadata["input_tokens"])
+
+        chatbot = create_chatbot_node(__name__, llm.bind_tools(self.tools), message_generator, on_response)
         graph_builder = StateGraph(AgentState)
         graph_builder.add_node("chatbot", chatbot)
 
@@ -64,7 +139,7 @@ class SubagentMainGame:
         def dummy_user_message(_: AgentState):
             return {
                 "messages": [
-                    HumanMessage("Ok, keep thinking. What do you want to do next? You should call at least one tool."),
+                    HumanMessage(KEEP_THINKING),
                 ],
             }
         graph_builder.add_node("dummy_user_message", dummy_user_message)
@@ -75,46 +150,80 @@ class SubagentMainGame:
         self.executor = graph_builder.compile()
 
     async def ai_turn(self):
-        formatted_previous_turn_actions = []
-        for (iteration, screen, message) in self._previous_turn_actions[-20:]:
-            formatted_previous_turn_actions.extend(prep_message([
-                HumanMessage(f"Turn {iteration}:"),
-                HumanMessage(f"The current screen is:\n\n{screen}"),
-            ]))
-            formatted_previous_turn_actions.append(message)
-
         final_state = await self.executor.ainvoke({
-            "messages": prep_message([
-                HumanMessage("""
-                    You're in-game now. Look at the information you've been given and form a strategy for
-                    how to play the game. You don't know much about the game, so explore and learn from your
-                    experiences.
-                             
-                    Take your time. Strategize. Decisions now can have long-term consequences. Think about
-                    what you want to do, short and medium term objectives, and long term goals.
-                    Save what you have learned in your long-term memory.
-                    Don't be in a rush to press a button.
-                             
-                    As you learn more about the game (i.e. how to use tools or perform actions), update your
-                    long-term memory to remind yourself of what you've learned. At the start of each turn, you
-                    should think "What do I know now that I didn't know before?" and "Is this something worth
-                    writing down in my long-term memory?"
-                             
-                    If you have nothing better to do, using autoexplore ('o')is a good idea. Once you have explored
-                    the area, proceed to the next floor.
-                """),
-                HumanMessage(f"The current screen is:\n\n{self.master.latest_screen}"),
-                HumanMessage(f"Without any formatting, the current screen is:\n\n{self.master.latest_text_only_screen}"),
-            ]),
+            "messages": [],
             "iteration": self.master.iterations,
-            "previous_turn_summary": formatted_previous_turn_actions,
+            "previous_turns": self._history_turns(),
+            "turn_instructions": HumanMessage(TURN_INSTRUCTIONS),
+            "screen_ansi": HumanMessage(f"The current screen is:\n\n{self.master.latest_screen}"),
+            "screen": HumanMessage(f"Without any formatting, the current screen is:\n\n{self.master.latest_text_only_screen}"),
         })
 
         last_ai_message = find_last_match(final_state["messages"], lambda m: m.type == "ai")
-        self._previous_turn_actions.append((
-            self.master.iterations,
-            self.master.latest_text_only_screen,
-            last_ai_message,
-        ))
-
-        logger.info(f"SubagentMainGame final_state: { {**final_state, "messages": None, "previous_turn_summary": None} }")
+        self._previous_turn_actions.append(self.master.iterations, self._record_turn(last_ai_message))
+
+        logger.info(f"SubagentMainGame final_state: { {**final_state, "messages": None, "previous_turns": None, "screen_ansi": None, "screen": None} }")
+
+    def _record_turn(self, response: Optional[BaseMessage]) -> PreviousTurn:
+        """
+        This turn as it'll be shown in the history. Its messages are built once here, then reused as is
+        by every later turn that shows it.
+        """
+        iteration = self.master.iterations
+        screen = self.master.latest_text_only_screen
+        keyframe = HumanMessage(f"Turn {iteration}:\n\nThe current screen is:\n\n{screen}")
+        previous = self._previous_turn_actions.last()
+        if previous is None:
+            return PreviousTurn(iteration, screen, keyframe, None, response)
+
+        rows = diff_screen(previous.screen, screen)
+        if not rows:
+            diff = HumanMessage(f"Turn {iteration}:\n\nThe screen was the same as on turn {previous.iteration}.")
+        else:
+            diff = HumanMessage(
+                f"Turn {iteration}:\n\nThe rows of the screen that changed since turn {previous.iteration} "
+                f"(row number: new contents) were:\n\n{rows}"
+            )
+            counter = self.master.prompt_budget.counter
+            if counter.count([diff]) > min(MAX_DIFF_TOKENS, counter.count([keyframe]) // 2):
+                diff = None
+        return PreviousTurn(iteration, screen, keyframe, diff, response)
+
+    def _history_messages(self, turns: List[PreviousTurn], count: Optional[int] = None) -> List[BaseMessage]:
+        """
+        The last `count` of `turns`, or all of them: the first with its full screen and the rest with
+        what changed, each followed by the response to it.
+        """
+        count = len(turns) if count is None else count
+        messages = [_omitted_turns(len(turns) - count)] if count < len(turns) else []
+        for index, turn in enumerate(turns[len(turns) - count:]):
+            screen = turn.keyframe if index == 0 or turn.diff is None else turn.diff
+            messages.extend(notnull([screen, turn.response]))
+        return messages
+
+    def _shrink_history(self, turns: List[PreviousTurn]):
+        """A shrinker that keeps as many of the latest turns as fit, starting again from a full screen."""
+        def shrink(target: int) -> List[BaseMessage]:
+            return largest_that_fits(lambda count: self._history_messages(turns, count), 0, len(turns),
+                                     self.master.prompt_budget.counter, target)
+        return shrink
+
+    def _history_turns(self) -> List[PreviousTurn]:
+        """The previous turns to show, oldest first. The oldest moves HISTORY_STEP turns at a time."""
+        total = len(self._previous_turn_actions)
+        excess = total - HISTORY_TURNS
+        start = 0 if excess <= 0 else -(-excess // HISTORY_STEP) * HISTORY_STEP
+        return self._previous_turn_actions.latest(total - start)
+
+    def _shrink_map(self, target: int) -> List[BaseMessage]:
+        """The map cropped to the largest square around the player that fits in `target` tokens."""
+        tool = self.master.tool_game_state
+        if tool.current_state is None:
+            return []
+        height, width = tool.current_state.map_size
+        return largest_that_fits(tool.create_map_message, 1, max(height, width),
+                                 self.master.prompt_budget.counter, target)
+
+
+def _omitted_turns(count: int) -> BaseMessage:
+    return HumanMessage(f"({count} earlier turns omitted to save space.)")
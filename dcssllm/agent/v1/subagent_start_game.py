@@ -2,10 +2,11 @@ import logging
 import typing
 
 from langchain_core.language_models.chat_models import BaseChatModel
-from langchain_core.messages import SystemMessage, HumanMessage
+from langchain_core.messages import HumanMessage
 from langgraph.graph import StateGraph, START, END
 
 from dcssllm.agent.util import *
+from dcssllm.agent.prompt_cache import StablePrefix
 from dcssllm.agent.v1.common_graph import BaseAgentState, attach_tool_nodes, create_chatbot_node
 from dcssllm.agent.v1.general_instructions import *
 
@@ -14,6 +15,12 @@ if typing.TYPE_CHECKING:
 
 logger = logging.getLogger(__name__)
 
+# Static text, dedented once here rather than on every chatbot call
+MENU_INSTRUCTIONS = trim_indent("""
+    Use the arrow keys to select a menu entry. Use the 'ENTER' key to confirm your selection.
+    If there's a letter next to a menu entry, you can press that letter to select it.
+""")
+
 
 class AgentState(BaseAgentState):
     pass
@@ -28,17 +35,20 @@ class SubagentStartGame:
         self.tools = [
             self.master.tool_send_key_press
         ]
+        self.prefix = StablePrefix(
+            GENERAL_AGENT_INTRO,
+            """
+                Current Objective: Start a new game, or resume an existing one. Prefer to resume an existing game
+                if there is one. Navigate the UI by interpreting the screen and sending the appropriate commands
+                to the game.
+
+                Choose the Minotaur Berserker class. Choose an axe as your starting weapon.
+            """,
+            cache_marker=master.prompt_cache_markers,
+        )
         
         def message_generator(state: AgentState):
-            messages = prep_message([
-                SystemMessage(GENERAL_AGENT_INTRO),
-                SystemMessage("""
-                    Current Objective: Start a new game, or resume an existing one. Prefer to resume an existing game
-                    if there is one. Navigate the UI by interpreting the screen and sending the appropriate commands
-                    to the game.
-
-                    Choose the Minotaur Berserker class. Choose an axe as your starting weapon.
-                """),
+            messages = self.prefix.build([
                 *state["messages"]
             ])
             return messages, {}
@@ -54,10 +64,7 @@ class SubagentStartGame:
     async def ai_turn(self):
         final_state = await self.executor.ainvoke({
             "messages": prep_message([
-                HumanMessage(f"""
-                    Use the arrow keys to select a menu entry. Use the 'ENTER' key to confirm your selection.
-                    If there's a letter next to a menu entry, you can press that letter to select it.
-                """),
+                HumanMessage(MENU_INSTRUCTIONS),
                 HumanMessage(f"The current screen is:\n\n{self.master.latest_screen}"),
             ]),
             "iteration": self.master.iterations,
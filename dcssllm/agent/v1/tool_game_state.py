@@ -1,12 +1,12 @@
 from logging import getLogger
-from typing import Optional, TYPE_CHECKING, List
+from typing import Dict, Optional, TYPE_CHECKING, List, Tuple
 
 from langchain_core.callbacks import CallbackManagerForToolRun
 from langchain_core.tools.base import ArgsSchema
 from langchain_core.messages import HumanMessage
 from pydantic import BaseModel, Field
 
-from dcssllm.agent.v1.game_state import GameState
+from dcssllm.agent.v1.game_state import GameState, position_at
 from dcssllm.agent.v1.tool import StatefulTool
 
 if TYPE_CHECKING:
@@ -30,10 +30,29 @@ class ToolGameState(StatefulTool):
         super().__init__(master)
         self._prev_state: Optional[GameState] = None
         self._current_state: Optional[GameState] = None
+        # `create_message`'s output and the state it was made from, as it's asked for on every chatbot call
+        self._message_cache: Optional[Tuple[GameState, List[HumanMessage]]] = None
+        # `create_map_message`'s output for the current state, by radius
+        self._map_cache: Tuple[Optional[GameState], Dict[Optional[int], List[HumanMessage]]] = (None, {})
+
+    @property
+    def current_state(self) -> Optional[GameState]:
+        return self._current_state
 
     def on_new_turn(self) -> None:
         self._prev_state = self._current_state
-        self._current_state = GameState()
+
+        # Prefer snapshots streamed over the game's side channel. These may be map deltas, so every
+        # frame is applied in order, even if we only keep the last. Its map is resolved straight away,
+        # so the snapshots before it can be freed.
+        game = self._master.game
+        if game.input_signal:
+            for frame in game.pop_game_state_frames():
+                self._current_state = GameState(data=frame, previous=self._current_state)
+            if self._current_state is not None:
+                self._current_state.resolve_map()
+        else:
+            self._current_state = GameState()
 
     def _run(
         self,
@@ -49,11 +68,39 @@ class ToolGameState(StatefulTool):
         return "These things changed in the game state:\n\n" + delta_summary
 
     def create_message(self) -> List[HumanMessage]:
-        if self._current_state:
-            return [
+        """The game state and nearby enemies. The map is in `create_map_message`."""
+        if not self._current_state:
+            return []
+        if self._message_cache is None or self._message_cache[0] is not self._current_state:
+            self._message_cache = (self._current_state, [
                 HumanMessage(f"Here is the current state of the game:\n\n{self._current_state.get_summary_without_map()}"),
-                HumanMessage(f"Here is your memory of the game map:\n\n{self._current_state.get_map()}"),
                 HumanMessage(self._current_state.get_nearby_enemy_summary()),
-            ]
-        else:
+            ])
+        return self._message_cache[1]
+
+    def create_map_message(self, radius: Optional[int] = None) -> List[HumanMessage]:
+        """The explored map, or with `radius`, only the part within that many tiles of the player."""
+        state = self._current_state
+        if not state:
             return []
+        if self._map_cache[0] is not state:
+            self._map_cache = (state, {})
+        cache = self._map_cache[1]
+
+        if radius not in cache:
+            bounds = state.get_map_bounds()
+            if bounds is None:
+                cache[radius] = []
+            elif radius is None or state.player_pos is None:
+                cache[radius] = [HumanMessage(f"Here is your memory of the game map:\n\n{state.get_map()}")]
+            else:
+                min_x, min_y, max_x, max_y = bounds
+                player = state.player_pos
+                section = state.get_map_section(
+                    position_at(max(min_x, player.x - radius), max(min_y, player.y - radius)),
+                    position_at(min(max_x, player.x + radius), min(max_y, player.y + radius)),
+                )
+                cache[radius] = [HumanMessage(
+                    f"Here is your memory of the game map within {radius} tiles of you:\n\n{section}"
+                )]
+        return cache[radius]
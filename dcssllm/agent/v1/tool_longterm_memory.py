@@ -20,12 +20,29 @@ logger = getLogger(__name__)
 class LongTermMemory:
     data: Dict[str, str] = {}
 
+    # `create_message`'s output, until the memories change
+    _message: Optional[HumanMessage] = None
+
+    def write(self, key: str, value: str) -> None:
+        self.data[key] = value
+        self._message = None
+
+    def clear(self, key: str) -> None:
+        self.data.pop(key, None)
+        self._message = None
+
+    def load(self, data: Dict[str, str]) -> None:
+        self.data = data
+        self._message = None
+
     def create_message(self) -> HumanMessage:
-        if self.data:
-            memories = "\n".join([f"{k}: {v}" for k, v in self.data.items()])
-            return HumanMessage(f"Here are your long term memories:\n\n{memories}")
-        else:
-            return HumanMessage("You don't have any long-term memories yet.")
+        if self._message is None:
+            if self.data:
+                memories = "\n".join([f"{k}: {v}" for k, v in self.data.items()])
+                self._message = HumanMessage(f"Here are your long term memories:\n\n{memories}")
+            else:
+                self._message = HumanMessage("You don't have any long-term memories yet.")
+        return self._message
 
 
 class ToolWriteLongTermMemoryInput(BaseModel):
@@ -62,11 +79,11 @@ class ToolWriteLongTermMemory(StatefulTool):
         logger.info(f"Writing Long-Term Memory {key} => {value}")
 
         if value != '':
-            self._memory.data[key] = value
+            self._memory.write(key, value)
             self._write_to_file()
             return f"Successfully saved memory: {key} => {value}"
         else:
-            self._memory.data.pop(key, None)
+            self._memory.clear(key)
             self._write_to_file()
             return f"Successfully cleared memory for key: {key}"
 
@@ -78,6 +95,6 @@ class ToolWriteLongTermMemory(StatefulTool):
     def _read_from_file(self) -> None:
         try:
             with open('tmp/longterm_memory.json', 'r') as f:
-                self._memory.data = json.load(f)
+                self._memory.load(json.load(f))
         except FileNotFoundError:
             logger.warning("No long-term memory file found")
@@ -48,8 +48,14 @@ class ToolSendKeyPress(StatefulTool):
         run_manager: Optional[CallbackManagerForToolRun] = None
     ) -> str:
         if not self._sent_key:
-            self._sent_key = True
-            self._previous_key = keycode
+            self.send_keys([keycode])
+
+    def send_keys(self, keycodes: List[str]) -> None:
+        """Send key presses to the game, and record that they were this turn's action."""
+        self._sent_key = True
+        self._previous_key = " ".join(keycodes)
+
+        for keycode in keycodes:
             logger.info(f"Sending key press: {keycode}")
 
             if keycode.upper() == "UP":
@@ -0,0 +1,172 @@
+from logging import getLogger
+from typing import *
+
+from langchain_core.callbacks import CallbackManagerForToolRun
+from langchain_core.tools.base import ArgsSchema
+from langchain_core.messages import HumanMessage
+from pydantic import BaseModel, Field
+
+from dcssllm.agent.util import trim_indent
+from dcssllm.agent.v1.game_state import Position, position_at
+from dcssllm.agent.v1.navigation import NavigationGrid, summarize_keys
+from dcssllm.agent.v1.tool import StatefulTool
+
+if TYPE_CHECKING:
+    from dcssllm.agent.v1.agent_main import V1Agent
+
+
+logger = getLogger(__name__)
+
+# Most moves to walk for one travel call. Fewer if monsters are around.
+MAX_STEPS_PER_TURN = 10
+
+TARGETS = {
+    "frontier": ("the nearest unexplored area", NavigationGrid.nearest_frontier),
+    "downstairs": ("the nearest staircase down", NavigationGrid.nearest_downstairs),
+    "upstairs": ("the nearest staircase up", NavigationGrid.nearest_upstairs),
+    "item": ("the nearest item", NavigationGrid.nearest_item),
+    "monster": ("the nearest monster", NavigationGrid.nearest_monster),
+}
+
+
+class Input(BaseModel):
+    target: str = Field(description="One of 'frontier', 'downstairs', 'upstairs', 'item', 'monster', or map coordinates as 'x,y'")
+
+
+class ToolTravel(StatefulTool):
+    name: str = "travel"
+    description: str = trim_indent(f"""
+        Walks you along the shortest known path towards a target and ends your turn. Use this instead of
+        sending one movement key at a time.
+
+        Targets:
+          frontier   : the nearest unexplored area
+          downstairs : the nearest staircase down
+          upstairs   : the nearest staircase up
+          item       : the nearest item on the floor
+          monster    : the nearest monster. Walking into a monster attacks it.
+          x,y        : a position on the map
+
+        You will take up to {MAX_STEPS_PER_TURN} steps. If any monsters are nearby, you will only take a single
+        step so you can react to them, and you'll stop early if one comes into view on the way.
+    """)
+    args_schema: Optional[ArgsSchema] = Input
+    return_direct: bool = True
+
+    def __init__(self, master: "V1Agent"):
+        super().__init__(master)
+        self._grid: Optional[NavigationGrid] = None
+        # `create_message`'s output and the grid it was made from, as it's asked for on every chatbot call
+        self._message_cache: Optional[Tuple[NavigationGrid, List[HumanMessage]]] = None
+        # Steps of the current route still to walk, as the key to press and where it should take us
+        self._route: List[Tuple[str, Position]] = []
+        self._expected_position: Optional[Position] = None
+
+    @property
+    def walking(self) -> bool:
+        """Whether there are steps left of a route, to be taken without asking the LLM."""
+        return bool(self._route)
+
+    def on_new_turn(self) -> None:
+        self._grid = None
+
+    def _get_grid(self) -> Optional[NavigationGrid]:
+        """The navigation grid for the current game state, built at most once per turn."""
+        state = self._master.tool_game_state.current_state
+        if state is None or state.player_pos is None:
+            return None
+        if self._grid is None or self._grid.state is not state:
+            self._grid = NavigationGrid(state)
+        return self._grid
+
+    def _resolve_target(self, grid: NavigationGrid, target: str) -> Tuple[str, Optional[Position]]:
+        """A description of the target, and where it is if we can reach it."""
+        target = target.strip().lower()
+        if target in TARGETS:
+            description, find = TARGETS[target]
+            found = find(grid)
+            return description, found[0] if found else None
+
+        try:
+            x, y = (int(v) for v in target.strip("()").split(","))
+        except ValueError:
+            return f"'{target}'", None
+        position = position_at(x, y)
+        return "the chosen position", position if grid.distance_to(position) > 0 else None
+
+    def _run(
+        self, target: str,
+        run_manager: Optional[CallbackManagerForToolRun] = None
+    ) -> str:
+        key_press = self._master.tool_send_key_press
+        if key_press._sent_key:
+            return "You have already acted this turn."
+
+        grid = self._get_grid()
+        if grid is None:
+            return "No map is available right now."
+
+        description, position = self._resolve_target(grid, target)
+        if position is None:
+            return f"There is no known path to {description}. Try another target, or explore with 'o'."
+
+        path = grid.path_to(position)
+        keys = grid.directions(path)
+        steps = 1 if grid.state.get_nearby_monsters() else MAX_STEPS_PER_TURN
+        planned = keys[:steps]
+
+        logger.info(f"Travelling to {description} at {position}: {summarize_keys(keys)}")
+        # Only the first step is sent now. The rest follow one per turn, once the game has taken the
+        # one before and asked for another key, so each turn's screen and state are after a whole step.
+        self.stop()
+        self._route = list(zip(planned, path))
+        self.continue_route()
+
+        remaining = len(keys) - len(planned)
+        ret = f"Moving towards {description} at {position}: {summarize_keys(planned)}."
+        if remaining:
+            ret += f" {remaining} more moves to go."
+        return ret
+
+    def continue_route(self) -> bool:
+        """
+        Take the next step of the current route, unless a monster has come into view, or the last step
+        didn't take us where it should have. False if there was no step to take.
+        """
+        if not self._route:
+            return False
+
+        state = self._master.tool_game_state.current_state
+        if self._expected_position is not None and (
+            state is None or state.player_pos != self._expected_position or state.get_nearby_monsters()
+        ):
+            logger.info(f"Travel interrupted at {state.player_pos if state else None}, {len(self._route)} steps short")
+            self.stop()
+            return False
+
+        key, self._expected_position = self._route.pop(0)
+        self._master.tool_send_key_press.send_keys([key])
+        return True
+
+    def stop(self) -> None:
+        self._route = []
+        self._expected_position = None
+
+    def create_message(self) -> List[HumanMessage]:
+        grid = self._get_grid()
+        if grid is None:
+            return []
+        if self._message_cache is None or self._message_cache[0] is not grid:
+            self._message_cache = (grid, self._build_message(grid))
+        return self._message_cache[1]
+
+    def _build_message(self, grid: NavigationGrid) -> List[HumanMessage]:
+        lines = []
+        for target, (description, find) in TARGETS.items():
+            found = find(grid)
+            if found:
+                position, distance = found
+                lines.append(f" - {target}: {description} is {distance} moves away at {position}")
+        if not lines:
+            return []
+        return [HumanMessage("Places you can travel to with the travel tool:\n" + "\n".join(lines))]
@@ -6,8 +6,11 @@ import subprocess
 import fcntl
 import termios
 import struct
+from collections import deque
+from typing import Deque, List, Optional, Tuple
 
 import pyte
+from wcwidth import wcwidth
 
 from dcssllm.keycodes import Keycode
 
@@ -35,8 +38,14 @@ BG_COLORS = {
     "white": "47",
 }
 
+RESET = "\x1b[0m"
+
+# Most game state frames held for the agent before the oldest are dropped
+MAX_PENDING_GAME_STATE_FRAMES = 256
+
 class CursesApplication:
-    def __init__(self, command, cols=80, rows=24, init_wait_secs=1):
+    def __init__(self, command, cols=80, rows=24, init_wait_secs=1, event_driven=False, input_signal=False,
+                 max_pending_frames=MAX_PENDING_GAME_STATE_FRAMES):
         self.command = command
         self.cols = cols
         self.rows = rows
@@ -46,6 +55,50 @@ class CursesApplication:
         self.screen = None
         self.stream = None
 
+        # When event-driven, the PTY master is registered with the asyncio loop and
+        # output is fed to pyte as soon as it arrives, rather than when polled.
+        self.event_driven = event_driven
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._output_event: Optional[asyncio.Event] = None
+        self._last_output_time = 0.0
+
+        # When enabled, the patched game uses an inherited pipe (fd passed via LLM_SIGNAL_FD) as a
+        # side channel. Every time it is ready for a key in the main game, it writes a
+        # `GAME_STATE: <seq> <length>` frame holding the game state dump, then `AWAITING_INPUT: <seq>`.
+        # When it starts autoexplore, travel or another action that takes many steps without a key,
+        # it writes `RUNNING: <seq>` instead, and `game_running` is set until the next AWAITING_INPUT.
+        if input_signal and not event_driven:
+            raise ValueError("input_signal requires event_driven=True")
+        self.input_signal = input_signal
+        self.input_seq = 0
+        self.game_running = False
+        self._input_seq_seen = 0
+        self._input_event: Optional[asyncio.Event] = None
+        self._signal_fd: Optional[int] = None
+        self._signal_buffer = bytearray()
+
+        # Complete game state frames received over the side channel, not yet taken by the agent.
+        # Frames may be deltas against the one before, so consumers should see every one of them, but
+        # if they aren't taken for `max_pending_frames` frames, the oldest are dropped. Consumers then
+        # get a delta against a frame they don't have, and make do until the game's next keyframe.
+        self.game_state_seq = 0
+        self.max_pending_frames = max_pending_frames
+        self.dropped_game_state_frames = 0
+        self._game_state_frames: Deque[bytes] = deque()
+
+        # Per-line content hashes, refreshed from pyte's dirty line set as output is fed.
+        # `screen_version` is bumped whenever any line's content actually changes.
+        self.screen_version = 0
+        self._line_hashes: Optional[List[int]] = None
+        self._fingerprint = 0
+        self._fingerprint_version = -1
+
+        # Per-line render cache. Every line pyte marks dirty is queued in `_stale_lines`, whether or
+        # not its hash changed, so a hash collision can never leave a stale render.
+        self._ansi_lines: Optional[List[str]] = None
+        self._text_lines: Optional[List[str]] = None
+        self._stale_lines = set()
+
     def __enter__(self):
         # Create a pseudo-terminal
         self.master, slave = pty.openpty()
@@ -53,6 +106,19 @@ class CursesApplication:
         # Set terminal size on the slave
         fcntl.ioctl(slave, termios.TIOCSWINSZ, struct.pack("HHHH", self.rows, self.cols, 0, 0))
         
+        # xterm doesn't seem to handle arrow keys correctly
+        env = dict(os.environ, TERM='rxvt')
+
+        # Side channel for the game to send its state and tell us when it's waiting for input.
+        # Both ends are non-blocking: if we stop reading, the game drops snapshots rather than stall.
+        pass_fds = ()
+        if self.input_signal:
+            self._signal_fd, signal_write_fd = os.pipe()
+            os.set_blocking(self._signal_fd, False)
+            os.set_blocking(signal_write_fd, False)
+            env['LLM_SIGNAL_FD'] = str(signal_write_fd)
+            pass_fds = (signal_write_fd,)
+
         # Start the process
         self.process = subprocess.Popen(
             self.command,
@@ -61,13 +127,14 @@ class CursesApplication:
             stderr=slave,
             shell=True,
             preexec_fn=os.setsid,
-
-            # xterm doesn't seem to handle arrow keys correctly
-            env=dict(os.environ, TERM='rxvt')
+            pass_fds=pass_fds,
+            env=env,
         )
 
-        # Close the slave file descriptor as the child process now has it
+        # Close the slave file descriptors as the child process now has them
         os.close(slave)
+        if self.input_signal:
+            os.close(signal_write_fd)
 
         # Set the master to non-blocking mode
         flags = fcntl.fcntl(self.master, fcntl.F_GETFL)
@@ -82,12 +149,18 @@ class CursesApplication:
         
         # Initialize the screen with the output
         self._feed_terminal_output()
+
+        if self.event_driven:
+            self._start_reader()
         return self
 
     # Clean up the pseudo-terminal
     def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stop_reader()
         self.process.terminate()
         os.close(self.master)
+        if self._signal_fd is not None:
+            os.close(self._signal_fd)
     
     def send_key(self, key: str):
         if key == 'UP':
@@ -112,51 +185,276 @@ class CursesApplication:
     async def await_update(self, delay: float = 0):
         if delay > 0:
             await asyncio.sleep(delay)
-        self._feed_terminal_output()
+        if self._loop is None:
+            self._feed_terminal_output()
+
+    async def await_quiescent(self, quiet_secs: float = 0.1):
+        """
+        Wait until the application has produced no output for `quiet_secs`.
+
+        Requires event-driven mode. Returns immediately if the screen has already been
+        quiet for long enough.
+        """
+        if self._output_event is None:
+            raise RuntimeError("await_quiescent requires event_driven=True")
+
+        while True:
+            self._output_event.clear()
+            remaining = self._last_output_time + quiet_secs - time.monotonic()
+            if remaining <= 0:
+                return
+            try:
+                await asyncio.wait_for(self._output_event.wait(), remaining)
+            except TimeoutError:
+                return
+
+    async def await_input_ready(self, settle_secs: float = 0.05, fallback_quiet_secs: float = 0.5,
+                                expect_signal: bool = True, signal_timeout_secs: float = 5.0):
+        """
+        Wait until the game is ready for the next key.
+
+        With `input_signal`, this waits for the game to report a new input request, then for its
+        output to settle for `settle_secs`. Menus and prompts don't go through the game's turn hook
+        and never signal, so unless the game says it's running, `fallback_quiet_secs` without
+        output also counts. While it's running autoexplore, travel or the like, output going quiet
+        doesn't count, as those can pause between steps without wanting a key, unless there's still
+        no signal after `signal_timeout_secs`. Pass `expect_signal=False` outside the main game,
+        where the turn hook never runs, to always take either.
+        """
+        if self._input_event is None:
+            await self.await_quiescent(fallback_quiet_secs)
+            return
+
+        while True:
+            if expect_signal and self.game_running:
+                try:
+                    await asyncio.wait_for(self._await_input_signal(), signal_timeout_secs)
+                except TimeoutError:
+                    await self._await_signal_or_quiet(settle_secs, fallback_quiet_secs)
+                else:
+                    # The game flushes the screen after asking for input, so let the output drain.
+                    await self.await_quiescent(settle_secs)
+                break
+
+            # If the game started running while we waited, the quiet was only a pause between steps
+            signaled = await self._await_signal_or_quiet(settle_secs, fallback_quiet_secs)
+            if signaled or not expect_signal or not self.game_running:
+                break
+        self._input_seq_seen = self.input_seq
+
+    async def _await_signal_or_quiet(self, settle_secs: float, quiet_secs: float) -> bool:
+        """
+        Wait for an input signal or `quiet_secs` without output, whichever comes first. True if it
+        was the signal.
+        """
+        signal_task = asyncio.create_task(self._await_input_signal())
+        quiet_task = asyncio.create_task(self.await_quiescent(quiet_secs))
+        try:
+            done, _ = await asyncio.wait([signal_task, quiet_task], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            signal_task.cancel()
+            quiet_task.cancel()
+
+        if signal_task in done:
+            await self.await_quiescent(settle_secs)
+            return True
+        return False
+
+    async def _await_input_signal(self):
+        while self.input_seq <= self._input_seq_seen:
+            self._input_event.clear()
+            await self._input_event.wait()
+
+    def pop_game_state_frames(self) -> List[bytes]:
+        """Take every game state frame received since the last call, oldest first."""
+        frames = list(self._game_state_frames)
+        self._game_state_frames.clear()
+        return frames
 
     def get_current_screen(self):
-        reset = "\x1b[0m"
-        output_lines = []
+        """Get the screen with terminal formatting codes. Only lines pyte marked dirty are re-rendered."""
+        self._render_dirty_lines()
+        return "\n".join(self._ansi_lines) + RESET + "\n"
+
+    def get_current_text_only_screen(self):
+        """Get the screen as plain text, equivalent to joining `screen.display`."""
+        self._render_dirty_lines()
+        return "\n".join(self._text_lines)
+
+    def fingerprint(self) -> int:
+        """
+        A hash of the whole screen contents, including formatting. Two screens with the same
+        fingerprint can be treated as identical without rendering either of them.
+        """
+        self._update_line_hashes()
+        if self._fingerprint_version != self.screen_version:
+            self._fingerprint = hash(tuple(self._line_hashes))
+            self._fingerprint_version = self.screen_version
+        return self._fingerprint
 
-        for y in sorted(self.screen.buffer.keys()):
+    def line_fingerprints(self) -> Tuple[int, ...]:
+        """Per-line hashes of the screen contents, for finding which lines changed."""
+        self._update_line_hashes()
+        return tuple(self._line_hashes)
+
+    def _update_line_hashes(self):
+        """Re-hash the lines pyte marked dirty, and queue all of them for re-rendering."""
+        if self._line_hashes is None:
+            self._line_hashes = [0] * self.screen.lines
+            self.screen.dirty.update(range(self.screen.lines))
+
+        changed = False
+        for y in self.screen.dirty:
+            if y >= self.screen.lines:
+                continue
             line = self.screen.buffer[y]
-            current_fg = None
-            current_bg = None
-            current_bold = False
-            line_str = ""
-
-            for col in range(self.screen.columns):
-                cell = line[col]
-                
-                cell_fg = cell.fg
-                cell_bg = cell.bg
-                codes = []
-                
-                # If the foreground changed, add its code.
-                if cell_fg != current_fg:
-                    codes.append(FG_COLORS.get(cell_fg, FG_COLORS["default"]))
-                    current_fg = cell_fg
-                
-                # If the background changed, add its code.
-                if cell_bg != current_bg:
-                    codes.append(BG_COLORS.get(cell_bg, BG_COLORS["default"]))
-                    current_bg = cell_bg
-                
-                if cell.bold != current_bold:
-                    codes.append("1" if cell.bold else "22")
-                    current_bold = cell.bold
-
-                if codes:
-                    ansi_seq = "\x1b[" + ";".join(codes) + "m"
-                    line_str += ansi_seq
-
-                line_str += cell.data
-            
-            # Reset at end of line.
-            # line_str += reset
-            
-            output_lines.append(line_str)
-        return "\n".join(output_lines) + reset + "\n"
+            self._stale_lines.add(y)
+            # Hashes only decide whether the screen version moves on
+            line_hash = hash(tuple(line[x] for x in range(self.screen.columns)))
+            if line_hash != self._line_hashes[y]:
+                self._line_hashes[y] = line_hash
+                changed = True
+        self.screen.dirty.clear()
+
+        if changed:
+            self.screen_version += 1
+
+    def _render_dirty_lines(self):
+        self._update_line_hashes()
+        if self._ansi_lines is None:
+            self._ansi_lines = [""] * self.screen.lines
+            self._text_lines = [""] * self.screen.lines
+
+        for y in self._stale_lines:
+            self._ansi_lines[y], self._text_lines[y] = self._render_line(self.screen.buffer[y])
+        self._stale_lines.clear()
+
+    def _render_line(self, line) -> Tuple[str, str]:
+        """Render a single pyte line as (ANSI formatted, plain text)."""
+        current_fg = None
+        current_bg = None
+        current_bold = False
+        is_wide_char = False
+        ansi_parts = []
+        text_parts = []
+
+        for col in range(self.screen.columns):
+            cell = line[col]
+
+            cell_fg = cell.fg
+            cell_bg = cell.bg
+            codes = []
+
+            # If the foreground changed, add its code.
+            if cell_fg != current_fg:
+                codes.append(FG_COLORS.get(cell_fg, FG_COLORS["default"]))
+                current_fg = cell_fg
+
+            # If the background changed, add its code.
+            if cell_bg != current_bg:
+                codes.append(BG_COLORS.get(cell_bg, BG_COLORS["default"]))
+                current_bg = cell_bg
+
+            if cell.bold != current_bold:
+                codes.append("1" if cell.bold else "22")
+                current_bold = cell.bold
+
+            if codes:
+                ansi_parts.append("\x1b[" + ";".join(codes) + "m")
+            ansi_parts.append(cell.data)
+
+            # Plain text skips the stub cell that follows a wide character, like pyte's `display`.
+            if is_wide_char:
+                is_wide_char = False
+            else:
+                text_parts.append(cell.data)
+                is_wide_char = bool(cell.data) and wcwidth(cell.data[0]) == 2
+
+        return "".join(ansi_parts), "".join(text_parts)
+
+    def _start_reader(self):
+        """Register the PTY master with the running event loop."""
+        self._loop = asyncio.get_running_loop()
+        self._output_event = asyncio.Event()
+        self._last_output_time = time.monotonic()
+        self._loop.add_reader(self.master, self._on_readable)
+
+        if self._signal_fd is not None:
+            self._input_event = asyncio.Event()
+            self._loop.add_reader(self._signal_fd, self._on_signal_readable)
+
+    def _stop_reader(self):
+        if self._loop is not None:
+            self._loop.remove_reader(self.master)
+            if self._signal_fd is not None:
+                self._loop.remove_reader(self._signal_fd)
+            self._loop = None
+
+    def _on_signal_readable(self):
+        """Event loop callback for messages from the game's side channel."""
+        try:
+            data = os.read(self._signal_fd, 65536)
+        except BlockingIOError:
+            return
+
+        if not data:
+            self._loop.remove_reader(self._signal_fd)
+            return
+
+        self._signal_buffer += data
+        self._parse_signal_buffer()
+
+    def _parse_signal_buffer(self):
+        """Consume every complete message in the side channel buffer."""
+        while True:
+            newline = self._signal_buffer.find(b'\n')
+            if newline < 0:
+                return
+            header = bytes(self._signal_buffer[:newline])
+
+            if header.startswith(b'GAME_STATE: '):
+                # Only take the frame once all of its payload has arrived, so it's never torn
+                seq, length = header[len(b'GAME_STATE: '):].split()
+                end = newline + 1 + int(length)
+                if len(self._signal_buffer) < end:
+                    return
+                self.game_state_seq = int(seq)
+                self._game_state_frames.append(bytes(self._signal_buffer[newline + 1:end]))
+                if len(self._game_state_frames) > self.max_pending_frames:
+                    self._game_state_frames.popleft()
+                    self.dropped_game_state_frames += 1
+                del self._signal_buffer[:end]
+                continue
+
+            del self._signal_buffer[:newline + 1]
+            if header.startswith(b'AWAITING_INPUT: '):
+                self.input_seq = int(header[len(b'AWAITING_INPUT: '):])
+                self.game_running = False
+                self._input_event.set()
+            elif header.startswith(b'RUNNING: '):
+                self.game_running = True
+
+    def _on_readable(self):
+        """Event loop callback for when the PTY master has data."""
+        try:
+            data = os.read(self.master, 4096)
+        except BlockingIOError:
+            return
+        except OSError:
+            # EIO once the child has exited and closed its side of the PTY
+            data = b''
+
+        if not data:
+            self._stop_reader()
+            return
+
+        self._feed(data)
+        self._last_output_time = time.monotonic()
+        self._output_event.set()
+
+    def _feed(self, data: bytes):
+        self.stream.feed(data)
+        self._update_line_hashes()
 
     def _feed_terminal_output(self):
         """Read from the file descriptor and feed the data to the pyte stream."""
@@ -166,7 +464,7 @@ class CursesApplication:
                 data = os.read(self.master, 4096)
                 if not data:
                     break
-                self.stream.feed(data)
+                self._feed(data)
         except BlockingIOError:
             # No more data available at the moment
             pass
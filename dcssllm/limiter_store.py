@@ -0,0 +1,103 @@
+from contextlib import contextmanager
+import json
+import os
+import sqlite3
+import threading
+from typing import Any, Dict, Iterator, Optional
+
+# How long to wait for another process to finish its transaction before giving up
+LOCK_TIMEOUT_SECS = 30.0
+
+
+class SqliteLimiterStore:
+    """
+    Keeps rate limiter state in a local SQLite file, so every agent process using the same file
+    draws from one shared quota, and the quota survives restarts.
+
+    Each limiter's state is a small JSON object under its key. Limiters load it at the start of
+    every transaction and save it at the end, and transactions take SQLite's write lock, so a
+    reservation across several limiters is atomic across processes as well as threads. Queries that
+    change nothing use `snapshot` instead, which never waits for the write lock.
+
+    Every call here is blocking I/O, so async code should make them from a worker thread.
+    """
+    def __init__(self, path: str):
+        self.path = os.path.abspath(path)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        # Transactions are begun by hand, and one connection is shared by every thread under `_lock`
+        self._connection = sqlite3.connect(
+            self.path, timeout=LOCK_TIMEOUT_SECS, isolation_level=None, check_same_thread=False,
+        )
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._writing = False
+        with self._lock:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS limiter_state (key TEXT PRIMARY KEY, state TEXT NOT NULL)"
+            )
+
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        """
+        Hold the store's write lock for the block, committing on success and rolling back on error.
+        Nested transactions join the outer one.
+        """
+        # IMMEDIATE takes the write lock now, so no other process can read stale state and overdraw
+        with self._begin("BEGIN IMMEDIATE", writing=True):
+            yield
+
+    @contextmanager
+    def snapshot(self) -> Iterator[None]:
+        """
+        Read a consistent view of the store in the block, without taking the write lock. With WAL,
+        this doesn't wait for other processes' transactions. Nested in a transaction, it joins it.
+        """
+        with self._begin("BEGIN DEFERRED", writing=False):
+            yield
+
+    @contextmanager
+    def _begin(self, statement: str, writing: bool) -> Iterator[None]:
+        with self._lock:
+            if self._depth > 0:
+                if writing and not self._writing:
+                    raise RuntimeError("Can't start a transaction inside a snapshot")
+                self._depth += 1
+                try:
+                    yield
+                finally:
+                    self._depth -= 1
+                return
+
+            self._connection.execute(statement)
+            self._depth = 1
+            self._writing = writing
+            try:
+                yield
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+            else:
+                self._connection.execute("COMMIT")
+            finally:
+                self._depth = 0
+                self._writing = False
+
+    def load(self, key: str) -> Optional[Dict[str, Any]]:
+        """The state saved under `key`, or None if there's none yet."""
+        with self._lock:
+            row = self._connection.execute("SELECT state FROM limiter_state WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save(self, key: str, state: Dict[str, Any]) -> None:
+        with self._lock:
+            self._connection.execute(
+                "INSERT INTO limiter_state (key, state) VALUES (?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET state = excluded.state",
+                (key, json.dumps(state)),
+            )
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
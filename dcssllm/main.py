@@ -8,9 +8,12 @@ import os
 
 from langchain.chat_models import init_chat_model
 
+from dcssllm.agent.prompt_cache import llama_cpp_cache_kwargs
 from dcssllm.agent.v1.agent_main import V1Agent
 from dcssllm.curses_utils import CursesApplication
+from dcssllm.limiter_store import SqliteLimiterStore
 from dcssllm.non_consuming_rate_limiter import NonConsumingRateLimiter
+from dcssllm.quota_limiters import DailyRequestLimiter, TokenRateLimiter
 from dcssllm.keycodes import Keycode
 from dcssllm.quota_aware_router import QuotaAwareRouter
 
@@ -48,6 +51,10 @@ async def main():
         cerebras_api_key = secrets.get("cerebras_api_key", "")
         gemini_api_key = secrets.get("gemini_api_key", "")
 
+    # Every agent process on this machine shares one API key, so they share one quota, which
+    # also carries over restarts
+    quota_store = SqliteLimiterStore("tmp/quota.sqlite3")
+
     llm = QuotaAwareRouter([
         #
         # Prefer Gemini when available
@@ -62,7 +69,12 @@ async def main():
                 openai_api_key=gemini_api_key,
             ),
             [
-                NonConsumingRateLimiter(requests_per_second=15/60, max_bucket_size=10)
+                NonConsumingRateLimiter(requests_per_second=15/60, max_bucket_size=10,
+                                        store=quota_store, key="gemini-2.0-flash:requests"),
+                TokenRateLimiter(tokens_per_minute=1_000_000, kind="input",
+                                 store=quota_store, key="gemini-2.0-flash:input_tokens"),
+                DailyRequestLimiter(requests_per_day=1500, timezone="America/Los_Angeles",
+                                    store=quota_store, key="gemini-2.0-flash:daily_requests"),
             ]
         ),
 
@@ -75,7 +87,12 @@ async def main():
                 openai_api_key=gemini_api_key,
             ),
             [
-                NonConsumingRateLimiter(requests_per_second=30/60, max_bucket_size=10)
+                NonConsumingRateLimiter(requests_per_second=30/60, max_bucket_size=10,
+                                        store=quota_store, key="gemini-2.0-flash-lite:requests"),
+                TokenRateLimiter(tokens_per_minute=1_000_000, kind="input",
+                                 store=quota_store, key="gemini-2.0-flash-lite:input_tokens"),
+                DailyRequestLimiter(requests_per_day=1500, timezone="America/Los_Angeles",
+                                    store=quota_store, key="gemini-2.0-flash-lite:daily_requests"),
             ]
         ),
 
@@ -88,7 +105,12 @@ async def main():
                 openai_api_key=gemini_api_key,
             ),
             [
-                NonConsumingRateLimiter(requests_per_second=10/60, max_bucket_size=10)
+                NonConsumingRateLimiter(requests_per_second=10/60, max_bucket_size=10,
+                                        store=quota_store, key="gemini-2.0-flash-exp:requests"),
+                TokenRateLimiter(tokens_per_minute=1_000_000, kind="input",
+                                 store=quota_store, key="gemini-2.0-flash-exp:input_tokens"),
+                DailyRequestLimiter(requests_per_day=1500, timezone="America/Los_Angeles",
+                                    store=quota_store, key="gemini-2.0-flash-exp:daily_requests"),
             ]
         ),
         
@@ -101,17 +123,33 @@ async def main():
                 openai_api_base='http://127.0.0.1:5001/v1/',
                 openai_api_key=local_api_key or "NONE",
                 # Llama.cpp has issues with streaming with tool calls
-                disable_streaming=True 
+                disable_streaming=True,
+                # Prefill dominates turn latency at 32K, so reuse the cached prompt prefix
+                **llama_cpp_cache_kwargs(slot=0),
             ),
             []
         ),
-    ])
+    ],
+        # Tail latency per turn matters most, so race a slow request against the next best model
+        hedge_percentile=0.95,
+        # Dump per-model request, latency and quota wait metrics for Prometheus and for reading by hand
+        metrics_directory="tmp",
+    )
+
+    # Have the game dump its map as binary planes rather than one text line per cell
+    os.environ.setdefault("LLM_DATA_FORMAT", "grid")
 
     min_seconds_between_actions = 3
+
+    # The game signals when it wants a key during normal play. For menus and prompts that don't,
+    # this is how long it must go without producing output before we consider the screen stable.
+    screen_quiet_secs = 0.5
     configure_logging()
 
-    with CursesApplication(command, init_wait_secs=2) as app:
-        agent = V1Agent(
+    # The agent is closed before the game, so its history files are cleaned up however we quit
+    with (
+        CursesApplication(command, init_wait_secs=2, event_driven=True, input_signal=True) as app,
+        V1Agent(
             game=app,
             llm_default=llm,
             # llm_default=gemini_2_flash,
@@ -119,7 +157,8 @@ async def main():
             # llm_summarize_last_turn=groq_deepseek_r1_llama70,
             # llm_current_objective=groq_llama3_70b_8192,
             # llm_final_action=groq_deepseek_r1_llama70,
-        )
+        ) as agent,
+    ):
 
         # register handler for when the user ctrl-c quits python
         def signal_handler(sig, frame):
@@ -143,19 +182,13 @@ async def main():
             # Wait for screen to stabilize
             # This is needed to support some commands that take a while to execute
             # (i.e. auto-explore and auto-move)
-            while True:
-                await app.await_update()
-                screen1 = app.get_current_screen()
-                await app.await_update(0.5)
-                screen2 = app.get_current_screen()
-                if screen1 == screen2:
-                    break
-                else:
-                    logger.debug("Screen changed - assuming the game is still updating")
-            
+            # In the main game, the game signals when it wants a key or is running; elsewhere only quiet output tells us
+            await app.await_input_ready(fallback_quiet_secs=screen_quiet_secs,
+                                        expect_signal=agent.game_state == "main_game")
+
             # Get the screen
-            screen = screen2
-            text_only_screen = '\n'.join(app.screen.display)
+            screen = app.get_current_screen()
+            text_only_screen = app.get_current_text_only_screen()
 
             sys.stdout.write(screen)
             with open('tmp/screen.log', 'w') as f:
@@ -165,6 +198,10 @@ async def main():
 
             await agent.ai_turn(screen, text_only_screen)
 
+            # Steps of a travel route don't need the LLM, so take the next as soon as the game's ready
+            if agent.tool_travel.walking:
+                continue
+
             await asyncio.sleep(max(0, min_seconds_between_actions - (time.time() - last_action_time)))
             last_action_time = time.time()
 
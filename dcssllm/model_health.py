@@ -0,0 +1,134 @@
+from collections import deque
+import math
+import threading
+import time
+from typing import Deque, Optional
+
+# Weight of each new sample in the running averages of latency, time to first token and errors
+LATENCY_SMOOTHING = 0.2
+ERROR_SMOOTHING = 0.1
+
+# How many recent latencies are kept for percentiles, and how many are needed before they're trusted
+LATENCY_WINDOW = 100
+MIN_PERCENTILE_SAMPLES = 10
+
+# Consecutive failures that open the circuit breaker
+BREAKER_FAILURE_THRESHOLD = 3
+
+# How long an open breaker stays open before letting one request through to probe the model.
+# Doubles every time the probe fails, up to the maximum.
+BREAKER_COOLDOWN_SECS = 30.0
+MAX_BREAKER_COOLDOWN_SECS = 600.0
+
+# Error rates near 1 would make the expected time blow up, so cap how much they can scale it
+MAX_ERROR_RATE = 0.9
+
+
+class ModelHealth:
+    """
+    How fast and how reliable a model has been recently: running averages of latency, time to
+    first token and error rate, and a circuit breaker that stops routing to a model that keeps failing.
+
+    Shared between every router that uses the same model, so copies made by `bind_tools` learn together.
+    Safe to use from multiple threads.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latency: Optional[float] = None
+        self.time_to_first_token: Optional[float] = None
+        self.error_rate = 0.0
+        self._latencies: Deque[float] = deque(maxlen=LATENCY_WINDOW)
+
+        self._consecutive_failures = 0
+        self._cooldown = BREAKER_COOLDOWN_SECS
+        # When the open breaker lets a probe through, or None if it's closed
+        self._open_until: Optional[float] = None
+        self._probing = False
+
+    def expected_completion_secs(self) -> float:
+        """
+        How long a request is expected to take, counting the retries its error rate implies.
+        Zero for a model we haven't heard back from yet, so it gets tried.
+        """
+        if self.latency is None:
+            return 0.0
+        return self.latency / (1 - min(self.error_rate, MAX_ERROR_RATE))
+
+    def latency_percentile(self, percentile: float) -> Optional[float]:
+        """The given percentile (0-1) of recent latencies, or None if there aren't enough to tell."""
+        with self._lock:
+            if len(self._latencies) < MIN_PERCENTILE_SAMPLES:
+                return None
+            ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, math.ceil(percentile * len(ordered)) - 1)]
+
+    def time_until_closed(self, now: Optional[float] = None) -> float:
+        """How long until the breaker lets a request through, or 0 if it does now."""
+        with self._lock:
+            return self._time_until_closed(time.monotonic() if now is None else now)
+
+    def _time_until_closed(self, now: float) -> float:
+        """See `time_until_closed`. Must hold `_lock`."""
+        if self._open_until is None:
+            return 0.0
+        if self._probing:
+            # Someone is already probing; wait a cooldown for their verdict
+            return self._cooldown
+        return max(0.0, self._open_until - now)
+
+    def try_begin_request(self) -> Optional[bool]:
+        """
+        Note that a request is being routed to the model. Returns None if the breaker won't let it
+        through, or else whether it's the probe of an open breaker.
+        """
+        with self._lock:
+            if self._time_until_closed(time.monotonic()) > 0:
+                return None
+            if self._open_until is None:
+                return False
+            self._probing = True
+            return True
+
+    def record_first_token(self, secs: float) -> None:
+        with self._lock:
+            self.time_to_first_token = _smooth(self.time_to_first_token, secs, LATENCY_SMOOTHING)
+
+    def record_success(self, latency: float) -> None:
+        with self._lock:
+            self.latency = _smooth(self.latency, latency, LATENCY_SMOOTHING)
+            if self.time_to_first_token is None:
+                self.time_to_first_token = latency
+            self._latencies.append(latency)
+            self.error_rate -= ERROR_SMOOTHING * self.error_rate
+
+            self._consecutive_failures = 0
+            self._cooldown = BREAKER_COOLDOWN_SECS
+            self._open_until = None
+            self._probing = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.error_rate += ERROR_SMOOTHING * (1 - self.error_rate)
+            self._consecutive_failures += 1
+
+            if self._probing:
+                # The probe failed, so back off for longer
+                self._cooldown = min(self._cooldown * 2, MAX_BREAKER_COOLDOWN_SECS)
+            if self._probing or self._consecutive_failures >= BREAKER_FAILURE_THRESHOLD:
+                self._open_until = time.monotonic() + self._cooldown
+            self._probing = False
+
+    def record_abandoned(self, probe: bool) -> None:
+        """
+        The request was cancelled before finishing, so we learned nothing about the model.
+        If it was the breaker's probe, let another request probe instead.
+        """
+        if probe:
+            with self._lock:
+                self._probing = False
+
+
+def _smooth(average: Optional[float], sample: float, weight: float) -> float:
+    if average is None:
+        return sample
+    return average + weight * (sample - average)
@@ -1,39 +1,241 @@
+import asyncio
+from contextlib import ExitStack, contextmanager
+import math
 import time
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple, Type
 from langchain_core.rate_limiters import InMemoryRateLimiter
 
+from dcssllm.limiter_store import SqliteLimiterStore
+
+try:
+    from openai import APIConnectionError as _OpenAIConnectionError, APITimeoutError as _OpenAITimeoutError
+except ImportError:
+    _OpenAIConnectionError = ConnectionError
+    _OpenAITimeoutError = TimeoutError
+
+# Errors that mean a request never reached the provider, so the quota it reserved wasn't used.
+# Cancellation isn't one: once a request is sent, the provider counts it whether or not we wait for
+# the answer. A reservation only refunds a cancellation if it came before the request was sent.
+REFUNDABLE_ERRORS: Tuple[Type[BaseException], ...] = (
+    ConnectionError, _OpenAIConnectionError,
+)
+
+# Exceptions to `REFUNDABLE_ERRORS`. openai raises APITimeoutError, a kind of APIConnectionError, when
+# the answer doesn't come back in time, after the provider has already counted the request.
+UNREFUNDABLE_ERRORS: Tuple[Type[BaseException], ...] = (
+    _OpenAITimeoutError,
+)
+
+
 class NonConsumingRateLimiter(InMemoryRateLimiter):
     """
     A custom in memory rate limiter that creates a method
     to not consume tokens and simply check if there are enough tokens available.
 
     This is useful when we want to check multiple rate limiters, and only proceed
-    with consuming tokens if all the rate limiters allow it.
+    with consuming tokens if all the rate limiters allow it. Use `reserve_all` to do
+    that atomically, so concurrent callers can't both pass the check and overdraw a bucket.
 
-    This does introduce a small race condition where a token might be consumed
-    after the check, but it's OK in this context.
+    With a `store`, the bucket is kept under `key` in it rather than only in memory, so it's shared
+    by every process using the store and survives restarts. Only the methods here use the store;
+    langchain's own `acquire` still works on this process's copy.
     """
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, store: Optional[SqliteLimiterStore] = None, key: Optional[str] = None, **kwargs):
         super().__init__(*args, **kwargs)
-        
+        if store is not None and key is None:
+            raise ValueError("A limiter kept in a store needs a key")
+        self.store = store
+        self.key = key
+
+    def _get_state(self) -> Dict[str, Any]:
+        """The bucket's state, to save in the store. Times are wall clock, to mean the same to every process."""
+        last = None if self.last is None else time.time() - (time.monotonic() - self.last)
+        return {"available_tokens": self.available_tokens, "last": last}
+
+    def _set_state(self, state: Dict[str, Any]) -> None:
+        """Restore the bucket from `_get_state`'s output."""
+        self.available_tokens = state["available_tokens"]
+        last = state["last"]
+        self.last = None if last is None else time.monotonic() - (time.time() - last)
+
+
+    def _refill(self, now: float) -> None:
+        """Add the tokens earned since the last refill. Must be held with `_hold`."""
+        # initialize on first call to avoid a burst
+        if self.last is None:
+            self.last = now
+
+        elapsed = now - self.last
+
+        if elapsed * self.requests_per_second >= 1:
+            self.available_tokens += elapsed * self.requests_per_second
+            self.last = now
+
+        # Make sure that we don't exceed the bucket size.
+        # This is used to prevent bursts of requests.
+        self.available_tokens = min(self.available_tokens, self.max_bucket_size)
     
     def can_consume(self) -> bool:
         """Returns whether we can consume a token."""
-        with self._consume_lock:
+        with _hold([self], write=False):
+            self._refill(time.monotonic())
+
+            # As long as we have at least one token, we can proceed.
+            return self.available_tokens >= 1
+
+    def time_until_available(self, amount: float = 1) -> float:
+        """Returns how many seconds until `amount` tokens can be consumed, or 0 if they can be now."""
+        with _hold([self], write=False):
             now = time.monotonic()
+            self._refill(now)
+            return self._time_until(amount, now)
 
-            # initialize on first call to avoid a burst
-            if self.last is None:
-                self.last = now
+    def _time_until(self, amount: float, now: float) -> float:
+        """See `time_until_available`. Must be held with `_hold`, after refilling."""
+        if self.available_tokens >= amount:
+            return 0.0
+        if self.requests_per_second <= 0:
+            return math.inf
 
-            elapsed = now - self.last
+        # Tokens are only added once at least a whole token's worth of time has passed
+        needed = max(amount - self.available_tokens, 1)
+        return max(0.0, needed / self.requests_per_second - (now - self.last))
 
-            if elapsed * self.requests_per_second >= 1:
-                self.available_tokens += elapsed * self.requests_per_second
-                self.last = now
+    def cost(self, input_tokens: int, output_tokens: int) -> float:
+        """How many of this limiter's tokens a request uses. One per request."""
+        return 1
 
-            # Make sure that we don't exceed the bucket size.
-            # This is used to prevent bursts of requests.
-            self.available_tokens = min(self.available_tokens, self.max_bucket_size)
+    def charge(self, amount: float) -> None:
+        """
+        Take tokens whether or not they're available, i.e. when a request used more than was reserved.
+        The bucket may go into debt, which delays later requests until it's paid back.
+        """
+        with _hold([self]):
+            self._refill(time.monotonic())
+            self.available_tokens -= amount
 
-            # As long as we have at least one token, we can proceed.
-            return self.available_tokens >= 1
\ No newline at end of file
+    def refund(self, amount: float = 1) -> None:
+        """Give back tokens that were consumed for a request that never happened."""
+        with _hold([self]):
+            self.available_tokens = min(self.available_tokens + amount, self.max_bucket_size)
+
+
+class Reservation:
+    """
+    Tokens taken from a set of limiters by `reserve_all`, based on estimated usage. Settle it with
+    the real usage once the request is done, or refund it if the request never happened.
+
+    Call `mark_sent` just before sending the request. From then on, the provider may count it, so
+    cancelling it no longer refunds the reservation.
+    """
+    def __init__(self, charges: List[Tuple[NonConsumingRateLimiter, float]]):
+        self._charges = charges
+        self.refunded = False
+        self.settled = False
+        self.sent = False
+
+    def mark_sent(self) -> None:
+        self.sent = True
+
+    def refund(self) -> None:
+        """Give the tokens back to every limiter. Does nothing if already refunded or settled."""
+        if self.refunded or self.settled:
+            return
+        self.refunded = True
+        for limiter, amount in self._charges:
+            limiter.refund(amount)
+
+    def settle(self, input_tokens: int, output_tokens: int) -> None:
+        """Correct every limiter from the estimate to the request's real usage."""
+        if self.refunded or self.settled:
+            return
+        self.settled = True
+        for limiter, reserved in self._charges:
+            difference = limiter.cost(input_tokens, output_tokens) - reserved
+            if difference > 0:
+                limiter.charge(difference)
+            elif difference < 0:
+                limiter.refund(-difference)
+
+    @contextmanager
+    def refund_on_error(self) -> Iterator[None]:
+        """
+        Refund if the block raises one of `REFUNDABLE_ERRORS` (but not `UNREFUNDABLE_ERRORS`), or is
+        cancelled before the request was sent, then re-raise.
+        """
+        try:
+            yield
+        except BaseException as error:
+            if self.should_refund(error):
+                self.refund()
+            raise
+
+    def should_refund(self, error: BaseException) -> bool:
+        """Whether `error`, raised while making the request, means its quota should be given back."""
+        if isinstance(error, UNREFUNDABLE_ERRORS):
+            return False
+        if isinstance(error, REFUNDABLE_ERRORS):
+            return True
+        return isinstance(error, asyncio.CancelledError) and not self.sent
+
+
+def reserve_all(limiters: Sequence[NonConsumingRateLimiter],
+                input_tokens: int = 0, output_tokens: int = 0) -> Optional[Reservation]:
+    """
+    Take what a request with the estimated usage costs from every limiter, or from none of them if
+    any doesn't have enough. Returns the reservation, or None if nothing was taken.
+    """
+    # A request can't cost more than a full bucket, or it could never be made. Settling charges the rest.
+    charges: Dict[int, Tuple[NonConsumingRateLimiter, float]] = {
+        id(limiter): (limiter, min(limiter.cost(input_tokens, output_tokens), limiter.max_bucket_size))
+        for limiter in limiters
+    }
+
+    ordered = [charges[key] for key in sorted(charges)]
+    with _hold([limiter for limiter, _ in ordered]):
+        now = time.monotonic()
+        for limiter, amount in ordered:
+            limiter._refill(now)
+            if limiter.available_tokens < amount:
+                return None
+        for limiter, amount in ordered:
+            limiter.available_tokens -= amount
+        return Reservation(ordered)
+
+
+@contextmanager
+def _hold(limiters: Sequence[NonConsumingRateLimiter], write: bool = True) -> Iterator[None]:
+    """
+    Lock the limiters for the block, loading the state of any kept in a store, and saving it
+    afterwards unless the block raises. Without `write`, the block only reads: the stores aren't
+    write-locked and nothing is saved to them.
+    """
+    # Lock in a fixed order so concurrent holds over overlapping sets can't deadlock
+    ordered = sorted({id(limiter): limiter for limiter in limiters}.items())
+    stores = sorted({id(limiter.store): limiter.store for _, limiter in ordered if limiter.store}.values(),
+                    key=lambda store: store.path)
+    with ExitStack() as stack:
+        for _, limiter in ordered:
+            stack.enter_context(limiter._consume_lock)
+        for store in stores:
+            stack.enter_context(store.transaction() if write else store.snapshot())
+
+        for _, limiter in ordered:
+            if limiter.store is not None:
+                state = limiter.store.load(limiter.key)
+                if state is not None:
+                    limiter._set_state(state)
+        yield
+        if write:
+            for _, limiter in ordered:
+                if limiter.store is not None:
+                    limiter.store.save(limiter.key, limiter._get_state())
+
+
+def time_until_all_available(limiters: Sequence[NonConsumingRateLimiter],
+                             input_tokens: int = 0, output_tokens: int = 0) -> float:
+    """How long until `reserve_all` could succeed for a request with the estimated usage."""
+    return max((
+        limiter.time_until_available(min(limiter.cost(input_tokens, output_tokens), limiter.max_bucket_size))
+        for limiter in limiters
+    ), default=0.0)
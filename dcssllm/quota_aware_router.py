@@ -1,76 +1,426 @@
-
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
 import logging
-from datetime import time
+import math
+import time
 
 from langchain_core.language_models.chat_models import BaseChatModel
 from langchain_core.language_models.base import LanguageModelInput
-from langchain_core.messages import BaseMessage, BaseMessageChunk
+from langchain_core.messages import AIMessage, BaseMessage, BaseMessageChunk, get_buffer_string
+from langchain_core.messages.ai import UsageMetadata, add_usage
 from typing import (
     List, Any, Tuple, Dict, Iterator, AsyncIterator, Optional, Sequence, 
-    Callable, Literal, Union,
+    Callable, Literal, Union, Deque,
 )
 from langchain_core.tools import BaseTool
 from langchain_core.runnables import Runnable
 from pydantic import BaseModel
 
-from dcssllm.non_consuming_rate_limiter import NonConsumingRateLimiter
+from dcssllm.model_health import ModelHealth
+from dcssllm.non_consuming_rate_limiter import (
+    NonConsumingRateLimiter, Reservation, reserve_all, time_until_all_available,
+)
+from dcssllm.router_metrics import RouterMetrics
 
 logger = logging.getLogger(__name__)
 
+# Longest we sleep at once while waiting for quota, so a model whose limiters never refill can't hang us forever
+MAX_QUOTA_WAIT_SECS = 60.0
+
+# Shortest we sleep at once, so rounding in the limiters can't turn the wait into a busy loop
+MIN_QUOTA_WAIT_SECS = 0.001
+
+# Rough characters per token, to estimate a prompt's size before sending it
+CHARS_PER_TOKEN = 4
+
+# Starting guess for a response's size, until we've seen real responses
+DEFAULT_EXPECTED_OUTPUT_TOKENS = 512
+
+# Weight of each new response in the running average of response sizes
+OUTPUT_TOKENS_SMOOTHING = 0.2
+
+
+class ModelReservation:
+    """
+    A model picked for one call, with the quota for the call reserved on its limiters.
+
+    Get one from `QuotaAwareRouter.reserve` or `areserve`, make the call on `model` inside `charging()`,
+    and settle it with the call's usage. Release it when done, or use it as a context manager: releasing
+    gives the quota back unless the call was sent, so a reservation that's never used costs nothing.
+    Each caller gets its own, so concurrent callers can't take each other's model or quota.
+    """
+    def __init__(self, model: BaseChatModel, reservation: Reservation, health: ModelHealth,
+                 probe: bool, usage: Tuple[int, int], metrics: RouterMetrics, index: int):
+        self.model = model
+        self.reservation = reservation
+        self.health = health
+        self.metrics = metrics
+        # The model's position in the router, which is how `metrics` knows it
+        self.index = index
+        # Whether this call is the probe of the model's open circuit breaker
+        self.probe = probe
+        # The (input, output) tokens the quota was reserved for
+        self.usage = usage
+        # Whether the call's outcome has been recorded in `health`
+        self._recorded = False
+
+    def settle(self, usage: Optional[UsageMetadata] = None) -> None:
+        """
+        Charge the limiters for what the call really used. Without usage, the call is assumed to
+        have used what was reserved. Does nothing if already settled or refunded.
+        """
+        if usage:
+            if not self.reservation.settled and not self.reservation.refunded:
+                self.metrics.record_usage(self.index, usage["input_tokens"], usage["output_tokens"])
+            self.reservation.settle(usage["input_tokens"], usage["output_tokens"])
+        else:
+            self.reservation.settle(*self.usage)
+
+    @contextmanager
+    def charging(self) -> Iterator[None]:
+        """
+        Make the call in this block, straight away: entering it marks the request as sent. If the call
+        can't connect, the quota is refunded. Otherwise, even if it's cancelled, it stays charged, at
+        the estimate unless the block settles it.
+        """
+        try:
+            with self.reservation.refund_on_error():
+                self.reservation.mark_sent()
+                yield
+        finally:
+            self.settle()
+
+    def record_first_token(self, secs: float) -> None:
+        self.health.record_first_token(secs)
+        self.metrics.observe(self.index, "time_to_first_token_seconds", secs)
+
+    def record_success(self, latency: float) -> None:
+        self._recorded = True
+        self.health.record_success(latency)
+        self.metrics.observe(self.index, "latency_seconds", latency)
+
+    def record_failure(self) -> None:
+        self._recorded = True
+        self.health.record_failure()
+        self.metrics.increment(self.index, "errors")
+
+    def release(self) -> None:
+        """Give back the quota if the call was never sent. Safe to call more than once."""
+        if not self.reservation.sent:
+            self.reservation.refund()
+        if not self._recorded:
+            self._recorded = True
+            self.health.record_abandoned(self.probe)
+
+    def __enter__(self) -> "ModelReservation":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.release()
+
+
 class QuotaAwareRouter(BaseChatModel):
     """
     A model that routes requests to the best model available based on the rate limiters.
+
+    Models are ranked by when a request to them is expected to complete: the wait for their quota
+    (or for their circuit breaker to let a request through) plus their recent latency, scaled up by
+    their recent error rate. Ties, including models we haven't heard back from yet, go in list order.
+
+    If `hedge_percentile` is set, an async request still running after that percentile of the
+    model's recent latencies is also sent to the next best model that's available right away.
+    Whichever finishes first is used, and the other is cancelled.
+
+    Every call reserves its own model and quota, so one router, and the copies `bind_tools` and
+    `with_structured_output` make of it, can be shared by any number of concurrent games and subagents.
+
+    What the router has been doing is counted in `metrics`, and written to `metrics_directory`
+    every so often if one is given.
+
+    If any limiter is kept in a store, the async methods check and charge quota from a worker
+    thread, as the store blocks on SQLite.
     """
 
     """
     A list of tuples, where each tuple contains a language model and a list of rate limiters.
-    The first model in the list where all the rate limiters are not exceeded is the active model.
     """
     _models: List[Tuple[BaseChatModel, List[NonConsumingRateLimiter]]]
-    _next_selected_model: Optional[BaseChatModel] = None
 
-    def __init__(self, models: List[Tuple[BaseChatModel, List[NonConsumingRateLimiter]]]):
+    # How each model has been doing, in the same order as `_models`
+    _health: List[ModelHealth]
+
+    # Latency percentile (0-1) after which a request is hedged, or None to never hedge
+    _hedge_percentile: Optional[float]
+
+    # Coroutines waiting in `areserve`, in the order they started waiting. Shared with copies,
+    # as they draw from the same limiters.
+    _waiters: Deque[asyncio.Future]
+
+    # Running average of output tokens per response, to estimate the next one
+    _expected_output_tokens: float
+
+    # Per-model counters and histograms, shared with copies
+    _metrics: RouterMetrics
+
+    # Whether any limiter is kept in a store, so checking quota blocks on I/O
+    _uses_store: bool
+
+    def __init__(self, models: List[Tuple[BaseChatModel, List[NonConsumingRateLimiter]]],
+                 health: Optional[List[ModelHealth]] = None, hedge_percentile: Optional[float] = None,
+                 waiters: Optional[Deque[asyncio.Future]] = None, metrics: Optional[RouterMetrics] = None,
+                 metrics_directory: Optional[str] = None):
         super().__init__()
         self._models = models
-        
+        self._health = health if health is not None else [ModelHealth() for _ in models]
+        self._hedge_percentile = hedge_percentile
+        self._waiters = waiters if waiters is not None else deque()
+        self._expected_output_tokens = DEFAULT_EXPECTED_OUTPUT_TOKENS
+        if metrics is None:
+            metrics = RouterMetrics([_model_name(model) for model, _ in models], directory=metrics_directory)
+        self._metrics = metrics
+        self._uses_store = any(limiter.store is not None for _, limiters in models for limiter in limiters)
+
+    @property
+    def metrics(self) -> RouterMetrics:
+        return self._metrics
+
     def get_active_model(self, consume: bool = False) -> BaseChatModel:
         """
-        Get the active model. This will bump the rate limiters for the returned model.
+        Get the model a request would go to right now.
 
-        Multiple calls to this method may happen before we actually use the model, so
-        there is logic to determine what the next model should be.
+        Without `consume`, nothing is reserved, so the answer is only a hint: another caller may take
+        the quota first. With it, this blocks until a model is available and charges it for one
+        request that can't be refunded. Prefer `reserve`, which can give back quota it didn't use.
         """
+        if not consume:
+            return self._peek_model()
+        with self.reserve() as reservation:
+            reservation.settle()
+            return reservation.model
 
-        # If we have already chosen which model to use next, use that.
-        if self._next_selected_model is not None:
-            ret = self._next_selected_model
-            if consume:
-                self._next_selected_model = None
-            return ret
+    async def aget_active_model(self, consume: bool = False) -> BaseChatModel:
+        """Async version of `get_active_model`. Prefer `areserve`."""
+        if not consume:
+            return await self._off_loop(self._peek_model)
+        with await self.areserve() as reservation:
+            await self._off_loop(reservation.settle)
+            return reservation.model
 
-        # Try to decide which model to use next.
+    def reserve(self, input: Optional[LanguageModelInput] = None) -> ModelReservation:
+        """
+        Reserve the best model for one call with `input`, blocking the calling thread until one
+        is available. Use `areserve` from coroutines.
+        """
+        usage = self._estimate_usage(input)
+        start = time.monotonic()
         while True:
-            for model, limiters in self._models:
-                # If there's only one limiter, we can just use that and avoid the race condition.
-                if len(limiters) <= 1:
-                    if len(limiters) == 0 or limiters[0].acquire():
-                        if not consume:
-                            # We're not consuming, so we can use this model next.
-                            self._next_selected_model = model
-                        return model
-                else:
-                    # Check if all the rate limiters are not exceeded.
-                    if not all(limiter.can_consume() for limiter in limiters):
-                        continue
-                    # Eagerly consume the quota for this model.
-                    for limiter in limiters:
-                        limiter.acquire()
-
-                    if not consume:
-                        # We're not consuming, so we can use this model next.
-                        self._next_selected_model = model
-                    return model
-            time.sleep(0.1)
+            reservation, wait = self._try_reserve(usage)
+            if reservation is not None:
+                self._metrics.observe(reservation.index, "queue_wait_seconds", time.monotonic() - start)
+                return reservation
+            time.sleep(self._wait_with_metrics(wait))
+
+    async def areserve(self, input: Optional[LanguageModelInput] = None) -> ModelReservation:
+        """
+        Async version of `reserve`. Waits without blocking the event loop, and callers waiting for
+        quota get a model in the order they asked.
+        """
+        usage = self._estimate_usage(input)
+        start = time.monotonic()
+
+        # Don't jump the queue if others are already waiting
+        if not self._waiters:
+            reservation, _ = await self._off_loop(self._try_reserve, usage)
+            if reservation is not None:
+                self._metrics.observe(reservation.index, "queue_wait_seconds", 0.0)
+                return reservation
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            # Wait until we're at the front of the queue
+            if self._waiters[0] is not waiter:
+                await waiter
+
+            while True:
+                reservation, wait = await self._off_loop(self._try_reserve, usage)
+                if reservation is not None:
+                    self._metrics.observe(reservation.index, "queue_wait_seconds", time.monotonic() - start)
+                    return reservation
+                await asyncio.sleep(self._wait_with_metrics(wait))
+        finally:
+            self._waiters.remove(waiter)
+            if self._waiters and not self._waiters[0].done():
+                self._waiters[0].set_result(None)
+
+    def _wait_with_metrics(self, wait: float) -> float:
+        """
+        Dump the metrics if they're due, before waiting `wait` seconds for quota. Returns how long to
+        actually wait, which is cut short so they're dumped on time however long the wait.
+        """
+        self._metrics.dump_if_due()
+        return min(wait, self._metrics.dump_interval_secs)
+
+    async def _off_loop[T](self, func: Callable[..., T], *args: Any) -> T:
+        """Call `func`, from a worker thread if it may block on a limiter store."""
+        if self._uses_store:
+            return await asyncio.to_thread(func, *args)
+        return func(*args)
+
+    def _try_reserve(self, usage: Tuple[int, int]) -> Tuple[Optional[ModelReservation], float]:
+        """
+        Try to reserve the model expected to finish a request with the estimated (input, output)
+        token usage soonest, without waiting. Returns the reservation, or None and how long to wait
+        until that model can take the request.
+        """
+        ranked = self._rank_models(usage)
+        if not ranked:
+            return None, MAX_QUOTA_WAIT_SECS
+
+        # If the best model isn't available yet, it's still quicker to wait for it than to use another
+        ready_in, index = ranked[0]
+        if ready_in > 0:
+            return None, min(max(ready_in, MIN_QUOTA_WAIT_SECS), MAX_QUOTA_WAIT_SECS)
+
+        reservation = self._reserve_model(index, usage)
+        if reservation is None:
+            # Someone else took the quota since we ranked the models, so rank them again
+            return None, MIN_QUOTA_WAIT_SECS
+
+        # Count it as a fallback if a model that's usually faster had to be passed over
+        fastest = min(range(len(self._models)), key=lambda i: self._health[i].expected_completion_secs())
+        if index != fastest:
+            self._metrics.increment(index, "fallbacks")
+        return reservation, 0.0
+
+    def _try_reserve_hedge(self, usage: Tuple[int, int], exclude: BaseChatModel) -> Optional[ModelReservation]:
+        """Reserve the best model other than `exclude` that can take a request right now, if any."""
+        for ready_in, index in self._rank_models(usage):
+            if ready_in > 0 or self._models[index][0] is exclude:
+                continue
+            reservation = self._reserve_model(index, usage)
+            if reservation is not None:
+                self._metrics.increment(index, "hedges")
+                return reservation
+        return None
+
+    def _peek_model(self) -> BaseChatModel:
+        ranked = self._rank_models((0, 0))
+        return self._models[ranked[0][1] if ranked else 0][0]
+
+    def _rank_models(self, usage: Tuple[int, int]) -> List[Tuple[float, int]]:
+        """
+        The (seconds until available, index) of every model that could ever take the request,
+        best first by when the request is expected to complete.
+        """
+        now = time.monotonic()
+        ranked = []
+        for index, (_, limiters) in enumerate(self._models):
+            health = self._health[index]
+            # A model whose breaker is open is as unavailable as one that's out of quota
+            ready_in = max(time_until_all_available(limiters, *usage), health.time_until_closed(now))
+            if math.isinf(ready_in):
+                continue
+            ranked.append((ready_in + health.expected_completion_secs(), index, ready_in))
+
+        # Sorting is stable, so ties keep list order
+        ranked.sort(key=lambda entry: entry[0])
+        return [(ready_in, index) for _, index, ready_in in ranked]
+
+    def _reserve_model(self, index: int, usage: Tuple[int, int]) -> Optional[ModelReservation]:
+        model, limiters = self._models[index]
+        health = self._health[index]
+        # Charge every limiter (requests, tokens, daily caps), or none of them if any is exhausted
+        reservation = reserve_all(limiters, *usage)
+        if reservation is None:
+            return None
+
+        probe = health.try_begin_request()
+        if probe is None:
+            # The breaker opened, or another caller started probing, since we ranked the models
+            reservation.refund()
+            return None
+        return ModelReservation(model, reservation, health, probe, usage, self._metrics, index)
+
+    def _hedge_delay(self, health: ModelHealth) -> Optional[float]:
+        """How long to give a request to `health`'s model before hedging it, or None to not hedge."""
+        if self._hedge_percentile is None or len(self._models) < 2:
+            return None
+        return health.latency_percentile(self._hedge_percentile)
+
+    def _estimate_usage(self, input: Optional[LanguageModelInput]) -> Tuple[int, int]:
+        """Guess a request's (input, output) tokens, to reserve before sending it."""
+        if input is None:
+            return 0, 0
+        prompt = get_buffer_string(self._convert_input(input).to_messages())
+        return len(prompt) // CHARS_PER_TOKEN, round(self._expected_output_tokens)
+
+    def _settle(self, reservation: ModelReservation, usage: Optional[UsageMetadata]) -> None:
+        """Charge the limiters for what a request really used, now that we know."""
+        reservation.settle(usage)
+        if usage:
+            self._expected_output_tokens += OUTPUT_TOKENS_SMOOTHING * (usage["output_tokens"] - self._expected_output_tokens)
+
+    @contextmanager
+    def _using(self, reservation: ModelReservation) -> Iterator[float]:
+        """
+        Make a call with a reservation, recording how long it took or that it failed in the model's
+        health, then release it. Yields the start time.
+        """
+        with reservation, reservation.charging(), self._recording(reservation) as start:
+            yield start
+
+    @asynccontextmanager
+    async def _ausing(self, reservation: ModelReservation) -> AsyncIterator[float]:
+        """`_using` for async calls. See `_acharging`."""
+        async with self._acharging(reservation):
+            with self._recording(reservation) as start:
+                yield start
+
+    @contextmanager
+    def _recording(self, reservation: ModelReservation) -> Iterator[float]:
+        """Record how long the call in the block took, or that it failed. Yields the start time."""
+        self._metrics.increment(reservation.index, "requests")
+        start = time.monotonic()
+        try:
+            try:
+                yield start
+            except (asyncio.CancelledError, GeneratorExit):
+                self._metrics.increment(reservation.index, "cancelled")
+                raise
+            except Exception:
+                reservation.record_failure()
+                raise
+            reservation.record_success(time.monotonic() - start)
+        finally:
+            self._metrics.dump_if_due()
+
+    @asynccontextmanager
+    async def _acharging(self, reservation: ModelReservation) -> AsyncIterator[None]:
+        """
+        `with reservation, reservation.charging()` for async calls. Refunding and settling write to
+        the limiter store, which can wait on another process's transaction, so they're done off the
+        event loop.
+        """
+        reservation.reservation.mark_sent()
+        try:
+            yield
+        except BaseException as error:
+            if reservation.reservation.should_refund(error):
+                await self._off_loop(reservation.reservation.refund)
+            raise
+        finally:
+            if not reservation.reservation.settled and not reservation.reservation.refunded:
+                await self._off_loop(reservation.settle)
+            # The request was sent, so this only records it in the model's health
+            reservation.release()
+
+    async def _arelease(self, reservation: ModelReservation) -> None:
+        """`reservation.release()`, with any refund done off the event loop."""
+        if not reservation.reservation.sent:
+            await self._off_loop(reservation.reservation.refund)
+        reservation.release()
 
     def bind_tools(
         self, 
@@ -89,11 +439,15 @@ class QuotaAwareRouter(BaseChatModel):
             [
                 (model.bind_tools(tools, tool_choice=tool_choice, **kwargs), limiters) 
                 for model, limiters in self._models
-            ]
+            ],
+            health=self._health,
+            hedge_percentile=self._hedge_percentile,
+            waiters=self._waiters,
+            metrics=self._metrics,
         )
-    
+
     def with_structured_output(
-        self,
+        self, 
         schema: Union[Dict, type],
         *,
         include_raw: bool = False,
@@ -103,41 +457,136 @@ class QuotaAwareRouter(BaseChatModel):
             [
                 (model.with_structured_output(schema, include_raw=include_raw, **kwargs), limiters) 
                 for model, limiters in self._models
-            ]
+            ],
+            health=self._health,
+            hedge_percentile=self._hedge_percentile,
+            waiters=self._waiters,
+            metrics=self._metrics,
         )
 
-    #
+    #    
     # We're doing some hacky stuff here and disobeying the contract of BaseChatModel.
-    #
+    #    
     # Instead of overriding the official methods, we're going to override the actual
     # invocation methods. This helps ensure as much logic is delegated to the underlying
     # model as possible.
-    #
-    def invoke(self, *args, **kwargs: Any) -> BaseMessage:
-        return self.get_active_model(consume=True).invoke(*args, **kwargs)
-
-    def ainvoke(self, *args, **kwargs: Any) -> BaseMessage:
-        return self.get_active_model(consume=True).ainvoke(*args, **kwargs)
-    
-    def stream(self, *args, **kwargs: Any) -> Iterator[BaseMessageChunk]:
-        return self.get_active_model(consume=True).stream(*args, **kwargs)
-
-    def astream(self, *args, **kwargs: Any) -> AsyncIterator[BaseMessageChunk]:
-        return self.get_active_model(consume=True).astream(*args, **kwargs)
-    
+    #    
+    #    
+    # Quota is reserved before each call from an estimate of its size, and settled afterwards from
+    # its `usage_metadata`. If the call can't connect, or is cancelled before it's sent, the request
+    # never reached the provider, so the reservation is refunded. A call cancelled after it's sent,
+    # including a stream closed early, stays charged.
+    #    
+    # Latency and errors are recorded for invoke and stream calls. Only `ainvoke` hedges, as hedging
+    # a sync call would need a thread per request, and a stream can't switch models once it's started.
+    #    
+    def invoke(self, input: LanguageModelInput, *args, **kwargs: Any) -> BaseMessage:
+        reservation = self.reserve(input)
+        with self._using(reservation):
+            response = reservation.model.invoke(input, *args, **kwargs)
+            self._settle(reservation, _usage_of(response))
+        return response
+
+    async def ainvoke(self, input: LanguageModelInput, *args, **kwargs: Any) -> BaseMessage:
+        reservation = await self.areserve(input)
+        hedge_after = self._hedge_delay(reservation.health)
+        if hedge_after is None:
+            return await self._ainvoke_on(reservation, input, *args, **kwargs)
+
+        requests = {asyncio.ensure_future(self._ainvoke_on(reservation, input, *args, **kwargs)): reservation}
+        try:
+            done, _ = await asyncio.wait(requests, timeout=hedge_after)
+            if done:
+                return done.pop().result()
+
+            hedge = await self._off_loop(self._try_reserve_hedge, reservation.usage, reservation.model)
+            if hedge is None:
+                return await next(iter(requests))
+            logger.info(f"Request still running after {hedge_after:.1f}s, hedging with another model")
+            requests[asyncio.ensure_future(self._ainvoke_on(hedge, input, *args, **kwargs))] = hedge
+
+            # Use whichever finishes first, unless it failed and the other might still succeed
+            pending = set(requests)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for request in done:
+                    if request.exception() is None:
+                        return request.result()
+                    error = error or request.exception()
+            raise error
+        finally:
+            for request, request_reservation in requests.items():
+                if not request.done():
+                    # A request that was sent keeps its quota charged when cancelled
+                    request.cancel()
+                    if not request_reservation.reservation.sent:
+                        # It never started running, so nothing else will give its quota back
+                        await self._arelease(request_reservation)
+
+    async def _ainvoke_on(self, reservation: ModelReservation, input: LanguageModelInput,
+                          *args, **kwargs: Any) -> BaseMessage:
+        async with self._ausing(reservation):
+            response = await reservation.model.ainvoke(input, *args, **kwargs)
+            await self._off_loop(self._settle, reservation, _usage_of(response))
+        return response
+
+    def stream(self, input: LanguageModelInput, *args, **kwargs: Any) -> Iterator[BaseMessageChunk]:
+        reservation = self.reserve(input)
+        with self._using(reservation) as start:
+            chunks = reservation.model.stream(input, *args, **kwargs)
+            first = next(chunks, None)
+            if first is None:
+                return
+            reservation.record_first_token(time.monotonic() - start)
+
+            # Usage is reported on the last chunks, so add it up as they go by
+            usage = _usage_of(first)
+            try:
+                yield first
+                for chunk in chunks:
+                    usage = _add_usage(usage, _usage_of(chunk))
+                    yield chunk
+            finally:
+                self._settle(reservation, usage)
+
+    async def astream(self, input: LanguageModelInput, *args, **kwargs: Any) -> AsyncIterator[BaseMessageChunk]:
+        reservation = await self.areserve(input)
+        async with self._ausing(reservation) as start:
+            chunks = reservation.model.astream(input, *args, **kwargs)
+            first = await anext(chunks, None)
+            if first is None:
+                return
+            reservation.record_first_token(time.monotonic() - start)
+
+            # Usage is reported on the last chunks, so add it up as they go by
+            usage = _usage_of(first)
+            try:
+                yield first
+                async for chunk in chunks:
+                    usage = _add_usage(usage, _usage_of(chunk))
+                    yield chunk
+            finally:
+                await self._off_loop(self._settle, reservation, usage)
+
     def batch(self, *args, **kwargs: Any) -> List[BaseMessage]:
-        return self.get_active_model(consume=True).batch(*args, **kwargs)
+        with self.reserve() as reservation, reservation.charging():
+            return reservation.model.batch(*args, **kwargs)
+
+    async def abatch(self, *args, **kwargs: Any) -> List[BaseMessage]:
+        reservation = await self.areserve()
+        async with self._acharging(reservation):
+            return await reservation.model.abatch(*args, **kwargs)
 
-    def abatch(self, *args, **kwargs: Any) -> List[BaseMessage]:
-        return self.get_active_model(consume=True).abatch(*args, **kwargs)
-    
     def batch_as_completed(self, *args, **kwargs: Any) -> Iterator[Tuple[int, Union[BaseMessage, Exception]]]:
         return self.get_active_model(consume=True).batch_as_completed(*args, **kwargs)
 
-    def abatch_as_completed(self, *args, **kwargs: Any) -> AsyncIterator[Tuple[int, Union[BaseMessage, Exception]]]:
-        return self.get_active_model(consume=True).abatch_as_completed(*args, **kwargs) 
+    async def abatch_as_completed(self, *args, **kwargs: Any) -> AsyncIterator[Tuple[int, Union[BaseMessage, Exception]]]:
+        model = await self.aget_active_model(consume=True)
+        async for result in model.abatch_as_completed(*args, **kwargs):
+            yield result
 
-    #
+    #    
     # These are needed but not technically used.
     #    
     def _generate(self, messages: List[BaseMessage], **kwargs: Any) -> BaseMessage:
@@ -147,22 +596,51 @@ class QuotaAwareRouter(BaseChatModel):
     def _stream(self, messages: List[BaseMessage], **kwargs: Any) -> Iterator[BaseMessageChunk]:
         logger.warn("Use of _stream is not supposed to happen")
         return self.get_active_model(consume=True)._stream(messages, **kwargs)
-    
-    def _agenerate(self, messages: List[BaseMessage], **kwargs: Any) -> AsyncIterator[BaseMessageChunk]:
+
+    async def _agenerate(self, messages: List[BaseMessage], **kwargs: Any) -> AsyncIterator[BaseMessageChunk]:
         logger.warn("Use of _agenerate is not supposed to happen")
-        return self.get_active_model(consume=True)._agenerate(messages, **kwargs)
-    
-    def _astream(self, messages: List[BaseMessage], **kwargs: Any) -> AsyncIterator[BaseMessageChunk]:
+        model = await self.aget_active_model(consume=True)
+        return await model._agenerate(messages, **kwargs)
+
+    async def _astream(self, messages: List[BaseMessage], **kwargs: Any) -> AsyncIterator[BaseMessageChunk]:
         logger.warn("Use of _astream is not supposed to happen")
-        return self.get_active_model(consume=True)._astream(messages, **kwargs)
-    
+        model = await self.aget_active_model(consume=True)
+        async for chunk in model._astream(messages, **kwargs):
+            yield chunk
+
     @property
     def _llm_type(self) -> str:
         logger.warn("Use of _llm_type is not supposed to happen")
         return self.get_active_model()._llm_type
-    
+
     @property
     def _identifying_params(self) -> Dict[str, Any]:
         logger.warn("Use of _llm_type is not supposed to happen")
         return self.get_active_model()._identifying_params
 
+
+def _model_name(model: Runnable) -> str:
+    """A readable name for a model, for metrics. Looks through `bind_tools` and similar wrappers."""
+    while True:
+        for attribute in ("model_name", "model"):
+            name = getattr(model, attribute, None)
+            if isinstance(name, str):
+                return name
+        if not hasattr(model, "bound"):
+            return type(model).__name__
+        model = model.bound
+
+
+def _usage_of(response: Any) -> Optional[UsageMetadata]:
+    """The token usage reported with a response, if any. Structured output has none unless `include_raw`."""
+    if isinstance(response, dict):
+        response = response.get("raw")
+    if isinstance(response, AIMessage):
+        return response.usage_metadata
+    return None
+
+
+def _add_usage(a: Optional[UsageMetadata], b: Optional[UsageMetadata]) -> Optional[UsageMetadata]:
+    if a is None or b is None:
+        return a or b
+    return add_usage(a, b)
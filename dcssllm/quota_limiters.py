@@ -0,0 +1,65 @@
+from datetime import date, datetime, timedelta
+import math
+import time
+from typing import Any, Dict, Literal
+from zoneinfo import ZoneInfo
+
+from dcssllm.non_consuming_rate_limiter import NonConsumingRateLimiter
+
+
+class TokenRateLimiter(NonConsumingRateLimiter):
+    """
+    Limits LLM tokens per minute, either input (prompt) or output (completion) tokens.
+
+    Requests are reserved from an estimate and settled from the response's `usage_metadata`.
+    Unlike a request limiter, the bucket starts full: providers allow a whole minute's tokens
+    straight away, and large prompts would otherwise stall the first turns.
+    """
+    def __init__(self, tokens_per_minute: float, kind: Literal["input", "output"] = "input",
+                 max_bucket_size: float = None, **kwargs):
+        super().__init__(
+            requests_per_second=tokens_per_minute / 60,
+            max_bucket_size=max_bucket_size or tokens_per_minute,
+            **kwargs,
+        )
+        self.kind = kind
+        self.available_tokens = self.max_bucket_size
+
+    def cost(self, input_tokens: int, output_tokens: int) -> float:
+        return input_tokens if self.kind == "input" else output_tokens
+
+
+class DailyRequestLimiter(NonConsumingRateLimiter):
+    """
+    Limits requests per calendar day, resetting at midnight in `timezone`. Gemini's daily
+    quotas reset at midnight Pacific time.
+    """
+    def __init__(self, requests_per_day: int, timezone: str = "UTC", **kwargs):
+        super().__init__(requests_per_second=requests_per_day / 86400, max_bucket_size=requests_per_day, **kwargs)
+        self.timezone = ZoneInfo(timezone)
+        self.available_tokens = requests_per_day
+        self._day = datetime.now(self.timezone).date()
+
+    def _get_state(self) -> Dict[str, Any]:
+        return {**super()._get_state(), "day": self._day.isoformat()}
+
+    def _set_state(self, state: Dict[str, Any]) -> None:
+        super()._set_state(state)
+        self._day = date.fromisoformat(state["day"])
+
+    def _refill(self, now: float) -> None:
+        # Days follow the wall clock, so `now` from the monotonic clock isn't used
+        today = datetime.now(self.timezone).date()
+        if today != self._day:
+            self._day = today
+            self.available_tokens = self.max_bucket_size
+
+    def _time_until(self, amount: float, now: float) -> float:
+        if self.available_tokens >= amount:
+            return 0.0
+        if amount > self.max_bucket_size:
+            return math.inf
+
+        # Wait for tomorrow's quota
+        tomorrow = datetime.combine(self._day + timedelta(days=1), datetime.min.time(), self.timezone)
+        return max(0.0, tomorrow.timestamp() - time.time())
@@ -0,0 +1,173 @@
+import bisect
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional, Sequence
+
+# Upper bounds of the histogram buckets, in seconds
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+QUEUE_WAIT_BUCKETS = (0.001, 0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+
+# How often the metrics are written to disk, at most
+DUMP_INTERVAL_SECS = 30.0
+
+METRIC_PREFIX = "dcssllm_router"
+
+# Name, help text and type of every metric, in the order they're written
+COUNTERS = {
+    "requests": "Requests sent to the model.",
+    "errors": "Requests to the model that failed.",
+    "cancelled": "Requests to the model that were cancelled, including hedges that lost.",
+    "fallbacks": "Requests sent to the model because a model expected to be faster was unavailable.",
+    "hedges": "Requests sent to the model to hedge a slow request to another model.",
+    "input_tokens": "Prompt tokens the model reported using.",
+    "output_tokens": "Completion tokens the model reported using.",
+}
+HISTOGRAMS = {
+    "queue_wait_seconds": ("Time spent waiting for quota before a request was sent to the model.", QUEUE_WAIT_BUCKETS),
+    "latency_seconds": ("Time from sending a request to the model until its response finished.", LATENCY_BUCKETS),
+    "time_to_first_token_seconds": ("Time from sending a streamed request to the model until its first chunk.", LATENCY_BUCKETS),
+}
+
+
+class Histogram:
+    """Counts of observations at or below each bucket's upper bound, like a Prometheus histogram."""
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = tuple(buckets)
+        # One more than the bounds, for observations above the largest
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self) -> List[int]:
+        """The count at or below each bound, then the total, as Prometheus expects."""
+        counts, total = [], 0
+        for count in self.counts:
+            total += count
+            counts.append(total)
+        return counts
+
+
+class ModelMetrics:
+    """Counters and histograms for one model. Updated through `RouterMetrics`, which holds the lock."""
+    def __init__(self, name: str):
+        self.name = name
+        self.counters: Dict[str, float] = {counter: 0 for counter in COUNTERS}
+        self.histograms = {name: Histogram(buckets) for name, (_, buckets) in HISTOGRAMS.items()}
+
+
+class RouterMetrics:
+    """
+    What a `QuotaAwareRouter` has been doing, per model: requests, errors, fallbacks, tokens used,
+    and how long requests waited for quota and took to answer.
+
+    Shared between a router and its copies. If `directory` is set, the metrics are written there
+    as `router_metrics.prom` (Prometheus text format) and `router_metrics.json` every
+    `dump_interval_secs`. That's checked whenever a request finishes, and while requests wait for
+    quota or for a circuit breaker, so the files stay fresh when nothing is getting through.
+    """
+    def __init__(self, model_names: Sequence[str], directory: Optional[str] = None,
+                 dump_interval_secs: float = DUMP_INTERVAL_SECS):
+        self._lock = threading.Lock()
+        self.models = [ModelMetrics(name) for name in _unique(model_names)]
+        self.directory = directory
+        self.dump_interval_secs = dump_interval_secs
+        self._last_dump = time.monotonic()
+
+    def increment(self, index: int, counter: str, amount: float = 1) -> None:
+        with self._lock:
+            self.models[index].counters[counter] += amount
+
+    def observe(self, index: int, histogram: str, value: float) -> None:
+        with self._lock:
+            self.models[index].histograms[histogram].observe(value)
+
+    def record_usage(self, index: int, input_tokens: int, output_tokens: int) -> None:
+        with self._lock:
+            counters = self.models[index].counters
+            counters["input_tokens"] += input_tokens
+            counters["output_tokens"] += output_tokens
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                model.name: {
+                    **model.counters,
+                    **{
+                        name: {
+                            "buckets": dict(zip([*map(str, histogram.buckets), "+Inf"], histogram.cumulative_counts())),
+                            "sum": histogram.sum,
+                            "count": histogram.count,
+                        }
+                        for name, histogram in model.histograms.items()
+                    },
+                }
+                for model in self.models
+            }
+
+    def to_prometheus(self) -> str:
+        lines = []
+        with self._lock:
+            for counter, help_text in COUNTERS.items():
+                metric = f"{METRIC_PREFIX}_{counter}_total"
+                lines.append(f"# HELP {metric} {help_text}")
+                lines.append(f"# TYPE {metric} counter")
+                for model in self.models:
+                    lines.append(f"{metric}{{model={_label(model.name)}}} {model.counters[counter]}")
+
+            for name, (help_text, _) in HISTOGRAMS.items():
+                metric = f"{METRIC_PREFIX}_{name}"
+                lines.append(f"# HELP {metric} {help_text}")
+                lines.append(f"# TYPE {metric} histogram")
+                for model in self.models:
+                    histogram = model.histograms[name]
+                    label = _label(model.name)
+                    for bound, count in zip([*map(str, histogram.buckets), "+Inf"], histogram.cumulative_counts()):
+                        lines.append(f'{metric}_bucket{{model={label},le="{bound}"}} {count}')
+                    lines.append(f"{metric}_sum{{model={label}}} {histogram.sum}")
+                    lines.append(f"{metric}_count{{model={label}}} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def dump(self) -> None:
+        """Write the metrics to `directory` now."""
+        if self.directory is None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        _write_atomically(os.path.join(self.directory, "router_metrics.prom"), self.to_prometheus())
+        _write_atomically(os.path.join(self.directory, "router_metrics.json"), json.dumps(self.to_dict(), indent=2))
+
+    def dump_if_due(self) -> None:
+        """Write the metrics to `directory` if it's been `dump_interval_secs` since the last time."""
+        now = time.monotonic()
+        with self._lock:
+            if self.directory is None or now - self._last_dump < self.dump_interval_secs:
+                return
+            self._last_dump = now
+        self.dump()
+
+
+def _unique(names: Sequence[str]) -> List[str]:
+    """Number repeated names, so each model gets its own series."""
+    unique = []
+    for index, name in enumerate(names):
+        unique.append(name if names.count(name) == 1 else f"{name}#{index}")
+    return unique
+
+
+def _label(value: str) -> str:
+    escaped = value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return f'"{escaped}"'
+
+
+def _write_atomically(path: str, content: str) -> None:
+    """Write through a temporary file, so readers never see half a dump."""
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as f:
+        f.write(content)
+    os.replace(temp_path, path)